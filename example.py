@@ -30,7 +30,7 @@ font.load(input_path("mig68000_8x16.data"), charmap, 8, 16)
 font.write(canvas, 8, 176, "Hello world!\nThis is a test!")
 font.write(canvas, 4, 0, "Long string is long! " * 8)
 
-rect = canvas.rect(8, 176, 24, 32)
+rect = canvas.rect(8, 176, 24, 32, view=True)
 canvas.blend(rect, 160, 176)
 
 canvas.to_png(output_path("test.png"))
@@ -0,0 +1,303 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from image_processing import instrumentation
+from image_processing.png_writer import PngWriter
+
+
+# fcTL dispose operations.
+DISPOSE_NONE, DISPOSE_BACKGROUND, DISPOSE_PREVIOUS = range(3)
+
+# fcTL blend operations.
+BLEND_SOURCE, BLEND_OVER = range(2)
+
+
+def changed_span(a, b, bpp):
+    """Finds the range of pixels in which two scanlines differ.
+
+    Prefix and suffix equality are monotonic, so both ends are located by bisecting with slice comparisons, which
+    leaves the per-byte work to C.
+
+    @param bytes a: The first scanline.
+    @param bytes b: The second scanline, as long as ``a``.
+    @param int bpp: The number of bytes per pixel.
+    @return tuple: ``(start, end)`` pixel offsets, ``end`` being exclusive, or None if the scanlines are equal.
+    """
+    if a == b:
+        return None
+
+    pixels = len(a) // bpp
+
+    # The longest equal prefix, in pixels.
+    lo, hi = 0, pixels
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid * bpp] == b[:mid * bpp]:
+            lo = mid
+        else:
+            hi = mid - 1
+    start = lo
+
+    # The longest equal suffix, in pixels.
+    lo, hi = 0, pixels - start
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid * bpp:] == b[len(b) - mid * bpp:]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return start, pixels - lo
+
+
+def encode_frame(region, width, height, preset):
+    """Filters and compresses the image data of a frame. This is a module-level function so process pools can
+    pickle it.
+
+    @param bytes region: The frame's region as 24-bit RGB.
+    @param int width: The width of the region.
+    @param int height: The height of the region.
+    @param CompressionPreset preset: The compression settings.
+    @return bytes: The compressed data.
+    """
+    return PngWriter(None, width, height, preset=preset).process_image_data(region)
+
+
+class ApngWriter(object):
+    """ApngWriter encodes a sequence of Canvas frames as an animated PNG.
+
+    Every frame after the first is compared to the previous one and only the bounding box of the changed pixels is
+    stored, as a sub-rectangle frame that replaces that region. Animations in which only a small part of the image
+    changes, e.g. a clock or a label, therefore cost little more than their first frame.
+
+    With more than one worker, ``write_frames`` filters and compresses several frames at once while the next frames
+    are being rendered. Chunks are still written strictly in frame order.
+    """
+
+    def __init__(self, stream, width, height, num_frames, num_plays=0, preset=None, workers=1, executor=None,
+                 queue_size=None):
+        """Creates a new ApngWriter object.
+
+        @param BytesIO stream: The stream to write the APNG to.
+        @param int width: The width of the animation.
+        @param int height: The height of the animation.
+        @param int num_frames: The number of frames that will be written.
+        @param int num_plays: The number of times to loop the animation. 0 indicates infinite looping (optional).
+        @param preset: The compression preset, see PngWriter (optional).
+        @type preset: str or CompressionPreset or None
+        @param int workers: The number of frames ``write_frames`` compresses in parallel. 1 compresses every frame
+                            right away (optional).
+        @param executor: A ``concurrent.futures`` executor to compress frames on, e.g. a ProcessPoolExecutor, which
+                         also runs the filters in parallel. If omitted, a thread pool with ``workers`` threads is
+                         created for each call of ``write_frames`` (optional).
+        @type executor: concurrent.futures.Executor or None
+        @param int queue_size: The most frames ``write_frames`` keeps in flight before it waits for the oldest one to
+                               be written. Defaults to twice the number of workers (optional).
+        """
+        if num_frames <= 0:
+            raise ValueError("An animation needs at least one frame.")
+        if workers < 1:
+            raise ValueError("workers must be positive and non-zero.")
+        if queue_size is not None and queue_size < 1:
+            raise ValueError("queue_size must be positive and non-zero.")
+
+        self.writer = PngWriter(stream, width, height, preset=preset)
+        self.stream = stream
+        self.width = width
+        self.height = height
+        self.num_frames = num_frames
+        self.num_plays = num_plays
+        self.preset = self.writer.preset
+        self.workers = workers
+        self.executor = executor
+        self.queue_size = queue_size or 2 * workers
+
+        self.frames_read = 0
+        self.frames_written = 0
+        self.seq = 0
+        self.previous = None
+
+    def write_frame(self, frame, delay_num=1, delay_den=10):
+        """Writes the next frame of the animation. The signature and acTL chunk are written along with the first
+        frame, the IEND chunk along with the last one.
+
+        @param Canvas frame: The frame. It must be as large as the animation.
+        @param int delay_num: The numerator for the fraction representing the frame's delay (optional).
+        @param int delay_den: The denominator for the fraction representing the frame's delay (optional).
+        """
+        previous = self.previous
+        x, y, width, height, region = self.frame_region(frame)
+
+        try:
+            data = encode_frame(region, width, height, self.preset)
+        except BaseException:
+            self.rollback(previous)
+            raise
+
+        self.emit_frame(data, delay_num, delay_den, x, y, width, height)
+
+    def write_frames(self, frames, delay_num=1, delay_den=10):
+        """Writes the next frames of the animation as they are produced, e.g. by a generator.
+
+        Each frame is compared to the previous one on the calling thread, then its region is filtered and compressed
+        on the workers while the following frames are produced. Compressed frames are written in order as soon as
+        all frames before them are written, with their fcTL and fdAT sequence numbers assigned at that point. At most
+        ``queue_size`` frames are in flight; after that, reading the next frame waits for the oldest one.
+
+        If producing or compressing a frame fails, the frames that were read but not written yet are dropped, so
+        writing can continue with the frame after the last one written.
+
+        @param frames: The frames, as Canvas objects.
+        @type frames: iterable of Canvas
+        @param int delay_num: The numerator for the fraction representing each frame's delay (optional).
+        @param int delay_den: The denominator for the fraction representing each frame's delay (optional).
+        """
+        if self.workers == 1 and self.executor is None:
+            for frame in frames:
+                self.write_frame(frame, delay_num, delay_den)
+            return
+
+        executor = self.executor or ThreadPoolExecutor(self.workers)
+        pending = deque()
+        # The scanlines of the last frame written.
+        written = self.previous
+
+        try:
+            for frame in frames:
+                x, y, width, height, region = self.frame_region(frame)
+                future = instrumentation.submit(executor, encode_frame, region, width, height, self.preset)
+                pending.append((future, x, y, width, height, self.previous))
+
+                while pending and (len(pending) > self.queue_size or pending[0][0].done()):
+                    future, x, y, width, height, rows = pending.popleft()
+                    self.emit_frame(future.result(), delay_num, delay_den, x, y, width, height)
+                    written = rows
+
+            while pending:
+                future, x, y, width, height, rows = pending.popleft()
+                self.emit_frame(future.result(), delay_num, delay_den, x, y, width, height)
+                written = rows
+        finally:
+            for future, _, _, _, _, _ in pending:
+                future.cancel()
+            if self.executor is None:
+                executor.shutdown()
+            if self.frames_read != self.frames_written:
+                self.rollback(written)
+
+    def write_animation(self, frames, delay_num=1, delay_den=10):
+        """Convenience method that writes all frames of an animation. ``num_frames`` must match ``len(frames)``.
+
+        @param list frames: The frames, as Canvas objects.
+        @param int delay_num: The numerator for the fraction representing each frame's delay (optional).
+        @param int delay_den: The denominator for the fraction representing each frame's delay (optional).
+        """
+        if len(frames) != self.num_frames - self.frames_read:
+            raise ValueError("Expected %d frames, got %d." % (self.num_frames - self.frames_read, len(frames)))
+
+        self.write_frames(frames, delay_num, delay_den)
+
+    def close(self):
+        """Checks that the animation is complete. Its last frame already wrote the IEND chunk, so the stream is left
+        open.
+        """
+        if self.frames_written != self.num_frames:
+            raise ValueError("Only %d of %d frames were written." % (self.frames_written, self.num_frames))
+
+    def rollback(self, previous):
+        """Drops the frames that were read but not written, so the next frame follows the last one written.
+
+        @param list previous: The scanlines of the last frame written, or None if no frame was written yet.
+        """
+        self.previous = previous
+        self.frames_read = self.frames_written
+
+    def frame_region(self, frame):
+        """Reads the next frame and extracts the region that changed since the previous one.
+
+        @param Canvas frame: The frame. It must be as large as the animation.
+        @return tuple: ``(x, y, width, height, region)``, where ``region`` is the changed region as 24-bit RGB. The
+                       first frame is returned whole.
+        """
+        if self.frames_read == self.num_frames:
+            raise ValueError("All %d frames have already been written." % self.num_frames)
+        if frame.width != self.width or frame.height != self.height:
+            raise ValueError("Frames must be %d x %d pixels." % (self.width, self.height))
+
+        rows = list(frame.rows())
+
+        if self.previous is None:
+            x, y, width, height = 0, 0, self.width, self.height
+            region = b"".join(rows)
+        else:
+            x, y, width, height = self.dirty_rect(self.previous, rows)
+            region = b"".join(row[x * 3:(x + width) * 3] for row in rows[y:y + height])
+
+        self.previous = rows
+        self.frames_read += 1
+        return x, y, width, height, region
+
+    def emit_frame(self, data, delay_num, delay_den, x, y, width, height):
+        """Writes the chunks of the next frame, whose region has already been compressed.
+
+        @param bytes data: The compressed region, see ``encode_frame``.
+        @param int delay_num: The numerator for the fraction representing the frame's delay.
+        @param int delay_den: The denominator for the fraction representing the frame's delay.
+        @param int x: The x coordinate of the region.
+        @param int y: The y coordinate of the region.
+        @param int width: The width of the region.
+        @param int height: The height of the region.
+        """
+        if self.frames_written == 0:
+            self.writer.write_signature()
+            self.writer.write_ihdr()
+            self.writer.write_actl(self.num_frames, self.num_plays)
+
+            # The first frame is also the default image, so it's stored in IDAT chunks.
+            self.write_fctl(delay_num, delay_den, x, y, width, height)
+            self.writer.write_chunk(b"IDAT", data)
+        else:
+            self.write_fctl(delay_num, delay_den, x, y, width, height)
+            self.writer.write_chunk(b"fdAT", self.next_seq().to_bytes(4, "big") + data)
+
+        self.frames_written += 1
+
+        if self.frames_written == self.num_frames:
+            self.writer.write_iend()
+
+    def write_fctl(self, delay_num, delay_den, x, y, width, height):
+        """Writes a fcTL chunk for a frame that replaces the given region, using the next sequence number."""
+        self.writer.write_fctl(self.next_seq(), delay_num, delay_den, width, height, x, y, DISPOSE_NONE, BLEND_SOURCE)
+
+    def next_seq(self):
+        """Returns the next sequence number. fcTL and fdAT chunks share one sequence.
+
+        @return int: The sequence number.
+        """
+        seq = self.seq
+        self.seq += 1
+        return seq
+
+    def dirty_rect(self, previous, rows):
+        """Computes the bounding box of the pixels that differ between two frames.
+
+        @param list previous: The scanlines of the previous frame, as 24-bit RGB.
+        @param list rows: The scanlines of the current frame, as 24-bit RGB.
+        @return tuple: ``(x, y, width, height)``. If the frames are identical, a single pixel is returned, as APNG
+                       frames cannot be empty.
+        """
+        top, bottom, left, right = None, None, self.width, 0
+
+        for y, (a, b) in enumerate(zip(previous, rows)):
+            span = changed_span(a, b, 3)
+
+            if span is not None:
+                if top is None:
+                    top = y
+                bottom = y
+                left, right = min(left, span[0]), max(right, span[1])
+
+        if top is None:
+            return 0, 0, 1, 1
+
+        return left, top, right - left, bottom - top + 1
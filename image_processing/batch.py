@@ -0,0 +1,371 @@
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from multiprocessing.shared_memory import SharedMemory
+
+from image_processing.canvas import Canvas, RgbaColor, alpha_runs
+from image_processing.font import Font
+
+
+# The assets of the current worker process, set up by attach_assets.
+worker_assets = {}
+
+
+class SharedImage(object):
+    """SharedImage gives read-only access to a Canvas' pixels that were placed in shared memory by BatchRenderer.
+
+    It can be blended onto a Canvas like a Canvas. Rows are read straight from the shared block, so every process
+    attached to it uses the same copy of the pixels.
+    """
+
+    def __init__(self, name, width, height, bgcolor):
+        """Attaches to a shared memory block holding ``width * height`` pixels in the layout of ``Canvas.pixels``.
+
+        @param str name: The name of the shared memory block.
+        @param int width: The width of the image.
+        @param int height: The height of the image.
+        @param tuple bgcolor: The background color of the image, as an ``(r, g, b, a)`` tuple.
+        """
+        self.memory = SharedMemory(name)
+        self.owner = None
+        self.width = width
+        self.height = height
+        self.bgcolor = RgbaColor(*bgcolor)
+        self.data = self.memory.buf[:width * height * 32].toreadonly()
+        self.pixels = self.data.cast("d")
+
+    def band(self, y, height):
+        """Returns a SharedImage of a band of rows of this image, reading the same shared block. It must not be used
+        after this image is closed.
+
+        @param int y: The y coordinate of the band's first row.
+        @param int height: The number of rows.
+        @return SharedImage: The band.
+        """
+        if y < 0 or height < 0 or y + height > self.height:
+            raise ValueError("The band does not fit into the image.")
+
+        # Bypass __init__, which would attach to the block once more.
+        band = object.__new__(SharedImage)
+        band.memory = self.memory
+        band.owner = self
+        band.width = self.width
+        band.height = height
+        band.bgcolor = self.bgcolor
+        band.data = self.data[y * self.width * 32:(y + height) * self.width * 32]
+        band.pixels = band.data.cast("d")
+        return band
+
+    def close(self):
+        """Detaches from the shared memory block. Bands only release their own access to it."""
+        self.pixels.release()
+        self.data.release()
+
+        if self.owner is None:
+            self.memory.close()
+
+    def row_pixels(self, y, x0=0, x1=None):
+        """Reads the given part of a row. See ``Canvas.row_pixels``.
+
+        @return tuple: ``(pixels, index)``, where ``index`` is the position of the row's pixel 0 in ``pixels``.
+        """
+        x1 = self.width if x1 is None else x1
+        start = (y * self.width + x0) * 32
+
+        pixels = array("d")
+        pixels.frombytes(self.data[start:start + (x1 - x0) * 32])
+        return pixels, -x0 * 4
+
+    def spans(self, y, x0=0, x1=None):
+        """Returns the runs of opaque and translucent pixels in the given part of a row. See ``Canvas.spans``.
+
+        @return list: A list of ``(start, end, opaque)`` tuples with x coordinates.
+        """
+        x1 = self.width if x1 is None else x1
+        s = y * self.width * 4
+        runs = alpha_runs(self.pixels[s + x0 * 4 + 3:s + x1 * 4:4])
+
+        if x0:
+            runs = [(start + x0, end + x0, opaque) for start, end, opaque in runs]
+
+        return runs
+
+    def to_canvas(self):
+        """Copies the image into a new Canvas.
+
+        @return Canvas: The canvas.
+        """
+        pixels = array("d")
+        pixels.frombytes(self.data)
+        return Canvas(self.width, self.height, RgbaColor(*self.bgcolor), pixels)
+
+    def template(self):
+        """Returns a Canvas that reads its pixels straight from the shared block, to start copies from. Copies share
+        the block until they are first written to, at which point they copy the pixels like any copy-on-write Canvas
+        does. The template itself is read-only: writing to it raises a TypeError.
+
+        @return Canvas: The template.
+        """
+        return Canvas(self.width, self.height, RgbaColor(*self.bgcolor), self.pixels)
+
+
+class RenderJob(object):
+    """RenderJob describes a single image rendered by BatchRenderer: a base image, a list of operations applied to a
+    copy of it and where to write the result.
+
+    Operations are added with ``blend``, ``text`` and ``copy_rect``, which return the job, so they can be chained.
+    Assets are referred to by the names they were added to the BatchRenderer with.
+    """
+
+    def __init__(self, base, output=None):
+        """Creates a new RenderJob object.
+
+        @param str base: The name of the image to start from.
+        @param str output: The path to write the PNG to. If omitted, the PNG is returned as bytes (optional).
+        """
+        self.base = base
+        self.output = output
+        self.operations = []
+
+    def blend(self, image, x=0, y=0, ignore_src_alpha=False):
+        """Blends an image onto the canvas. See ``Canvas.blend``.
+
+        @param str image: The name of the image.
+        @param int x: The X offset to place the image at (optional).
+        @param int y: The Y offset to place the image at (optional).
+        @param bool ignore_src_alpha: Whether the image's alpha values should be ignored (optional).
+        @return RenderJob: This job.
+        """
+        self.operations.append(("blend", image, x, y, ignore_src_alpha))
+        return self
+
+    def text(self, font, x, y, text):
+        """Writes a string of text onto the canvas. See ``Font.write``.
+
+        @param str font: The name of the font.
+        @param int x: The x coordinate of where to write the text.
+        @param int y: The y coordinate of where to write the text.
+        @param str text: The text to write.
+        @return RenderJob: This job.
+        """
+        self.operations.append(("text", font, x, y, text))
+        return self
+
+    def copy_rect(self, x, y, width, height, dest_x, dest_y):
+        """Blends a rectangle of the canvas, as it is at this point, onto another position of the canvas.
+
+        @param int x: The x coordinate of the rectangle's top left corner.
+        @param int y: The y coordinate of the rectangle's top left corner.
+        @param int width: The width of the rectangle.
+        @param int height: The height of the rectangle.
+        @param int dest_x: The X offset to place the rectangle at.
+        @param int dest_y: The Y offset to place the rectangle at.
+        @return RenderJob: This job.
+        """
+        self.operations.append(("copy_rect", x, y, width, height, dest_x, dest_y))
+        return self
+
+
+def attach_assets(images, fonts, preset):
+    """Initializes a worker process: attaches the shared images and builds the fonts from the shared glyphs. Glyphs
+    are bands of their font's shared block, so laying out text reads them from there instead of from a private copy.
+
+    @param dict images: Maps image names to ``(memory name, width, height, bgcolor)``.
+    @param dict fonts: Maps font names to ``(memory name, characters, char width, char height, cache size, cache
+                       bytes)``.
+    @param preset: The compression preset, see PngWriter.
+    @type preset: str or CompressionPreset or None
+    """
+    worker_assets["images"] = {name: SharedImage(*spec) for name, spec in images.items()}
+    worker_assets["fonts"] = {}
+    worker_assets["bases"] = {}
+    worker_assets["preset"] = preset
+
+    for name, (memory_name, characters, char_width, char_height, cache_size, cache_bytes) in fonts.items():
+        shared = SharedImage(memory_name, char_width, char_height * len(characters), (0, 0, 0, 0))
+        font = Font(cache_size, cache_bytes)
+        font.load_glyphs({c: shared.band(i * char_height, char_height) for i, c in enumerate(characters)},
+                         char_width, char_height)
+        worker_assets["fonts"][name] = font
+
+
+def base_canvas(name):
+    """Returns the worker's template canvas for a base image. Templates read their pixels from the shared block, see
+    ``SharedImage.template``, so a worker holds no copy of a base image beyond those of the jobs it is rendering.
+    They are exported once when they are created, the same way the jobs export them, so the copies made for every job
+    only convert, analyze and filter the rows their operations change, as long as the job's output keeps the
+    template's color type.
+
+    @param str name: The name of the image.
+    @return Canvas: The template. It must not be modified.
+    """
+    bases = worker_assets["bases"]
+
+    if name not in bases:
+        template = worker_assets["images"][name].template()
+        template.write_png(BytesIO(), worker_assets["preset"])
+        bases[name] = template
+
+    return bases[name]
+
+
+def render_job(job):
+    """Renders a single job in a worker process.
+
+    @param RenderJob job: The job.
+    @return: The output path of the job, or the PNG as bytes if the job has none.
+    @rtype: str or bytes
+    """
+    images, fonts = worker_assets["images"], worker_assets["fonts"]
+    canvas = base_canvas(job.base).copy()
+
+    for operation in job.operations:
+        kind = operation[0]
+
+        if kind == "blend":
+            _, image, x, y, ignore_src_alpha = operation
+            canvas.blend(images[image], x, y, ignore_src_alpha)
+        elif kind == "text":
+            _, font, x, y, text = operation
+            fonts[font].write(canvas, x, y, text)
+        else:
+            _, x, y, width, height, dest_x, dest_y = operation
+            canvas.blend(canvas.rect(x, y, width, height), dest_x, dest_y)
+
+    if job.output is None:
+        stream = BytesIO()
+        canvas.write_png(stream, worker_assets["preset"])
+        return stream.getvalue()
+
+    canvas.to_png(job.output, worker_assets["preset"])
+    return job.output
+
+
+class BatchRenderer(object):
+    """BatchRenderer renders many images built from the same assets on a pool of worker processes.
+
+    Images and fonts are added once; their decoded pixels are placed in shared memory, which every worker attaches to
+    instead of loading or receiving its own copy. Jobs only carry asset names, offsets and text, so handing them to
+    the workers is cheap. Font glyphs and overlays are read from the shared blocks. Each worker exports every base
+    image once and starts each job from a copy-on-write copy of it that reads the shared block, so a job only copies
+    the base image's pixels once it changes them, and only the rows it changes are converted and filtered again.
+
+    Shared memory is released by ``close``, so use BatchRenderer as a context manager::
+
+        with BatchRenderer() as renderer:
+            renderer.add_image("background", background)
+            renderer.add_font("font", font)
+            renderer.render([RenderJob("background", "out/1.png").text("font", 8, 8, "Hello")])
+    """
+
+    def __init__(self, workers=None, preset=None):
+        """Creates a new BatchRenderer object.
+
+        @param int workers: The number of worker processes. Defaults to the number of CPUs (optional).
+        @param preset: The compression preset used for all outputs, see PngWriter (optional).
+        @type preset: str or CompressionPreset or None
+        """
+        if workers is not None and workers < 1:
+            raise ValueError("workers must be positive and non-zero.")
+
+        self.workers = workers or os.cpu_count() or 1
+        self.preset = preset
+        self.images = {}
+        self.fonts = {}
+        self.memory = []
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def share(self, pixels):
+        """Copies pixels into a new shared memory block.
+
+        @param array pixels: The pixels, as an ``array("d")``.
+        @return str: The name of the block.
+        """
+        data = memoryview(pixels).cast("B")
+        memory = SharedMemory(create=True, size=max(1, len(data)))
+        memory.buf[:len(data)] = data
+        self.memory.append(memory)
+        return memory.name
+
+    def add_image(self, name, image):
+        """Adds an image that jobs can use as their base or blend onto their canvas.
+
+        @param str name: The name jobs refer to the image by.
+        @param Canvas image: The image. Later changes to it are not seen by the jobs.
+        """
+        self.images[name] = (self.share(image.pixels), image.width, image.height, tuple(image.bgcolor))
+        self.restart()
+
+    def add_font(self, name, font):
+        """Adds a loaded font that jobs can write text with.
+
+        @param str name: The name jobs refer to the font by.
+        @param Font font: The font.
+        """
+        if not font.charmap:
+            raise ValueError("The font does not contain any characters.")
+
+        pixels = array("d")
+        for glyph in font.charmap.values():
+            for y in range(font.char_height):
+                row, s = glyph.row_pixels(y)
+                pixels.extend(row[s:s + font.char_width * 4])
+
+        self.fonts[name] = (self.share(pixels), "".join(font.charmap), font.char_width, font.char_height,
+                            font.cache_size, font.cache_bytes)
+        self.restart()
+
+    def restart(self):
+        """Shuts down the worker processes, so the next call to ``render`` starts new ones that see all assets."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def render(self, jobs, chunksize=None):
+        """Renders a list of jobs on the worker processes.
+
+        @param list jobs: The RenderJob objects.
+        @param int chunksize: The number of jobs handed to a worker at once. Defaults to a quarter of each worker's
+                              share (optional).
+        @return list: The results of the jobs in the order of ``jobs``: the output path of each job, or the PNG as
+                      bytes for jobs without one.
+        """
+        jobs = list(jobs)
+
+        for job in jobs:
+            if job.base not in self.images:
+                raise ValueError("Unknown image %r." % job.base)
+
+            for operation in job.operations:
+                if operation[0] == "blend" and operation[1] not in self.images:
+                    raise ValueError("Unknown image %r." % operation[1])
+                if operation[0] == "text" and operation[1] not in self.fonts:
+                    raise ValueError("Unknown font %r." % operation[1])
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers, initializer=attach_assets,
+                                                initargs=(self.images, self.fonts, self.preset))
+
+        if chunksize is None:
+            chunksize = max(1, len(jobs) // (self.workers * 4))
+
+        return list(self.executor.map(render_job, jobs, chunksize=chunksize))
+
+    def close(self):
+        """Shuts down the worker processes and releases the shared memory."""
+        self.restart()
+
+        for memory in self.memory:
+            memory.close()
+            memory.unlink()
+
+        self.memory = []
+        self.images = {}
+        self.fonts = {}
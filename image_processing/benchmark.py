@@ -0,0 +1,326 @@
+"""Benchmarks for the hot paths of image_processing, using the standard library only.
+
+Every operation is timed on square images of several sizes; the best of a few repetitions is reported, along with
+the peak memory allocated while running it once, as measured by ``tracemalloc``. Results can be saved as JSON and
+compared against a previously saved baseline, in which case the exit status tells whether anything regressed. To keep
+the comparison from flagging noise, increases below ``MIN_DELTAS`` do not count::
+
+    python -m image_processing.benchmark --output baseline.json
+    python -m image_processing.benchmark --baseline baseline.json --threshold 0.2 --min-seconds 0.002
+
+The images are generated, so no input files are needed. Pure-Python image processing is slow on large images: the
+4096 x 4096 size is not run by default and takes minutes and gigabytes of memory per operation.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+from image_processing import filters
+from image_processing.canvas import Canvas, RgbaColor
+from image_processing.font import Font
+
+
+SIZES = (64, 256, 1024, 4096)
+DEFAULT_SIZES = (64, 256, 1024)
+
+FILTER_NAMES = ("none", "sub", "up", "average", "paeth")
+OPERATIONS = ("load", "blend", "fill", "blit", "rect", "copy", "resize", "thumbnail", "bytes", "text") \
+    + tuple("filter_" + name for name in FILTER_NAMES) + ("to_png",)
+
+# The metrics saved per result and compared against the baseline.
+METRICS = ("seconds", "peak_bytes")
+
+# The smallest absolute increase of each metric that counts as a regression. Timings of fast operations vary by more
+# than any sensible threshold from run to run, so without these the comparison would be flaky.
+MIN_DELTAS = {"seconds": 0.002, "peak_bytes": 4096}
+
+
+def image_data(size, channels, seed=0):
+    """Generates the raw data of a test image: horizontal gradients with some noise, which is neither trivial to
+    compress nor pure noise.
+
+    @param int size: The width and height of the image.
+    @param int channels: 3 for RGB data, 4 for RGBA data.
+    @param int seed: The seed of the noise (optional).
+    @return bytes: ``size * size * channels`` bytes.
+    """
+    rng = random.Random(seed)
+    noise = [bytes((v + rng.randrange(-4, 5)) & 255 for v in range(256)) for _ in range(16)]
+
+    stride = size * channels
+    ramp = bytes(i // channels & 255 for i in range(stride + 256 * channels))
+    return b"".join(ramp[(y & 255) * channels:(y & 255) * channels + stride].translate(noise[y & 15])
+                    for y in range(size))
+
+
+def test_font(char_width=8, char_height=16, characters="abcdefghijklmnopqrstuvwxyz0123456789 "):
+    """Builds a font with generated glyphs holding opaque, translucent and transparent pixels.
+
+    @return Font: The font. Its text run cache is disabled, so every write lays out its text again.
+    """
+    font = Font(cache_size=0)
+    glyphs = {}
+
+    for i, c in enumerate(characters):
+        glyph = Canvas(char_width, char_height, RgbaColor(0, 0, 0, 0))
+
+        if c != " ":
+            glyph.import_rgba_data(image_data(char_height, 4, i)[:char_width * char_height * 4])
+
+        glyphs[c] = glyph
+
+    font.load_glyphs(glyphs, char_width, char_height)
+    return font
+
+
+class Benchmark(object):
+    """The fixtures for benchmarking the operations at one image size."""
+
+    def __init__(self, size, directory):
+        """Creates the test images.
+
+        @param int size: The width and height of the images.
+        @param str directory: A directory for the files written and read by the benchmarks.
+        """
+        self.size = size
+        self.rgb_path = os.path.join(directory, "image-%d.data" % size)
+        self.png_path = os.path.join(directory, "image-%d.png" % size)
+
+        with open(self.rgb_path, "wb") as f:
+            f.write(image_data(size, 3))
+
+        self.canvas = Canvas(size, size, RgbaColor(0, 0, 0, 1))
+        self.canvas.load_rgb_data(self.rgb_path)
+
+        half = max(1, size // 2)
+        self.overlay = Canvas(half, half, RgbaColor(0, 0, 0, 0))
+        self.overlay.import_rgba_data(image_data(half, 4, 1))
+
+        self.font = test_font()
+        line = ("the quick brown fox 0123456789 " * (size // 256 + 1))[:size // self.font.char_width]
+        self.text = "\n".join([line] * (size // (self.font.char_height + 2)))
+
+        self.rows = list(self.canvas.rows())
+
+    def setup(self, operation):
+        """Prepares a run of an operation, outside of the measured time.
+
+        @param str operation: The operation.
+        @return: A function running the operation once.
+        """
+        canvas = self.canvas
+
+        if operation == "load":
+            target = Canvas(self.size, self.size, RgbaColor(0, 0, 0, 1))
+            return lambda: target.load_rgb_data(self.rgb_path)
+        if operation == "blend":
+            target = self.target()
+            return lambda: target.blend(self.overlay, self.size // 4, self.size // 4)
+        if operation == "fill":
+            target = self.target()
+            return lambda: target.fill_rect(self.size // 4, self.size // 4, self.size // 2, self.size // 2,
+                                            RgbaColor(0.2, 0.4, 0.6, 1))
+        if operation == "blit":
+            target = self.target()
+            return lambda: target.blit(self.overlay, self.size // 4, self.size // 4)
+        if operation == "rect":
+            return lambda: canvas.rect(self.size // 4, self.size // 4, self.size // 2, self.size // 2)
+        if operation == "copy":
+            # Copies share their pixels until written to, so the first write is where the copying happens.
+            return lambda: canvas.copy().set(0, 0, RgbaColor(1, 1, 1, 1))
+        if operation == "resize":
+            return lambda: canvas.resize(self.size * 3 // 4, self.size * 3 // 4)
+        if operation == "thumbnail":
+            return lambda: canvas.resize(max(1, self.size // 8), max(1, self.size // 8), "box")
+        if operation == "bytes":
+            # Drop the cached scanlines, so the conversion is measured.
+            canvas.mark_dirty()
+            return canvas.bytes
+        if operation == "text":
+            target = self.target()
+            return lambda: self.font.write(target, 0, 0, self.text)
+        if operation.startswith("filter_"):
+            return lambda: self.filter_rows(FILTER_NAMES.index(operation[7:]))
+        if operation == "to_png":
+            canvas.mark_dirty()
+            return lambda: canvas.to_png(self.png_path)
+
+        raise ValueError("Unknown operation %r." % operation)
+
+    def target(self):
+        """Returns a copy of the test image to draw on. Its pixels are copied here rather than by the first write, so
+        the copy is not part of the measured time.
+
+        @return Canvas: The copy.
+        """
+        target = self.canvas.copy()
+        target.detach()
+        return target
+
+    def filter_rows(self, filter_type):
+        """Filters all scanlines of the test image with one filter, one scanline at a time.
+
+        @param int filter_type: The filter.
+        """
+        previous = None
+
+        for line in self.rows:
+            filters.filter_scanline(line, previous, 3, filter_type)
+            previous = line
+
+    def run(self, operation, repeat):
+        """Measures an operation.
+
+        @param str operation: The operation.
+        @param int repeat: The number of timed runs. The fastest one is reported.
+        @return dict: The metrics: ``seconds`` and ``peak_bytes``.
+        """
+        timings = []
+
+        for _ in range(repeat):
+            function = self.setup(operation)
+            start = perf_counter()
+            function()
+            timings.append(perf_counter() - start)
+
+        # tracemalloc slows allocations down, so memory is measured in a separate, untimed run.
+        function = self.setup(operation)
+        tracemalloc.start()
+        try:
+            current = tracemalloc.get_traced_memory()[0]
+            function()
+            peak = tracemalloc.get_traced_memory()[1] - current
+        finally:
+            tracemalloc.stop()
+
+        return {"seconds": min(timings), "peak_bytes": peak}
+
+
+def run(sizes=DEFAULT_SIZES, operations=OPERATIONS, repeat=3, report=None):
+    """Runs the benchmarks.
+
+    @param tuple sizes: The image sizes (optional).
+    @param tuple operations: The operations (optional).
+    @param int repeat: The number of timed runs per measurement (optional).
+    @param report: A function called with the name and metrics of each result as soon as it is measured (optional).
+    @type report: callable or None
+    @return dict: The results, ready to be saved as JSON.
+    """
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            benchmark = Benchmark(size, directory)
+
+            for operation in operations:
+                name = "%s@%d" % (operation, size)
+                results[name] = benchmark.run(operation, repeat)
+
+                if report is not None:
+                    report(name, results[name])
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "filter_backend": filters.backend,
+        "results": results,
+    }
+
+
+def compare(results, baseline, threshold, min_deltas=MIN_DELTAS):
+    """Compares results against a baseline. A metric regressed if it increased by more than ``threshold`` and by
+    more than its minimum delta.
+
+    @param dict results: The results, as returned by ``run``.
+    @param dict baseline: Earlier results, as returned by ``run``.
+    @param float threshold: The relative increase of a metric that counts as a regression, e.g. 0.2 for 20%.
+    @param dict min_deltas: Maps metrics to the smallest absolute increase that counts as a regression. Metrics
+                            missing in it have none (optional).
+    @return list: A ``(name, metric, baseline value, value)`` tuple for every regressed metric. Results missing in
+                  either set are not compared.
+    """
+    regressions = []
+
+    for name, metrics in sorted(results["results"].items()):
+        previous = baseline["results"].get(name)
+
+        if previous is None:
+            continue
+
+        for metric in METRICS:
+            if metric not in previous:
+                continue
+
+            before, after = previous[metric], metrics[metric]
+            if after > before * (1 + threshold) and after - before > min_deltas.get(metric, 0):
+                regressions.append((name, metric, before, after))
+
+    return regressions
+
+
+def main(args=None):
+    """Runs the benchmarks from the command line.
+
+    @param list args: The command line arguments. Defaults to ``sys.argv[1:]`` (optional).
+    @return int: The exit status: 1 if a metric regressed against the baseline, 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(prog="python -m image_processing.benchmark",
+                                     description="Benchmarks the hot paths of image_processing.")
+    parser.add_argument("--sizes", type=int, nargs="+", choices=SIZES, default=DEFAULT_SIZES, metavar="SIZE",
+                        help="image sizes to run, out of %s (default: %s)" % (
+                            ", ".join(map(str, SIZES)), " ".join(map(str, DEFAULT_SIZES))))
+    parser.add_argument("--ops", nargs="+", choices=OPERATIONS, default=OPERATIONS, metavar="OP",
+                        help="operations to run, out of %s (default: all)" % ", ".join(OPERATIONS))
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per measurement (default: 3)")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results against this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative increase that counts as a regression (default: 0.2)")
+    parser.add_argument("--min-seconds", type=float, default=MIN_DELTAS["seconds"],
+                        help="smallest increase in seconds that counts as a regression (default: %g)"
+                             % MIN_DELTAS["seconds"])
+    options = parser.parse_args(args)
+
+    if options.repeat < 1:
+        parser.error("--repeat must be positive and non-zero")
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+    def report(name, metrics):
+        print("%-20s %10.4f s %12.1f KiB" % (name, metrics["seconds"], metrics["peak_bytes"] / 1024))
+        sys.stdout.flush()
+
+    results = run(options.sizes, options.ops, options.repeat, report)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if baseline is None:
+        return 0
+
+    regressions = compare(results, baseline, options.threshold, dict(MIN_DELTAS, seconds=options.min_seconds))
+
+    for name, metric, previous, value in regressions:
+        # Any increase over a baseline of 0 is a regression, but not a relative one.
+        change = "%+.1f%%" % ((value / previous - 1) * 100) if previous else "n/a"
+        print("REGRESSION %s %s: %g -> %g (%s)" % (name, metric, previous, value, change))
+
+    if regressions:
+        return 1
+
+    print("No regressions beyond %.0f%%." % (options.threshold * 100))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
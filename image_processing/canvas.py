@@ -1,13 +1,27 @@
-from struct import pack, unpack_from
-from copy import copy
+import warnings
+from array import array
+from collections import namedtuple
+from itertools import repeat
 from math import floor
+from operator import add, mul, sub
+from time import perf_counter
 
-from image_processing.png_writer import PngWriter
+from image_processing import instrumentation, resample
+from image_processing.png_writer import PngWriter, analyze_row
+
+
+# Maps a byte to the float value Canvas uses for it.
+UNIT = [i / 255 for i in range(256)]
+
+# The number of color type and filter combinations a canvas keeps filtered scanlines for.
+FILTER_CACHE_SIZE = 4
 
 
 class RgbaColor(object):
     """RgbaColor represents RGBA colors using float values from 0 to 1 inclusive."""
 
+    __slots__ = ("r", "g", "b", "a")
+
     def __init__(self, r, g, b, a):
         if r < 0. or r > 1.:
             raise ValueError("r must be within the range 0 to 1 inclusive.")
@@ -23,29 +37,276 @@ class RgbaColor(object):
         self.b = float(b)
         self.a = float(a)
 
+    def __iter__(self):
+        return iter((self.r, self.g, self.b, self.a))
+
+
+class Pixel(namedtuple("Pixel", ("r", "g", "b", "a"))):
+    """Pixel is the color of a single pixel as returned by ``Canvas.at``. It is an immutable snapshot, so assigning to
+    its channels raises an AttributeError; use ``Canvas.set`` to change a pixel. It can be passed wherever an
+    RgbaColor is expected.
+    """
+
+    __slots__ = ()
+
+
+def decode_pixels(data, channels):
+    """Converts 8-bit pixel data into the float representation used by ``Canvas.pixels``.
+
+    @param bytes data: The pixel data.
+    @param int channels: The number of bytes per pixel: 1 for grayscale, 2 for grayscale with alpha, 3 for RGB and 4
+                         for RGBA.
+    @return array: An ``array("d")`` holding four floats per pixel.
+    """
+    count = len(data) // channels
+    lookup = UNIT.__getitem__
+    # Start out opaque, so images without alpha channel are done after setting the colors.
+    pixels = array("d", [1.0]) * (count * 4)
+
+    if channels <= 2:
+        gray = array("d", map(lookup, data[0::channels]))
+        pixels[0::4] = gray
+        pixels[1::4] = gray
+        pixels[2::4] = gray
+    else:
+        pixels[0::4] = array("d", map(lookup, data[0::channels]))
+        pixels[1::4] = array("d", map(lookup, data[1::channels]))
+        pixels[2::4] = array("d", map(lookup, data[2::channels]))
+
+    if channels in (2, 4):
+        pixels[3::4] = array("d", map(lookup, data[channels - 1::channels]))
+
+    return pixels
+
+
+def flatten_pixels(pixels, start, end, bgcolor):
+    """Converts pixels to 24-bit RGB, blending translucent pixels with the background color.
+
+    Pixels with an alpha value of at least 0.999 count as opaque and are converted as they are. The others are blended
+    as ``floor((c * a + bg * (1 - a)) * 255)``. Every channel is converted in one pass of C-level ``map`` calls over
+    a strided slice, performing exactly these float operations, so the result is the same as converting pixel by pixel.
+
+    @param array pixels: An ``array("d")`` in the layout of ``Canvas.pixels``.
+    @param int start: The index of the first float to convert, which must be the red value of a pixel.
+    @param int end: The index after the last float to convert.
+    @param RgbaColor bgcolor: The background color.
+    @return bytes: The RGB data, three bytes per pixel.
+    """
+    alphas = pixels[start + 3:end:4]
+
+    if not alphas:
+        return b""
+
+    data = bytearray(len(alphas) * 3)
+    scale = repeat(255.)
+
+    # Opaque fast path: scale and floor each channel.
+    if min(alphas) >= 0.999:
+        data[0::3] = bytes(map(floor, map(mul, pixels[start:end:4], scale)))
+        data[1::3] = bytes(map(floor, map(mul, pixels[start + 1:end:4], scale)))
+        data[2::3] = bytes(map(floor, map(mul, pixels[start + 2:end:4], scale)))
+        return bytes(data)
+
+    # Alphas above 1, e.g. from rounding errors while blending, count as opaque. Blending with an alpha of exactly 1
+    # yields the unblended value, while larger ones would push the result out of the byte range.
+    if max(alphas) > 1.:
+        alphas = array("d", map(min, alphas, repeat(1.)))
+
+    inverse = array("d", map(sub, repeat(1), alphas))
+
+    for c, bg in enumerate(tuple(bgcolor)[:3]):
+        blended = map(add, map(mul, pixels[start + c:end:4], alphas), map(mul, repeat(bg), inverse))
+        data[c::3] = bytes(map(floor, map(mul, blended, scale)))
+
+    # For an alpha of exactly 1 the blend formula yields the unblended value, but pixels with an alpha between 0.999
+    # and 1 must not be blended either.
+    if any(0.999 <= a < 1. for a in set(alphas)):
+        for i, a in enumerate(alphas):
+            if 0.999 <= a < 1.:
+                p = start + i * 4
+                data[i * 3:i * 3 + 3] = bytes(map(floor, map(mul, pixels[p:p + 3], scale)))
+
+    return bytes(data)
+
+
+def alpha_runs(alphas):
+    """Splits a row of alpha values into runs of opaque and translucent pixels. Fully transparent pixels are left out,
+    as blending them does not change the target.
+
+    @param array alphas: The alpha values of consecutive pixels.
+    @return list: A list of ``(start, end, opaque)`` tuples, where ``start`` and ``end`` are pixel offsets into
+                  ``alphas`` (``end`` being exclusive) and ``opaque`` tells whether the run can simply be copied.
+    """
+    if not alphas:
+        return []
+
+    # Fast paths for rows that are uniformly opaque or transparent.
+    if min(alphas) >= 0.999999:
+        return [(0, len(alphas), True)]
+    if max(alphas) <= 0.:
+        return []
+
+    runs = []
+    start, kind = 0, None
+
+    for i, a in enumerate(alphas):
+        current = None if a <= 0. else a >= 0.999999
+
+        if current is not kind:
+            if kind is not None:
+                runs.append((start, i, kind))
+            start, kind = i, current
+
+    if kind is not None:
+        runs.append((start, len(alphas), kind))
+
+    return runs
+
+
+def blend_run(dst_pixels, d, src_pixels, s, count):
+    """Blends ``count`` consecutive source pixels onto the destination using the "over" operator.
+
+    @param array dst_pixels: The destination pixel array.
+    @param int d: The index of the first destination float.
+    @param array src_pixels: The source pixel array.
+    @param int s: The index of the first source float.
+    @param int count: The number of pixels to blend.
+    """
+    n = count * 4
+    blended = []
+
+    for src_r, src_g, src_b, src_a, dst_r, dst_g, dst_b, dst_a in zip(
+            src_pixels[s:s + n:4], src_pixels[s + 1:s + n:4], src_pixels[s + 2:s + n:4], src_pixels[s + 3:s + n:4],
+            dst_pixels[d:d + n:4], dst_pixels[d + 1:d + n:4], dst_pixels[d + 2:d + n:4], dst_pixels[d + 3:d + n:4]):
+        new_alpha = src_a + dst_a * (1 - src_a)
+
+        if new_alpha < 0.000001:
+            blended += (0., 0., 0., 0.)
+        else:
+            blended += ((src_r * src_a + dst_r * dst_a * (1 - src_a)) / new_alpha,
+                        (src_g * src_a + dst_g * dst_a * (1 - src_a)) / new_alpha,
+                        (src_b * src_a + dst_b * dst_a * (1 - src_a)) / new_alpha,
+                        new_alpha)
+
+    dst_pixels[d:d + n] = array("d", blended)
+
 
 class Canvas(object):
-    """Canvas is a class that represents a 32-bit RGBA image that can be manipulated and drawn upon."""
+    """Canvas is a class that represents a 32-bit RGBA image that can be manipulated and drawn upon.
+
+    Pixels are stored in ``pixels``, a flat ``array("d")`` holding four floats (r, g, b, a) per pixel in row-major
+    order. Pixel ``i`` occupies the items ``4 * i`` to ``4 * i + 3``.
+
+    The canvas keeps track of which rows its methods change, so exporting it again after a small edit only converts
+    and filters the rows that changed. Copies share their pixels until one of them is written to. Code that writes to
+    ``pixels`` directly must call ``detach`` before and ``mark_dirty`` afterwards.
+    """
+
+    def __init__(self, width, height, bgcolor, pixels=None):
+        """Creates a new Canvas object.
+
+        @param int width: The width of the canvas.
+        @param int height: The height of the canvas.
+        @param RgbaColor bgcolor: The background color.
+        @param array pixels: The pixels, as an ``array("d")`` in the layout of ``pixels``, which the canvas takes
+                             over. If omitted, the canvas is filled with the background color (optional).
+        """
+        if pixels is not None and len(pixels) != width * height * 4:
+            raise ValueError("Passed pixels do not fit a %d x %d canvas." % (width, height))
 
-    def __init__(self, width, height, bgcolor):
         self.width = width
         self.height = height
         self.bgcolor = bgcolor
-        self.canvas = []
-        self.clear()
+        self.pixels = array("d") if pixels is None else pixels
+
+        # Every row carries the generation in which it was last changed. The export caches remember the generations
+        # they were computed for: row_cache maps rows to their RGB bytes and rgba_row_cache to their RGBA bytes,
+        # analysis_cache maps a number of channels to the rows' analyses for PngWriter.choose_color_type, and
+        # filter_cache maps a writer's filter_key to the filtered scanlines, which also depend on the row above.
+        self.generation = 0
+        self.row_versions = array("Q", bytes(8 * height))
+        self.row_cache = [None] * height
+        self.row_cache_bgcolor = None
+        self.rgba_row_cache = [None] * height
+        self.analysis_cache = {}
+        self.filter_cache = {}
+
+        # While the pixels are shared with copies, this is a [count, pixels] list shared by all of them.
+        self.pixel_owners = None
+
+        if pixels is None:
+            self.clear()
+
+    @property
+    def canvas(self):
+        """The pixels as a list of colors, one per pixel in row-major order. Deprecated: this is a snapshot built on
+        every access, so changing its colors does not change the canvas. Use ``at``, ``set`` or ``pixels`` instead.
+        """
+        warnings.warn("Canvas.canvas is deprecated; use Canvas.at, Canvas.set or Canvas.pixels.", DeprecationWarning,
+                      stacklevel=2)
+        pixels = self.pixels
+        return [Pixel(*pixels[i:i + 4]) for i in range(0, len(pixels), 4)]
 
     def clear(self):
         """Clears the canvas, filling it with the background color."""
-        self.canvas = [copy(self.bgcolor) for _ in range(self.width * self.height)]
+        self.pixels = array("d", self.bgcolor) * (self.width * self.height)
+        self.detach()
+        self.mark_dirty()
 
     def copy(self):
-        """Creates a copy of this canvas.
+        """Creates a copy of this canvas. The copy is copy-on-write: it shares the pixels of this canvas until either
+        of them is written to, so copies of a large template are cheap to make. It also shares the export caches of
+        this canvas for the rows that have not changed, so exporting an edited copy of a template is incremental too.
+
+        Sharing is tracked by counting owners, and a copy that is garbage collected without being written to still
+        counts. The only cost is that the next write to one of the remaining canvases copies the pixels once more,
+        after which it owns them.
+
         @return Canvas: A copy of this canvas.
         """
-        c = type(self)(self.width, self.height, self.bgcolor)
-        c.canvas = [copy(color) for color in self.canvas]
+        if self.pixel_owners is None:
+            self.pixel_owners = [1, self.pixels]
+        self.pixel_owners[0] += 1
+
+        # Bypass __init__, which would allocate and fill new pixels.
+        c = object.__new__(type(self))
+        c.__dict__.update(self.__dict__)
+        c.generation = self.generation
+        c.row_versions = array("Q", self.row_versions)
+        c.row_cache = list(self.row_cache)
+        c.row_cache_bgcolor = self.row_cache_bgcolor
+        c.rgba_row_cache = list(self.rgba_row_cache)
+        c.analysis_cache = {key: list(cache) for key, cache in self.analysis_cache.items()}
+        c.filter_cache = {key: list(cache) for key, cache in self.filter_cache.items()}
         return c
 
+    def detach(self):
+        """Stops sharing the pixels with copies of this canvas, copying them if another canvas still uses them. Every
+        method that changes pixels calls this first.
+        """
+        owners = self.pixel_owners
+
+        if owners is not None:
+            self.pixel_owners = None
+            owners[0] -= 1
+
+            # The last owner keeps the pixels, as do canvases whose pixels have been replaced in the meantime.
+            if owners[0] and owners[1] is self.pixels:
+                self.pixels = array("d", self.pixels)
+
+    def mark_dirty(self, y0=0, y1=None):
+        """Marks a range of rows as changed, so they are converted and filtered again on the next export.
+
+        @param int y0: The first changed row (optional).
+        @param int y1: The row after the last changed row. Defaults to the height of the canvas (optional).
+        """
+        y0 = max(0, y0)
+        y1 = self.height if y1 is None else min(y1, self.height)
+
+        if y0 < y1:
+            self.generation += 1
+            self.row_versions[y0:y1] = array("Q", [self.generation]) * (y1 - y0)
+
     def coordinate_to_index(self, x, y):
         """Returns the index for the given coordinates.
         @param int x: The x coordinate.
@@ -59,21 +320,40 @@ class Canvas(object):
         return x + self.width * y
 
     def at(self, x, y):
-        """Returns the index for the given coordinates.
+        """Returns the color at the given coordinates.
+
+        The returned color is an immutable snapshot. Use ``set`` to change the pixel.
+
         @param int x: The x coordinate.
         @param int y: The y coordinate.
-        @return RgbaColor: The color.
+        @return Pixel: The color.
         """
-        return self.canvas[self.coordinate_to_index(x, y)]
+        i = self.coordinate_to_index(x, y) * 4
+        return Pixel(*self.pixels[i:i + 4])
 
-    def rect(self, x, y, width, height):
-        """Returns a new Canvas that contains a copy of the pixels in the given rectangle.
+    def set(self, x, y, color):
+        """Sets the color at the given coordinates.
+
+        @param int x: The x coordinate.
+        @param int y: The y coordinate.
+        @param RgbaColor color: The new color.
+        """
+        i = self.coordinate_to_index(x, y) * 4
+        self.detach()
+        self.pixels[i:i + 4] = array("d", color)
+        self.mark_dirty(y, y + 1)
+
+    def rect(self, x, y, width, height, view=False):
+        """Returns a new Canvas that contains a copy of the pixels in the given rectangle, or a CanvasView of them.
 
         @param int x: The x coordinate of the rectangle's top left corner.
         @param int y: The y coordinate of the rectangle's top left corner.
         @param int width: The width of the rectangle, extending to the right from the top left corner.
         @param int height: The height of the rectangle, extending downwards from the top left corner.
-        @return canvas:
+        @param bool view: Whether to return a view that reads the pixels of this canvas instead of copying them. The
+                          view sees later changes to this canvas (optional).
+        @return: The rectangle.
+        @rtype: Canvas or CanvasView
         """
         if x < 0 or x > self.width - 1 \
                 or y < 0 or y > self.height - 1:
@@ -86,53 +366,184 @@ class Canvas(object):
                 or y + height > self.height:
             raise ValueError("The rectangle does not fit into the image.")
 
-        rect = Canvas(width, height, copy(self.bgcolor))
+        if view:
+            return CanvasView(self, x, y, width, height)
+
+        pixels = array("d")
+
+        # Copy whole rows of the rectangle at once.
+        for source_y in range(y, y + height):
+            start = (source_y * self.width + x) * 4
+            pixels.extend(self.pixels[start:start + width * 4])
 
-        for target_y in range(height):
-            for target_x in range(width):
-                color = self.at(x + target_x, y + target_y)
-                target_i = target_y * width + target_x
-                rect.canvas[target_i] = copy(color)
+        return Canvas(width, height, RgbaColor(*self.bgcolor), pixels)
 
-        return rect
+    def resize(self, width, height, filter=resample.BILINEAR, reducing_gap=None):
+        """Returns a resized copy of this canvas. See ``image_processing.resample``.
+
+        @param int width: The new width.
+        @param int height: The new height.
+        @param str filter: The resampling filter: "nearest", "box", "bilinear" or "lanczos". Box downscaling by
+                           integer factors, e.g. powers of two, takes a faster path (optional).
+        @param float reducing_gap: Shrink large reductions by an integer factor first, as long as the image stays
+                                   this many times larger than the target, e.g. 2 for thumbnails. See
+                                   ``resample.resize`` (optional).
+        @return Canvas: The resized canvas.
+        """
+        pixels = resample.resize(self, width, height, filter, reducing_gap)
+        return Canvas(width, height, RgbaColor(*self.bgcolor), pixels)
+
+    def fill_rect(self, x, y, width, height, color):
+        """Paints a rectangle in a solid color, blending it onto the canvas like ``blend`` would. The rectangle is
+        clipped against the canvas.
+
+        Opaque colors are written a whole row at a time with slice assignment, without any per-pixel math. Translucent
+        colors are blended pixel by pixel.
+
+        @param int x: The x coordinate of the rectangle's top left corner.
+        @param int y: The y coordinate of the rectangle's top left corner.
+        @param int width: The width of the rectangle, extending to the right from the top left corner.
+        @param int height: The height of the rectangle, extending downwards from the top left corner.
+        @param RgbaColor color: The color.
+        """
+        if width < 0 or height < 0:
+            raise ValueError("Width and height must be positive.")
+
+        x0, x1 = max(0, x), min(self.width, x + width)
+        y0, y1 = max(0, y), min(self.height, y + height)
+
+        if x0 >= x1 or y0 >= y1 or color.a <= 0.:
+            return
+
+        self.detach()
+        self.mark_dirty(y0, y1)
+
+        pixels = self.pixels
+        size = self.width * 4
+        row = array("d", color) * (x1 - x0)
+
+        if color.a < 0.999999:
+            for d in range(y0 * size + x0 * 4, y1 * size, size):
+                blend_run(pixels, d, row, 0, x1 - x0)
+        else:
+            for d in range(y0 * size + x0 * 4, y1 * size, size):
+                pixels[d:d + len(row)] = row
+
+    def blit(self, src, x=0, y=0):
+        """Copies ``src`` onto this canvas, replacing the pixels it covers including their alpha values. The source
+        is clipped against the canvas and copied a whole row at a time with slice assignment.
+
+        This is the same as ``blend`` with ``ignore_src_alpha``.
+
+        @param Canvas src: The image to copy. Any image providing ``row_pixels`` and ``spans`` works.
+        @param int x: The X offset to place the source image at (optional).
+        @param int y: The Y offset to place the source image at (optional).
+        """
+        self.blend(src, x, y, ignore_src_alpha=True)
 
     def blend(self, src, offset_x=0, offset_y=0, ignore_src_alpha=False):
         """Blends the ``src`` canvas onto this canvas.
 
-        @param Canvas src: The canvas to blend onto this one.
+        The source rectangle is clipped against this canvas once and then processed row by row. Within a row, runs
+        of opaque pixels are copied with a single slice assignment and runs of fully transparent pixels are skipped;
+        only translucent pixels are blended individually.
+
+        @param Canvas src: The canvas to blend onto this one. Any image providing ``row_pixels`` and ``spans`` works.
         @param int offset_x: The X offset to place the source image at.
         @param int offset_y: The Y offset to place the source image at.
         @param bool ignore_src_alpha: Whether blend should ignore the source image's alpha values
                                       and assume it's opaque.
         """
+        # Clip the source rectangle against the target. x0, x1, y0 and y1 are in source coordinates.
+        x0, x1 = max(0, -offset_x), min(src.width, self.width - offset_x)
+        y0, y1 = max(0, -offset_y), min(src.height, self.height - offset_y)
+
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        # A view of this canvas reads the rows being written, which is only safe if they don't overlap.
+        if isinstance(src, CanvasView) and src.canvas is self and src.overlaps(offset_x + x0, offset_y + y0,
+                                                                              x1 - x0, y1 - y0):
+            src = src.copy()
 
-        for i, src_color in enumerate(src.canvas):
-            src_x, src_y = i % src.width, i // src.width
+        self.detach()
+        self.mark_dirty(offset_y + y0, offset_y + y1)
 
-            target_x = offset_x + src_x
-            target_y = offset_y + src_y
+        stats = instrumentation.active()
+        if stats is not None:
+            started = perf_counter()
 
-            # Don't blit pixels that are out of bounds.
-            if target_x < 0 or target_x > self.width - 1 \
-                    or target_y < 0 or target_y > self.height - 1:
+        dst_pixels = self.pixels
+        span = (x1 - x0) * 4
+
+        for src_y in range(y0, y1):
+            # s is the index of the source row's pixel 0; only pixels x0 to x1 of it are accessed.
+            src_pixels, s = src.row_pixels(src_y, x0, x1)
+            d = ((offset_y + src_y) * self.width + offset_x) * 4
+
+            if ignore_src_alpha:
+                dst_pixels[d + x0 * 4:d + x0 * 4 + span] = src_pixels[s + x0 * 4:s + x0 * 4 + span]
                 continue
 
-            dst_color = self.canvas[target_y * self.width + target_x]
+            for start, end, opaque in src.spans(src_y, x0, x1):
+                if opaque:
+                    dst_pixels[d + start * 4:d + end * 4] = src_pixels[s + start * 4:s + end * 4]
+                else:
+                    blend_run(dst_pixels, d + start * 4, src_pixels, s + start * 4, end - start)
+
+        if stats is not None:
+            stats.add_time("blend", perf_counter() - started)
+            self.count_blend(stats, src, x0, x1, y0, y1, ignore_src_alpha)
 
-            if ignore_src_alpha or src_color.a >= 0.999999:
-                dst_color.r = src_color.r
-                dst_color.g = src_color.g
-                dst_color.b = src_color.b
-                dst_color.a = src_color.a
-            else:
-                new_alpha = src_color.a + dst_color.a * (1 - src_color.a)
-                dst_color.r = (src_color.r * src_color.a + dst_color.r * dst_color.a * (1 - src_color.a)) / new_alpha
-                dst_color.g = (src_color.g * src_color.a + dst_color.g * dst_color.a * (1 - src_color.a)) / new_alpha
-                dst_color.b = (src_color.b * src_color.a + dst_color.b * dst_color.a * (1 - src_color.a)) / new_alpha
-                dst_color.a = new_alpha
+    def count_blend(self, stats, src, x0, x1, y0, y1, ignore_src_alpha):
+        """Counts the pixels a blend copied, blended and skipped. This goes over the source's spans once more, so
+        ``blend`` itself does not need to count while instrumentation is disabled.
+        """
+        copied = blended = 0
+
+        if ignore_src_alpha:
+            copied = (x1 - x0) * (y1 - y0)
+        else:
+            for src_y in range(y0, y1):
+                for start, end, opaque in src.spans(src_y, x0, x1):
+                    if opaque:
+                        copied += end - start
+                    else:
+                        blended += end - start
+
+        stats.count("blends")
+        stats.count("blend_pixels_copied", copied)
+        stats.count("blend_pixels_blended", blended)
+        stats.count("blend_pixels_skipped", (x1 - x0) * (y1 - y0) - copied - blended)
+
+    def row_pixels(self, y, x0=0, x1=None):
+        """Gives access to the pixels of a row without copying them. This, together with ``width``, ``height`` and
+        ``spans``, is what ``blend`` needs from its source, so other image types can be blended by providing it.
+
+        @param int y: The y coordinate of the row.
+        @param int x0: The first pixel that will be accessed (optional).
+        @param int x1: The pixel after the last one that will be accessed (optional).
+        @return tuple: ``(pixels, index)``, where ``pixels`` is an ``array("d")`` and ``index`` the position of the
+                       row's pixel 0 in it. Only the pixels from ``x0`` to ``x1`` are guaranteed to be present.
+        """
+        return self.pixels, y * self.width * 4
 
-                if dst_color.a < 0.000001:
-                    dst_color.r, dst_color.g, dst_color.b, dst_color.a = 0, 0, 0, 0
+    def spans(self, y, x0=0, x1=None):
+        """Returns the runs of opaque and translucent pixels in a row, leaving out fully transparent pixels.
+
+        @param int y: The y coordinate of the row.
+        @param int x0: The x coordinate to start at (optional).
+        @param int x1: The x coordinate to stop at, exclusive. Defaults to the width of the canvas (optional).
+        @return list: A list of ``(start, end, opaque)`` tuples with x coordinates, as returned by ``alpha_runs``.
+        """
+        x1 = self.width if x1 is None else x1
+        s = (y * self.width) * 4
+        runs = alpha_runs(self.pixels[s + x0 * 4 + 3:s + x1 * 4:4])
+
+        if x0:
+            runs = [(start + x0, end + x0, opaque) for start, end, opaque in runs]
+
+        return runs
 
     def bytes(self):
         """Returns an 24-bit RGB representation of this canvas as a byte array.
@@ -140,38 +551,186 @@ class Canvas(object):
 
         @return bytes: An 24-bit RGB representation of this canvas.
         """
-        data = bytearray(self.width * self.height * 3)
+        return b"".join(self.rows())
 
-        for i, color in enumerate(self.canvas):
-            if color.a >= 0.999:
-                data[i*3:i*3 + 3] = pack("!3B", floor(color.r * 255), floor(color.g * 255), floor(color.b * 255))
-            else:
-                r = floor((color.r * color.a + self.bgcolor.r * (1 - color.a)) * 255)
-                g = floor((color.g * color.a + self.bgcolor.g * (1 - color.a)) * 255)
-                b = floor((color.b * color.a + self.bgcolor.b * (1 - color.a)) * 255)
-                data[i*3:i*3 + 3] = pack("!3B", r, g, b)
+    def rows(self):
+        """Yields the 24-bit RGB representation of this canvas one scanline at a time, top to bottom.
+        The image gets blended with the background color.
 
-        return bytes(data)
+        @return generator: A generator yielding ``self.height`` bytes objects of ``self.width * 3`` bytes each.
+        """
+        # Converted rows are cached until they change or the background color does.
+        bgcolor = tuple(self.bgcolor)
+        if bgcolor != self.row_cache_bgcolor:
+            self.row_cache = [None] * self.height
+            self.row_cache_bgcolor = bgcolor
+
+        row_cache = self.row_cache
+        stats = instrumentation.active()
+
+        for y, version in enumerate(self.row_versions):
+            entry = row_cache[y]
+
+            if entry is None or entry[0] != version:
+                if stats is None:
+                    entry = row_cache[y] = (version, self.row_bytes(y))
+                else:
+                    started = perf_counter()
+                    entry = row_cache[y] = (version, self.row_bytes(y))
+                    stats.add_time("flatten", perf_counter() - started)
+                    stats.count("rows_flattened")
+                    stats.count("pixels_flattened", self.width)
+            elif stats is not None:
+                stats.count("rows_flatten_cached")
+
+            yield entry[1]
+
+    def filtered_rows(self, writer):
+        """Yields the scanlines of this canvas filtered by the given PngWriter, reusing the filtered scanlines of the
+        previous export for rows that did not change and whose row above did not change either.
+
+        @param PngWriter writer: The writer to filter with. Its ``filter_key`` must not be None. Scanlines are passed
+                                 to it as RGBA if its ``channels`` is 4 and as RGB otherwise.
+        @return generator: A generator yielding ``self.height`` filtered scanlines.
+        """
+        key = writer.filter_key()
+
+        if key not in self.filter_cache:
+            # Every color type and palette needs its own cache; only the most recently added ones are kept.
+            if len(self.filter_cache) >= FILTER_CACHE_SIZE:
+                del self.filter_cache[next(iter(self.filter_cache))]
+            self.filter_cache[key] = [None] * self.height
+
+        cache = self.filter_cache[key]
+        bgcolor = tuple(self.bgcolor)
+        previous_line, previous_converted, previous_version = None, None, None
+        stats = instrumentation.active()
+
+        for y, line in enumerate(self.rgba_rows() if writer.channels == 4 else self.rows()):
+            version = (self.row_versions[y], previous_version, bgcolor)
+            entry = cache[y]
+            converted = None
+
+            if entry is None or entry[0] != version:
+                if stats is not None:
+                    started = perf_counter()
+
+                # Only rows that are filtered again need converting, including the row above them.
+                if previous_line is not None and previous_converted is None:
+                    previous_converted = writer.convert_row(previous_line)
+                converted = writer.convert_row(line)
+                entry = cache[y] = (version, writer.filter_scanline(converted, previous_converted))
+
+                if stats is not None:
+                    stats.add_time("filter", perf_counter() - started)
+                    stats.count("rows_filtered")
+                    stats.record_filters(entry[1][:1])
+            elif stats is not None:
+                stats.count("rows_filter_cached")
+                stats.record_filters(entry[1][:1])
+
+            yield entry[1]
+            previous_line, previous_converted, previous_version = line, converted, self.row_versions[y]
+
+    def rgba_rows(self):
+        """Yields the 32-bit RGBA representation of this canvas one scanline at a time, top to bottom. Unlike ``rows``,
+        this keeps the alpha channel instead of blending with the background color. Converted rows are cached until
+        they change.
+
+        @return generator: A generator yielding ``self.height`` bytes objects of ``self.width * 4`` bytes each.
+        """
+        scale = repeat(255.)
+        size = self.width * 4
+        row_cache = self.rgba_row_cache
+
+        for y, version in enumerate(self.row_versions):
+            entry = row_cache[y]
+
+            if entry is None or entry[0] != version:
+                start = y * size
+                entry = row_cache[y] = (version, bytes(map(floor, map(mul, self.pixels[start:start + size], scale))))
+
+            yield entry[1]
+
+    def row_analyses(self, channels):
+        """Yields the analysis of every scanline for ``PngWriter.choose_color_type``, reusing the analyses of the
+        previous export for rows that did not change.
+
+        @param int channels: 3 to analyze the RGB scanlines, 4 for RGBA.
+        @return generator: A generator yielding ``self.height`` analyses, see ``png_writer.analyze_row``.
+        """
+        if channels not in self.analysis_cache:
+            self.analysis_cache[channels] = [None] * self.height
+
+        cache = self.analysis_cache[channels]
+        bgcolor = tuple(self.bgcolor) if channels == 3 else None
+        stats = instrumentation.active()
+
+        for y, line in enumerate(self.rows() if channels == 3 else self.rgba_rows()):
+            version = (self.row_versions[y], bgcolor)
+            entry = cache[y]
+
+            if entry is None or entry[0] != version:
+                entry = cache[y] = (version, analyze_row(line, channels))
+                if stats is not None:
+                    stats.count("rows_analyzed")
+            elif stats is not None:
+                stats.count("rows_analysis_cached")
+
+            yield entry[1]
+
+    def row_bytes(self, y):
+        """Returns the 24-bit RGB representation of a single scanline, blended with the background color.
+
+        @param int y: The y coordinate of the scanline.
+        @return bytes: The scanline, ``self.width * 3`` bytes long.
+        """
+        start = y * self.width * 4
+        return flatten_pixels(self.pixels, start, start + self.width * 4, self.bgcolor)
 
     def import_rgb_data(self, data):
         """Imports a 24-bit RGB image from raw data.
 
         @param bytes data: The image.
         """
-        for i in range(0, len(data), 3):
-            r, g, b = unpack_from("!3B", data, i)
-            r, g, b = r / 255, g / 255, b / 255
-            self.canvas[i // 3] = RgbaColor(r, g, b, 1.0)
+        if len(data) > self.width * self.height * 3:
+            raise ValueError("Passed data object does not fit into a %d x %d canvas." % (self.width, self.height))
+
+        pixels = decode_pixels(data[:len(data) - len(data) % 3], 3)
+        self.detach()
+        self.pixels[:len(pixels)] = pixels
+        self.mark_dirty()
 
     def import_rgba_data(self, data):
         """Imports a 32-bit RGBA image from raw data.
 
         @param bytes data: The image.
         """
-        for i in range(0, len(data), 4):
-            r, g, b, a = unpack_from("!4B", data, i)
-            r, g, b, a = r / 255, g / 255, b / 255, a / 255
-            self.canvas[i // 4] = RgbaColor(r, g, b, a)
+        if len(data) > self.width * self.height * 4:
+            raise ValueError("Passed data object does not fit into a %d x %d canvas." % (self.width, self.height))
+
+        pixels = decode_pixels(data[:len(data) - len(data) % 4], 4)
+        self.detach()
+        self.pixels[:len(pixels)] = pixels
+        self.mark_dirty()
+
+    def import_row(self, y, data, channels=4):
+        """Imports a single row of 8-bit pixel data.
+
+        @param int y: The y coordinate of the row.
+        @param bytes data: The row, holding ``self.width`` pixels.
+        @param int channels: The number of bytes per pixel: 1 for grayscale, 2 for grayscale with alpha, 3 for RGB and
+                             4 for RGBA (optional).
+        """
+        if y < 0 or y > self.height - 1:
+            raise ValueError("y coordinate out of bounds.")
+        if len(data) != self.width * channels:
+            raise ValueError("Passed row does not contain %d pixels." % self.width)
+
+        start = y * self.width * 4
+        self.detach()
+        self.pixels[start:start + self.width * 4] = decode_pixels(data, channels)
+        self.mark_dirty(y, y + 1)
 
     def load_rgb_data(self, path):
         """Imports a 24-bit RGB image from a file.
@@ -189,11 +748,201 @@ class Canvas(object):
         with open(path, "rb") as f:
             return self.import_rgba_data(f.read())
 
-    def to_png(self, path):
+    def to_png(self, path, preset=None, alpha=False, optimize=True, cache=None):
         """Convenience method to export a PNG file with the Canvas' contents.
 
+        The image is converted and encoded one scanline at a time, so no full-size copy of it is built. Converted,
+        analyzed and filtered scanlines are cached, so exporting again after a small change only redoes the rows that
+        changed.
+
         @param string path: The image path.
+        @param preset: The compression preset: "fastest", "balanced", "smallest" or a CompressionPreset. See
+                       PngWriter (optional).
+        @type preset: str or CompressionPreset or None
+        @param bool alpha: Whether to keep the alpha channel instead of blending the image with the background color
+                           (optional).
+        @param bool optimize: Whether to scan the image first and store it as grayscale or indexed color if that
+                              represents it exactly. See ``PngWriter.optimize`` (optional).
+        @param PngCache cache: A cache to look the PNG up in before encoding it, and to store it in after. See
+                               ``image_processing.png_cache`` (optional).
         """
         with open(path, "wb") as f:
-            w = PngWriter(f, self.width, self.height)
-            w.write_image(self.bytes())
+            self.write_png(f, preset, alpha, optimize, cache)
+
+    def write_png(self, stream, preset=None, alpha=False, optimize=True, cache=None):
+        """Writes the Canvas' contents as a PNG image to a stream. See ``to_png``.
+
+        @param BytesIO stream: The stream to write the PNG to.
+        @param preset: The compression preset, see ``to_png`` (optional).
+        @type preset: str or CompressionPreset or None
+        @param bool alpha: Whether to keep the alpha channel, see ``to_png`` (optional).
+        @param bool optimize: Whether to pick the cheapest color type, see ``to_png`` (optional).
+        @param PngCache cache: A cache for the encoded PNG, see ``to_png`` (optional).
+        """
+        if cache is not None:
+            cache.write_png(self, stream, preset, alpha, optimize)
+            return
+
+        w = PngWriter(stream, self.width, self.height, preset=preset, channels=4 if alpha else 3)
+        rows = self.rgba_rows if alpha else self.rows
+
+        if optimize:
+            w.choose_color_type(self.row_analyses(w.channels))
+
+        if w.filter_key() is None:
+            w.write_image(rows())
+            return
+
+        w.write_signature()
+        w.write_ihdr()
+        w.write_plte()
+        w.write_idat_filtered(self.filtered_rows(w))
+        w.write_iend()
+
+
+class CanvasView(object):
+    """CanvasView is a read-only rectangular region of a Canvas that shares the canvas' pixels instead of copying
+    them. It is made by ``Canvas.rect(..., view=True)``.
+
+    A view is described by its origin in the canvas, its size and the stride of the canvas' rows. It can be blended
+    like a Canvas and exported with ``bytes`` and ``to_png``. Changes to the canvas show through the view; ``copy``
+    turns a view into a Canvas of its own.
+    """
+
+    def __init__(self, canvas, x, y, width, height):
+        """Creates a new CanvasView object. The rectangle must lie within the canvas.
+
+        @param Canvas canvas: The canvas whose pixels the view shares.
+        @param int x: The x coordinate of the view's top left corner in the canvas.
+        @param int y: The y coordinate of the view's top left corner in the canvas.
+        @param int width: The width of the view.
+        @param int height: The height of the view.
+        """
+        self.canvas = canvas
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    @property
+    def bgcolor(self):
+        """The background color of the canvas."""
+        return self.canvas.bgcolor
+
+    @property
+    def stride(self):
+        """The number of floats from one row of the view to the next in the canvas' pixels."""
+        return self.canvas.width * 4
+
+    def overlaps(self, x, y, width, height):
+        """Checks whether the view overlaps a rectangle of the canvas.
+
+        @param int x: The x coordinate of the rectangle's top left corner.
+        @param int y: The y coordinate of the rectangle's top left corner.
+        @param int width: The width of the rectangle.
+        @param int height: The height of the rectangle.
+        @return bool: Whether they have any pixel in common.
+        """
+        return x < self.x + self.width and self.x < x + width and y < self.y + self.height and self.y < y + height
+
+    def at(self, x, y):
+        """Returns the color at the given coordinates of the view. See ``Canvas.at``.
+
+        @param int x: The x coordinate.
+        @param int y: The y coordinate.
+        @return Pixel: The color.
+        """
+        if x < 0 or x > self.width - 1 \
+                or y < 0 or y > self.height - 1:
+            raise ValueError("x or y coordinates out of bounds.")
+
+        return self.canvas.at(self.x + x, self.y + y)
+
+    def row_pixels(self, y, x0=0, x1=None):
+        """Gives access to the pixels of a row without copying them. See ``Canvas.row_pixels``.
+
+        @return tuple: ``(pixels, index)``, where ``index`` is the position of the row's pixel 0 in ``pixels``.
+        """
+        return self.canvas.pixels, (self.y + y) * self.stride + self.x * 4
+
+    def spans(self, y, x0=0, x1=None):
+        """Returns the runs of opaque and translucent pixels in a row. See ``Canvas.spans``.
+
+        @return list: A list of ``(start, end, opaque)`` tuples with x coordinates.
+        """
+        x1 = self.width if x1 is None else x1
+        pixels, s = self.row_pixels(y)
+        runs = alpha_runs(pixels[s + x0 * 4 + 3:s + x1 * 4:4])
+
+        if x0:
+            runs = [(start + x0, end + x0, opaque) for start, end, opaque in runs]
+
+        return runs
+
+    def copy(self):
+        """Copies the pixels of the view into a new Canvas.
+
+        @return Canvas: The canvas.
+        """
+        return self.canvas.rect(self.x, self.y, self.width, self.height)
+
+    def row_bytes(self, y):
+        """Returns the 24-bit RGB representation of a single scanline. See ``Canvas.row_bytes``.
+
+        @param int y: The y coordinate of the scanline.
+        @return bytes: The scanline, ``self.width * 3`` bytes long.
+        """
+        pixels, s = self.row_pixels(y)
+        return flatten_pixels(pixels, s, s + self.width * 4, self.bgcolor)
+
+    def rows(self):
+        """Yields the 24-bit RGB representation of the view one scanline at a time. See ``Canvas.rows``.
+
+        @return generator: A generator yielding ``self.height`` bytes objects of ``self.width * 3`` bytes each.
+        """
+        for y in range(self.height):
+            yield self.row_bytes(y)
+
+    def rgba_rows(self):
+        """Yields the 32-bit RGBA representation of the view one scanline at a time. See ``Canvas.rgba_rows``.
+
+        @return generator: A generator yielding ``self.height`` bytes objects of ``self.width * 4`` bytes each.
+        """
+        scale = repeat(255.)
+
+        for y in range(self.height):
+            pixels, s = self.row_pixels(y)
+            yield bytes(map(floor, map(mul, pixels[s:s + self.width * 4], scale)))
+
+    def bytes(self):
+        """Returns an 24-bit RGB representation of the view as a byte array. See ``Canvas.bytes``.
+
+        @return bytes: An 24-bit RGB representation of the view.
+        """
+        return b"".join(self.rows())
+
+    def to_png(self, path, preset=None, alpha=False, optimize=True, cache=None):
+        """Exports the view as a PNG file. See ``Canvas.to_png``.
+
+        @param string path: The image path.
+        """
+        with open(path, "wb") as f:
+            self.write_png(f, preset, alpha, optimize, cache)
+
+    def write_png(self, stream, preset=None, alpha=False, optimize=True, cache=None):
+        """Writes the view as a PNG image to a stream. See ``Canvas.write_png``. Views keep no export caches, so every
+        scanline is converted and filtered.
+
+        @param BytesIO stream: The stream to write the PNG to.
+        """
+        if cache is not None:
+            cache.write_png(self, stream, preset, alpha, optimize)
+            return
+
+        w = PngWriter(stream, self.width, self.height, preset=preset, channels=4 if alpha else 3)
+        rows = self.rgba_rows if alpha else self.rows
+
+        if optimize:
+            w.optimize(rows())
+
+        w.write_image(rows())
@@ -0,0 +1,205 @@
+from image_processing.canvas import blend_run
+
+
+def subtract_intervals(start, end, covered):
+    """Returns the parts of an interval that are not covered.
+
+    @param int start: The start of the interval.
+    @param int end: The end of the interval, exclusive.
+    @param list covered: Sorted, disjoint ``(start, end)`` intervals.
+    @return list: The uncovered ``(start, end)`` parts, in order.
+    """
+    parts = []
+
+    for covered_start, covered_end in covered:
+        if covered_end <= start:
+            continue
+        if covered_start >= end:
+            break
+        if covered_start > start:
+            parts.append((start, covered_start))
+        start = max(start, covered_end)
+
+    if start < end:
+        parts.append((start, end))
+
+    return parts
+
+
+def add_intervals(covered, intervals):
+    """Merges intervals into a list of covered intervals.
+
+    @param list covered: Sorted, disjoint ``(start, end)`` intervals.
+    @param list intervals: The ``(start, end)`` intervals to add, in any order.
+    @return list: The sorted, disjoint union of both.
+    """
+    merged = []
+
+    for start, end in sorted(covered + intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+class Compositor(object):
+    """Compositor defers blending onto a Canvas until the result is needed, then composites every row in one go.
+
+    Blends, including the text runs Font.write blends, are recorded as layers with the region of the canvas they
+    cover. When the compositor is flattened, each row is composited once from the layers that intersect it. Layers are
+    looked at from the top down first, so pixels hidden under opaque pixels of a higher layer are never read or
+    blended. The result is identical to blending onto the canvas right away.
+
+    Sources are read when the compositor is flattened, so they must not change until then.
+    """
+
+    def __init__(self, canvas):
+        """Creates a new Compositor object.
+
+        @param Canvas canvas: The canvas to composite onto. It serves as the bottom layer.
+        """
+        self.canvas = canvas
+        self.width = canvas.width
+        self.height = canvas.height
+
+        # The recorded layers as (src, offset_x, offset_y, x0, x1, y0, y1, ignore_src_alpha) tuples, bottom to top.
+        # x0 to x1 and y0 to y1 is the part of the source that lies within the canvas, in source coordinates.
+        self.layers = []
+
+    def blend(self, src, offset_x=0, offset_y=0, ignore_src_alpha=False):
+        """Records a blend of ``src`` onto the canvas. See ``Canvas.blend``.
+
+        @param Canvas src: The image to blend. Any image providing ``row_pixels`` and ``spans`` works.
+        @param int offset_x: The X offset to place the source image at.
+        @param int offset_y: The Y offset to place the source image at.
+        @param bool ignore_src_alpha: Whether blend should ignore the source image's alpha values
+                                      and assume it's opaque.
+        """
+        x0, x1 = max(0, -offset_x), min(src.width, self.width - offset_x)
+        y0, y1 = max(0, -offset_y), min(src.height, self.height - offset_y)
+
+        if x0 < x1 and y0 < y1:
+            self.layers.append((src, offset_x, offset_y, x0, x1, y0, y1, ignore_src_alpha))
+
+    def write(self, font, x, y, text):
+        """Records a string of text. See ``Font.write``.
+
+        @param Font font: The font to write with.
+        @param int x: The x coordinate of where to write the text.
+        @param int y: The y coordinate of where to write the text.
+        @param str text: The text to write.
+        """
+        font.write(self, x, y, text)
+
+    def layers_by_row(self):
+        """Sorts the layers into the rows they intersect.
+
+        @return list: For each row, the layers intersecting it, bottom to top.
+        """
+        rows = [[] for _ in range(self.height)]
+
+        for layer in self.layers:
+            offset_y, y0, y1 = layer[2], layer[5], layer[6]
+
+            for y in range(offset_y + y0, offset_y + y1):
+                rows[y].append(layer)
+
+        return rows
+
+    def composite_row(self, y, layers, pixels, d):
+        """Composites layers onto a row of pixels.
+
+        @param int y: The y coordinate of the row in the canvas.
+        @param list layers: The layers intersecting the row, bottom to top.
+        @param array pixels: The pixels holding the row, as it is without the layers.
+        @param int d: The index of the row's pixel 0 in ``pixels``.
+        """
+        # Top down, work out which parts of each layer are visible, i.e. not under an opaque pixel of a higher layer.
+        covered = []
+        work = []
+        bottom = layers[0]
+
+        for layer in reversed(layers):
+            src, offset_x, offset_y, x0, x1, _, _, ignore_src_alpha = layer
+            src_y = y - offset_y
+            spans = [(x0, x1, True)] if ignore_src_alpha else src.spans(src_y, x0, x1)
+
+            if not covered:
+                visible = [(start + offset_x, end + offset_x, opaque) for start, end, opaque in spans]
+            else:
+                visible = [(visible_start, visible_end, opaque) for start, end, opaque in spans
+                           for visible_start, visible_end in subtract_intervals(start + offset_x, end + offset_x,
+                                                                                covered)]
+
+            if visible:
+                work.append((layer, src_y, visible))
+            if layer is bottom:
+                break
+
+            covered = add_intervals(covered, [(start + offset_x, end + offset_x) for start, end, opaque in spans
+                                              if opaque])
+
+            if covered == [(0, self.width)]:
+                break
+
+        # Bottom up, blend the visible parts.
+        for (src, offset_x, _, _, _, _, _, _), src_y, visible in reversed(work):
+            src_pixels, s = src.row_pixels(src_y, visible[0][0] - offset_x, visible[-1][1] - offset_x)
+            s -= offset_x * 4
+
+            for start, end, opaque in visible:
+                if opaque:
+                    pixels[d + start * 4:d + end * 4] = src_pixels[s + start * 4:s + end * 4]
+                else:
+                    blend_run(pixels, d + start * 4, src_pixels, s + start * 4, end - start)
+
+    def flatten(self):
+        """Composites all recorded layers onto the canvas and forgets them.
+
+        @return Canvas: The canvas.
+        """
+        canvas = self.canvas
+        size = self.width * 4
+        canvas.detach()
+
+        for y, layers in enumerate(self.layers_by_row()):
+            if layers:
+                self.composite_row(y, layers, canvas.pixels, y * size)
+                canvas.mark_dirty(y, y + 1)
+
+        self.layers = []
+        return canvas
+
+    def rect(self, x, y, width, height):
+        """Returns a new Canvas that contains a copy of the composited pixels in the given rectangle. Only the rows
+        of the rectangle are composited, and the layers are kept.
+
+        @param int x: The x coordinate of the rectangle's top left corner.
+        @param int y: The y coordinate of the rectangle's top left corner.
+        @param int width: The width of the rectangle, extending to the right from the top left corner.
+        @param int height: The height of the rectangle, extending downwards from the top left corner.
+        @return Canvas: The canvas.
+        """
+        rect = self.canvas.rect(x, y, width, height)
+        size = self.width * 4
+
+        for rect_y in range(height):
+            layers = [layer for layer in self.layers if layer[2] + layer[5] <= y + rect_y < layer[2] + layer[6]]
+
+            if layers:
+                start = (y + rect_y) * size
+                row = self.canvas.pixels[start:start + size]
+                self.composite_row(y + rect_y, layers, row, 0)
+                rect.pixels[rect_y * width * 4:(rect_y + 1) * width * 4] = row[x * 4:(x + width) * 4]
+
+        return rect
+
+    def to_png(self, path, *args, **kwargs):
+        """Flattens the compositor and exports the canvas as a PNG file. See ``Canvas.to_png``.
+
+        @param string path: The image path.
+        """
+        self.flatten().to_png(path, *args, **kwargs)
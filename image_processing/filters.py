@@ -0,0 +1,285 @@
+"""The five PNG scanline filters, implemented for whole scanlines or whole images at once.
+
+Two backends are available: a pure-Python one that pushes the per-byte work into C-level ``map`` and ``bytes``
+operations, and a NumPy one that is used automatically when NumPy can be imported. Both produce byte-identical
+results. See http://www.libpng.org/pub/png/spec/1.2/PNG-Filters.html for the filter definitions.
+"""
+from itertools import repeat
+from operator import add, and_, rshift, sub
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+NONE, SUB, UP, AVERAGE, PAETH = range(5)
+
+# Maps a filtered byte to the absolute value of that byte read as a signed 8-bit integer.
+ABS_SIGNED = bytes(min(i, 256 - i) for i in range(256))
+
+backend = "numpy" if numpy is not None else "python"
+
+
+def set_backend(name):
+    """Selects the filter backend.
+
+    @param str name: Either "python" or "numpy".
+    """
+    global backend
+
+    if name not in ("python", "numpy"):
+        raise ValueError("Unknown filter backend %r." % name)
+    if name == "numpy" and numpy is None:
+        raise ValueError("The numpy backend requires NumPy to be installed.")
+
+    backend = name
+
+
+def score(filtered):
+    """Scores a filtered scanline for the "minimum sum of absolute differences" heuristic. Lower is better.
+
+    The first data byte is counted as an unsigned value while all following bytes are counted as absolute signed
+    differences. The encoder has always ranked filters this way, so it is kept to produce identical files.
+
+    @param bytes filtered: The filtered scanline, including its filter type byte.
+    @return int: The score.
+    """
+    return filtered[1] + sum(filtered[2:].translate(ABS_SIGNED))
+
+
+def filter_scanline(line, prev_line, bpp, filter_type=None):
+    """Filters a single scanline.
+
+    @param bytes line: The scanline to process.
+    @param prev_line: The previous scanline, or None if ``line`` is the first scanline.
+    @type prev_line: bytes or None
+    @param int bpp: The number of bytes per complete pixel.
+    @param filter_type: The filter to apply, or None to pick the filter with the lowest ``score``.
+    @type filter_type: int or None
+    @return bytes: The filtered scanline, which will be one byte longer than ``line``.
+    """
+    if backend == "numpy":
+        return _numpy_filter_rows(line, len(line), prev_line, bpp, filter_type)
+
+    if filter_type is not None:
+        return PYTHON_FILTERS[filter_type](line, prev_line, bpp)
+
+    best, best_score = None, None
+
+    # Ties go to the filter with the lowest type number.
+    for filter_ in PYTHON_FILTERS:
+        filtered = filter_(line, prev_line, bpp)
+        filtered_score = score(filtered)
+
+        if best is None or filtered_score < best_score:
+            best, best_score = filtered, filtered_score
+
+    return best
+
+
+def filter_image(image, stride, bpp, filter_type=None, prev_line=None):
+    """Filters all scanlines of an image, or of a horizontal strip of an image.
+
+    @param bytes image: The image, consisting of scanlines of ``stride`` bytes each.
+    @param int stride: The number of bytes per scanline.
+    @param int bpp: The number of bytes per complete pixel.
+    @param filter_type: The filter to apply, or None to pick the best filter per scanline.
+    @type filter_type: int or None
+    @param prev_line: The scanline above the first one in ``image`` when filtering a strip (optional).
+    @type prev_line: bytes or None
+    @return bytes: The filtered scanlines, concatenated.
+    """
+    if backend == "numpy":
+        return _numpy_filter_rows(image, stride, prev_line, bpp, filter_type)
+
+    filtered = []
+    previous_line = prev_line
+
+    for i in range(0, len(image), stride):
+        line = image[i:i + stride]
+        filtered.append(filter_scanline(line, previous_line, bpp, filter_type))
+        previous_line = line
+
+    return b"".join(filtered)
+
+
+def none_filter(line, prev_line, bpp):
+    """Filters a scanline using the None filter function. The filter type byte is prepended."""
+    return b"\x00" + bytes(line)
+
+
+def sub_filter(line, prev_line, bpp):
+    """Filters a scanline using the Sub filter function. The filter type byte is prepended."""
+    left = bytes(bpp) + line[:-bpp]
+    return b"\x01" + bytes(map(and_, map(sub, line, left), repeat(255)))
+
+
+def up_filter(line, prev_line, bpp):
+    """Filters a scanline using the Up filter function. The filter type byte is prepended."""
+    if not prev_line:
+        return b"\x02" + bytes(line)
+
+    return b"\x02" + bytes(map(and_, map(sub, line, prev_line), repeat(255)))
+
+
+def average_filter(line, prev_line, bpp):
+    """Filters a scanline using the Average filter function. The filter type byte is prepended."""
+    left = bytes(bpp) + line[:-bpp]
+
+    if prev_line:
+        predictor = map(rshift, map(add, left, prev_line), repeat(1))
+    else:
+        predictor = map(rshift, left, repeat(1))
+
+    return b"\x03" + bytes(map(and_, map(sub, line, predictor), repeat(255)))
+
+
+def paeth_filter(line, prev_line, bpp):
+    """Filters a scanline using the Paeth filter function. The filter type byte is prepended."""
+    left = bytes(bpp) + line[:-bpp]
+
+    # Without a previous scanline, b and c are 0 and the Paeth predictor always picks a, just like Sub does.
+    if not prev_line:
+        return b"\x04" + bytes(map(and_, map(sub, line, left), repeat(255)))
+
+    up_left = bytes(bpp) + prev_line[:-bpp]
+    filtered = bytearray(len(line) + 1)
+    filtered[0] = 4
+
+    # a, b and c are arranged around x as follows:  c b
+    #                                               a x
+    for i, x, a, b, c in zip(range(1, len(line) + 1), line, left, prev_line, up_left):
+        # With p = a + b - c, these are |p - a|, |p - b| and |p - c|.
+        pa = b - c if b > c else c - b
+        pb = a - c if a > c else c - a
+        pc = a + b - c - c
+        if pc < 0:
+            pc = -pc
+
+        if pa <= pb and pa <= pc:
+            filtered[i] = (x - a) & 255
+        elif pb <= pc:
+            filtered[i] = (x - b) & 255
+        else:
+            filtered[i] = (x - c) & 255
+
+    return bytes(filtered)
+
+
+PYTHON_FILTERS = (none_filter, sub_filter, up_filter, average_filter, paeth_filter)
+
+
+def _numpy_filter_rows(data, stride, prev_line, bpp, filter_type):
+    """Filters one or more scanlines at once using NumPy.
+
+    @param bytes data: The scanlines, concatenated.
+    @param int stride: The number of bytes per scanline.
+    @param prev_line: The scanline preceding the first one in ``data``, or None.
+    @type prev_line: bytes or None
+    @param int bpp: The number of bytes per complete pixel.
+    @param filter_type: The filter to apply, or None to pick the best filter per scanline.
+    @type filter_type: int or None
+    @return bytes: The filtered scanlines, concatenated.
+    """
+    x = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, stride)
+    rows = x.shape[0]
+
+    # Neighbouring bytes: a is to the left, b is above and c is above left. Everything outside the image is 0.
+    a = numpy.zeros_like(x)
+    a[:, bpp:] = x[:, :-bpp]
+    b = numpy.zeros_like(x)
+    b[1:] = x[:-1]
+    if prev_line:
+        b[0] = numpy.frombuffer(prev_line, dtype=numpy.uint8)
+    c = numpy.zeros_like(x)
+    c[:, bpp:] = b[:, :-bpp]
+
+    def predict(type_):
+        if type_ == NONE:
+            return numpy.zeros_like(x)
+        if type_ == SUB:
+            return a
+        if type_ == UP:
+            return b
+        if type_ == AVERAGE:
+            return ((a.astype(numpy.uint16) + b) >> 1).astype(numpy.uint8)
+
+        a16, b16, c16 = a.astype(numpy.int16), b.astype(numpy.int16), c.astype(numpy.int16)
+        pa = numpy.abs(b16 - c16)
+        pb = numpy.abs(a16 - c16)
+        pc = numpy.abs(a16 + b16 - c16 - c16)
+        return numpy.where((pa <= pb) & (pa <= pc), a, numpy.where(pb <= pc, b, c))
+
+    if filter_type is not None:
+        filtered = x - predict(filter_type)
+        types = numpy.full(rows, filter_type, dtype=numpy.uint8)
+    else:
+        candidates = numpy.stack([x - predict(type_) for type_ in range(5)])
+        table = numpy.frombuffer(ABS_SIGNED, dtype=numpy.uint8)
+        scores = candidates[:, :, 0].astype(numpy.int64) \
+            + table[candidates[:, :, 1:]].sum(axis=2, dtype=numpy.int64)
+        types = scores.argmin(axis=0).astype(numpy.uint8)
+        filtered = candidates[types, numpy.arange(rows)]
+
+    return numpy.concatenate([types[:, None], filtered], axis=1).tobytes()
+
+
+def unfilter_scanline(filter_type, line, prev_line, bpp):
+    """Reverses the filtering of a scanline, as done by a PNG decoder.
+
+    Unlike filtering, this is inherently sequential for Sub, Average and Paeth, as every byte depends on the
+    reconstructed byte to its left.
+
+    @param int filter_type: The filter type byte of the scanline.
+    @param bytes line: The filtered scanline, without the filter type byte.
+    @param prev_line: The previous reconstructed scanline, or None if ``line`` is the first scanline.
+    @type prev_line: bytes or None
+    @param int bpp: The number of bytes per complete pixel, rounded up to 1 for bit depths below 8.
+    @return bytearray: The reconstructed scanline.
+    """
+    if filter_type == NONE or (filter_type == UP and not prev_line):
+        return bytearray(line)
+
+    if filter_type == UP:
+        return bytearray(map(and_, map(add, line, prev_line), repeat(255)))
+
+    out = bytearray(line)
+
+    if filter_type == SUB or (filter_type == PAETH and not prev_line):
+        # Without a previous scanline, Paeth always predicts from the left, just like Sub.
+        for i in range(bpp, len(out)):
+            out[i] = (out[i] + out[i - bpp]) & 255
+    elif filter_type == AVERAGE:
+        if not prev_line:
+            prev_line = bytes(len(line))
+
+        for i in range(len(out)):
+            a = out[i - bpp] if i >= bpp else 0
+            out[i] = (out[i] + ((a + prev_line[i]) >> 1)) & 255
+    elif filter_type == PAETH:
+        for i in range(len(out)):
+            b = prev_line[i]
+
+            if i < bpp:
+                # a and c are 0, so the predictor is b.
+                out[i] = (out[i] + b) & 255
+                continue
+
+            a, c = out[i - bpp], prev_line[i - bpp]
+            pa = b - c if b > c else c - b
+            pb = a - c if a > c else c - a
+            pc = a + b - c - c
+            if pc < 0:
+                pc = -pc
+
+            if pa <= pb and pa <= pc:
+                out[i] = (out[i] + a) & 255
+            elif pb <= pc:
+                out[i] = (out[i] + b) & 255
+            else:
+                out[i] = (out[i] + c) & 255
+    else:
+        raise ValueError("Unknown filter type %d." % filter_type)
+
+    return out
@@ -1,17 +1,86 @@
-from image_processing.canvas import Canvas, RgbaColor
+from collections import OrderedDict
+
+from image_processing.canvas import Canvas, CanvasView, RgbaColor
+
+
+class TextRun(Canvas):
+    """TextRun is a transparent canvas holding a laid-out string of text.
+
+    Besides the pixels, a TextRun keeps the spans of inked pixels for each row, so blending it onto another canvas only
+    touches those pixels. Text runs are built by Font and should be treated as read-only; drawing onto one does not
+    update its spans.
+    """
+
+    def __init__(self, width, height, bgcolor=None):
+        Canvas.__init__(self, width, height, bgcolor or RgbaColor(0, 0, 0, 0))
+        self.row_spans = [[] for _ in range(height)]
+
+    def copy(self):
+        """Creates a copy of this text run.
+        @return TextRun: A copy of this text run.
+        """
+        c = Canvas.copy(self)
+        c.row_spans = [list(spans) for spans in self.row_spans]
+        return c
+
+    def spans(self, y, x0=0, x1=None):
+        """Returns the precomputed runs of inked pixels in a row, clipped to the given range.
+
+        @param int y: The y coordinate of the row.
+        @param int x0: The x coordinate to start at (optional).
+        @param int x1: The x coordinate to stop at, exclusive. Defaults to the width of the run (optional).
+        @return list: A list of ``(start, end, opaque)`` tuples with x coordinates.
+        """
+        x1 = self.width if x1 is None else x1
+
+        if x0 <= 0 and x1 >= self.width:
+            return self.row_spans[y]
+
+        return [(max(start, x0), min(end, x1), opaque)
+                for start, end, opaque in self.row_spans[y] if start < x1 and end > x0]
+
+
+def run_size(run):
+    """Returns the number of bytes the pixels of a text run take up.
+
+    @param run: The text run, or None.
+    @type run: TextRun or None
+    @return int: The size.
+    """
+    return 0 if run is None else len(run.pixels) * run.pixels.itemsize
 
 
 class Font(object):
     """The Font class offers support for writing text onto a Canvas."""
 
-    def __init__(self):
+    def __init__(self, cache_size=256, cache_bytes=16 * 1024 * 1024):
+        """Creates a new Font object.
+
+        Laid-out strings are kept for reuse until either limit is reached, evicting the least recently used ones
+        first. Each costs 32 bytes per pixel of its bounding box, so the byte budget is what bounds memory for long
+        strings.
+
+        @param int cache_size: The most laid-out strings to keep (optional).
+        @param int cache_bytes: The most pixel data of laid-out strings to keep. Strings larger than this are not
+                                cached (optional).
+        """
+        if cache_size < 0 or cache_bytes < 0:
+            raise ValueError("cache_size and cache_bytes must not be negative.")
+
         self.charmap = {}
         self.char_height = 0
         self.char_width = 0
+        self.glyph_spans = {}
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.runs = OrderedDict()
+        self.runs_size = 0
 
     def load(self, path, charmap, char_width, char_height):
         """Imports a font file.
 
+        For every glyph, the spans of inked pixels per row are computed once, so drawing text only touches those.
+
         @param str path: The path of the font file.
         @param str charmap: The character map.
         @param int char_width: The width of a character.
@@ -26,28 +95,67 @@ class Font(object):
         with open(path, "rb") as f:
             canvas.import_rgba_data(f.read())
 
-        for i, c in enumerate(charmap):
-            self.charmap[c] = canvas.rect(i * char_width, 0, char_width, char_height)
+        self.load_glyphs({c: canvas.rect(i * char_width, 0, char_width, char_height) for i, c in enumerate(charmap)},
+                         char_width, char_height)
+
+    def load_glyphs(self, glyphs, char_width, char_height):
+        """Uses already decoded glyphs, e.g. those of another Font, as this font's characters. CanvasView objects are
+        copied into Canvas objects, so later changes to the canvas they show do not affect the font. Other read-only
+        images, such as the shared glyphs of ``batch.SharedImage.band``, are used as they are.
+
+        @param dict glyphs: A dict mapping characters to Canvas or CanvasView objects, or other images providing
+                            ``row_pixels`` and ``spans``, of ``char_width`` x ``char_height`` pixels.
+        @param int char_width: The width of a character.
+        @param int char_height: The height of a character.
+        """
+        for c, glyph in glyphs.items():
+            if isinstance(glyph, CanvasView):
+                glyph = glyph.copy()
+
+            self.charmap[c] = glyph
+            self.glyph_spans[c] = [glyph.spans(y) for y in range(char_height)]
 
         self.char_width = char_width
         self.char_height = char_height
+        self.runs.clear()
+        self.runs_size = 0
 
-    def write(self, target, x, y, text):
-        """Writes a string of text onto the given canvas.
+    def layout(self, text):
+        """Lays out a string of text as a TextRun. Recently used strings are served from a cache.
 
-        @param Canvas target: The canvas to write the text onto.
-        @param int x: The x coordinate of where to write the text.
-        @param int x: The y coordinate of where to write the text.
-        @param str text: The text to write.
+        @param str text: The text to lay out.
+        @return TextRun: The text run, or None if the text does not contain any visible glyph.
         """
+        if text in self.runs:
+            self.runs.move_to_end(text)
+            return self.runs[text]
+
+        run = self.build_run(text)
+        size = run_size(run)
+
+        if self.cache_size > 0 and size <= self.cache_bytes:
+            self.runs[text] = run
+            self.runs_size += size
 
+            while len(self.runs) > self.cache_size or self.runs_size > self.cache_bytes:
+                _, evicted = self.runs.popitem(last=False)
+                self.runs_size -= run_size(evicted)
+
+        return run
+
+    def build_run(self, text):
+        """Builds a TextRun for a string of text, without consulting the cache.
+
+        @param str text: The text to lay out.
+        @return TextRun: The text run, or None if the text does not contain any visible glyph.
+        """
+        placements = []
         x_offset = 0
         y_offset = 0
 
         for c in text:
             if c in self.charmap:
-                letter = self.charmap[c]
-                target.blend(letter, x + x_offset, y + y_offset)
+                placements.append((c, x_offset, y_offset))
                 x_offset += self.char_width
             elif c == "\n":
                 x_offset = 0
@@ -55,3 +163,41 @@ class Font(object):
             else:
                 x_offset += self.char_width
 
+        if not placements:
+            return None
+
+        width = max(x for _, x, _ in placements) + self.char_width
+        height = max(y for _, _, y in placements) + self.char_height
+        run = TextRun(width, height)
+
+        for c, x, y in placements:
+            glyph = self.charmap[c]
+
+            for glyph_y, spans in enumerate(self.glyph_spans[c]):
+                glyph_pixels, s = glyph.row_pixels(glyph_y)
+                d = ((y + glyph_y) * width + x) * 4
+                row_spans = run.row_spans[y + glyph_y]
+
+                for start, end, opaque in spans:
+                    run.pixels[d + start * 4:d + end * 4] = glyph_pixels[s + start * 4:s + end * 4]
+
+                    # Merge with the previous span if both touch and are of the same kind.
+                    if row_spans and row_spans[-1][1] == x + start and row_spans[-1][2] == opaque:
+                        row_spans[-1] = (row_spans[-1][0], x + end, opaque)
+                    else:
+                        row_spans.append((x + start, x + end, opaque))
+
+        return run
+
+    def write(self, target, x, y, text):
+        """Writes a string of text onto the given canvas.
+
+        @param Canvas target: The canvas to write the text onto.
+        @param int x: The x coordinate of where to write the text.
+        @param int x: The y coordinate of where to write the text.
+        @param str text: The text to write.
+        """
+        run = self.layout(text)
+
+        if run is not None:
+            target.blend(run, x, y)
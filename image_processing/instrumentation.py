@@ -0,0 +1,157 @@
+"""Opt-in instrumentation of Canvas and PngWriter.
+
+While an ``instrument`` block is active, Canvas and PngWriter record how long each stage of their work takes, how
+many bytes pass through it, which filter every scanline got and how many pixels were blended::
+
+    with instrument() as stats:
+        canvas.blend(overlay, 32, 32)
+        canvas.to_png("out/test.png")
+
+    print(stats.report())
+
+The instrumented code calls ``active`` once per call and only takes measurements if it returns a Stats object, so
+there is no per-pixel or per-byte cost when instrumentation is disabled. The active Stats object is kept in a context
+variable, so ``instrument`` blocks on different threads or asyncio tasks record separately. Work handed to thread
+pools with ``submit`` is recorded in the Stats object of the thread that submitted it.
+
+Stages are timed exclusively around the work itself: "blend" is ``Canvas.blend``, "flatten" the conversion of
+pixels to RGB scanlines, "filter" the scanline filters (including trial compressions of the brute-force policy, and all
+of the best policy's work, which interleaves filtering and compressing), "compress" zlib and "write" the stream writes
+of ``PngWriter.write_chunk``. The strips of parallel compression are counted in bytes, but not timed. Frames that
+ApngWriter compresses on worker threads are timed like serial ones, so the times of concurrent frames add up; frames
+compressed on worker processes are not measured.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from threading import Lock
+
+from image_processing import filters
+
+
+# The Stats object measurements are currently recorded in, or None if instrumentation is disabled.
+current = ContextVar("current", default=None)
+
+FILTER_NAMES = {filters.NONE: "none", filters.SUB: "sub", filters.UP: "up", filters.AVERAGE: "average",
+                filters.PAETH: "paeth"}
+
+
+def active():
+    """Returns the Stats object measurements are currently recorded in.
+
+    @return Stats: The Stats object, or None if instrumentation is disabled.
+    """
+    return current.get()
+
+
+def submit(executor, fn, *args):
+    """Submits a call to an executor. On thread pools, the call runs in a copy of the caller's context, so the
+    worker records its measurements in the caller's Stats object. Contexts cannot be sent to other processes, so
+    calls on other executors are submitted as they are.
+
+    @param concurrent.futures.Executor executor: The executor.
+    @param callable fn: The function to call.
+    @return Future: The future of the call.
+    """
+    if isinstance(executor, ThreadPoolExecutor):
+        return executor.submit(copy_context().run, fn, *args)
+
+    return executor.submit(fn, *args)
+
+
+class Stats(object):
+    """Stats collects the measurements taken while instrumentation is active. Measurements may be added from several
+    threads at once.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # Maps stage names to the seconds spent in them.
+        self.timers = {}
+        # Maps counter names to their values, e.g. "compressed_bytes" or "blend_pixels_blended".
+        self.counters = {}
+        # The filter type of every filtered scanline, in the order they were filtered.
+        self.filter_choices = []
+
+    def add_time(self, stage, seconds):
+        """Adds time to a stage.
+
+        @param str stage: The name of the stage.
+        @param float seconds: The time spent.
+        """
+        with self.lock:
+            self.timers[stage] = self.timers.get(stage, 0.) + seconds
+
+    def count(self, name, amount=1):
+        """Increments a counter.
+
+        @param str name: The name of the counter.
+        @param int amount: The amount to add (optional).
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_filters(self, filter_types):
+        """Records the filters chosen for one or more scanlines.
+
+        @param filter_types: The filter types, one per scanline, e.g. the first bytes of filtered scanlines.
+        @type filter_types: bytes or iterable of int
+        """
+        with self.lock:
+            self.filter_choices.extend(filter_types)
+
+    def filter_histogram(self):
+        """Counts how often each filter was chosen.
+
+        @return dict: Maps filter names to the number of scanlines filtered with them.
+        """
+        histogram = dict.fromkeys(FILTER_NAMES.values(), 0)
+
+        for filter_type in self.filter_choices:
+            histogram[FILTER_NAMES[filter_type]] += 1
+
+        return histogram
+
+    def as_dict(self):
+        """Exports the measurements, e.g. to be serialized as JSON.
+
+        @return dict: The timers, counters, filter choices and filter histogram.
+        """
+        return {
+            "timers": dict(self.timers),
+            "counters": dict(self.counters),
+            "filter_choices": list(self.filter_choices),
+            "filter_histogram": self.filter_histogram(),
+        }
+
+    def report(self):
+        """Formats the measurements as a human-readable table.
+
+        @return str: The report.
+        """
+        lines = ["%-24s %10.4f s" % (stage, seconds) for stage, seconds in sorted(self.timers.items())]
+        lines += ["%-24s %12d" % (name, value) for name, value in sorted(self.counters.items())]
+        lines += ["filter %-17s %12d" % item for item in self.filter_histogram().items() if item[1]]
+        return "\n".join(lines)
+
+
+@contextmanager
+def instrument(callback=None):
+    """Enables instrumentation for the duration of a ``with`` block. Blocks can be nested; the innermost one
+    receives the measurements. Blocks on other threads are independent of this one.
+
+    @param callback: A function that is called with the Stats object when the block ends, e.g. to export the
+                     measurements to a monitoring system (optional).
+    @type callback: callable or None
+    @return Stats: The Stats object the measurements are recorded in.
+    """
+    stats = Stats()
+    token = current.set(stats)
+
+    try:
+        yield stats
+    finally:
+        current.reset(token)
+
+        if callback is not None:
+            callback(stats)
@@ -0,0 +1,132 @@
+from array import array
+from mmap import mmap, ACCESS_READ
+
+from image_processing.canvas import Canvas, RgbaColor, UNIT, alpha_runs, decode_pixels
+
+
+class MappedImage(object):
+    """MappedImage gives access to a raw 24-bit RGB or 32-bit RGBA image file, as exported by GIMP, without reading it
+    up front.
+
+    The file is memory-mapped and pixels are only decoded for the rows and columns that are actually used, e.g. by
+    ``rect`` or when blending a MappedImage onto a Canvas. Only the pages holding those pixels are ever read, so
+    working with a small part of a huge image stays cheap.
+    """
+
+    def __init__(self, path, width, height, channels=3):
+        """Opens a raw image file.
+
+        @param string path: The image path.
+        @param int width: The width of the image.
+        @param int height: The height of the image.
+        @param int channels: 3 for RGB data, 4 for RGBA data (optional).
+        """
+        if channels not in (3, 4):
+            raise ValueError("channels must be 3 or 4.")
+        if width <= 0 or height <= 0:
+            raise ValueError("Width and height must be positive and non-zero.")
+
+        self.width = width
+        self.height = height
+        self.channels = channels
+
+        with open(path, "rb") as f:
+            self.data = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+        if len(self.data) < width * height * channels:
+            self.data.close()
+            raise ValueError("The file does not contain %d x %d pixels." % (width, height))
+
+        # The most recently decoded row, as (y, x0, x1, pixels). blend asks for spans and pixels of the same row.
+        self.last_row = None
+
+    def close(self):
+        """Unmaps the file."""
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def decode(self, y, x0, x1):
+        """Decodes a part of a row.
+
+        @param int y: The y coordinate of the row.
+        @param int x0: The first pixel to decode.
+        @param int x1: The pixel after the last one to decode.
+        @return array: The pixels as an ``array("d")`` with four floats per pixel, like ``Canvas.pixels``.
+        """
+        if self.last_row is not None and self.last_row[:3] == (y, x0, x1):
+            return self.last_row[3]
+
+        start = (y * self.width + x0) * self.channels
+        pixels = decode_pixels(self.data[start:start + (x1 - x0) * self.channels], self.channels)
+
+        self.last_row = (y, x0, x1, pixels)
+        return pixels
+
+    def row_pixels(self, y, x0=0, x1=None):
+        """Decodes the given part of a row. See ``Canvas.row_pixels``.
+
+        @return tuple: ``(pixels, index)``, where ``index`` is the position of the row's pixel 0 in ``pixels``.
+        """
+        x1 = self.width if x1 is None else x1
+        return self.decode(y, x0, x1), -x0 * 4
+
+    def spans(self, y, x0=0, x1=None):
+        """Returns the runs of opaque and translucent pixels in the given part of a row. See ``Canvas.spans``.
+
+        @return list: A list of ``(start, end, opaque)`` tuples with x coordinates.
+        """
+        x1 = self.width if x1 is None else x1
+
+        if x0 >= x1:
+            return []
+        if self.channels == 3:
+            return [(x0, x1, True)]
+
+        start = (y * self.width + x0) * 4
+        alphas = array("d", map(UNIT.__getitem__, self.data[start + 3:start + (x1 - x0) * 4:4]))
+        return [(run_start + x0, run_end + x0, opaque) for run_start, run_end, opaque in alpha_runs(alphas)]
+
+    def rect(self, x, y, width, height, bgcolor=None):
+        """Decodes the pixels in the given rectangle into a new Canvas.
+
+        @param int x: The x coordinate of the rectangle's top left corner.
+        @param int y: The y coordinate of the rectangle's top left corner.
+        @param int width: The width of the rectangle, extending to the right from the top left corner.
+        @param int height: The height of the rectangle, extending downwards from the top left corner.
+        @param RgbaColor bgcolor: The background color of the new canvas. Defaults to opaque black for RGB images and
+                                  transparent black for RGBA images (optional).
+        @return Canvas: The canvas.
+        """
+        if x < 0 or x > self.width - 1 \
+                or y < 0 or y > self.height - 1:
+            raise ValueError("x or y coordinates out of bounds.")
+
+        if width < 0 or height < 0:
+            raise ValueError("Width and height must be positive.")
+
+        if x + width > self.width \
+                or y + height > self.height:
+            raise ValueError("The rectangle does not fit into the image.")
+
+        if bgcolor is None:
+            bgcolor = RgbaColor(0, 0, 0, 1 if self.channels == 3 else 0)
+
+        pixels = array("d")
+
+        for source_y in range(y, y + height):
+            pixels.extend(self.decode(source_y, x, x + width))
+
+        return Canvas(width, height, bgcolor, pixels)
+
+    def to_canvas(self, bgcolor=None):
+        """Decodes the whole image into a new Canvas.
+
+        @param RgbaColor bgcolor: The background color of the new canvas, see ``rect`` (optional).
+        @return Canvas: The canvas.
+        """
+        return self.rect(0, 0, self.width, self.height, bgcolor)
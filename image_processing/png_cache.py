@@ -0,0 +1,242 @@
+"""A content-addressed cache of encoded PNG images.
+
+Exporting the same pixels with the same settings always produces the same PNG, so a service that renders identical
+canvases over and over, e.g. the same template with the same text, only needs to encode each of them once::
+
+    cache = PngCache(max_bytes=64 * 1024 * 1024, directory="cache/png")
+    canvas.to_png("out/test.png", cache=cache)
+
+Images are identified by a SHA-256 hash of their pixels, size and background color together with the encoder
+settings. Encoded PNGs are kept in memory up to a byte budget, evicting the least recently used ones first. If a
+directory is given, they are also stored there, so they survive restarts; the directory is not size-limited.
+"""
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from io import BytesIO
+from threading import Lock
+
+from image_processing import instrumentation
+from image_processing.png_writer import CompressionPreset, FIXED, PRESETS
+
+
+# Part of every key. Bump it when a change to the encoder changes its output, so stale files on disk are not used.
+FORMAT_VERSION = 1
+
+
+def settings_key(preset, alpha, optimize):
+    """Describes the encoder settings of an export, so that equivalent presets share cache entries.
+
+    @param preset: The compression preset, see ``Canvas.to_png``.
+    @type preset: str or CompressionPreset or None
+    @param bool alpha: Whether the alpha channel is kept.
+    @param bool optimize: Whether the color type is picked automatically.
+    @return bytes: The settings.
+    """
+    if preset is None:
+        preset = CompressionPreset()
+    elif not isinstance(preset, CompressionPreset):
+        if preset not in PRESETS:
+            raise ValueError("Unknown preset %r." % preset)
+        preset = PRESETS[preset]
+
+    # The filter type only matters to the FIXED policy, like in PngWriter.filter_key.
+    filter_type = preset.filter_type if preset.filter_policy == FIXED else None
+    return repr((FORMAT_VERSION, preset.level, preset.strategy, preset.mem_level, preset.filter_policy,
+                 filter_type, bool(alpha), bool(optimize))).encode("ascii")
+
+
+def image_key(image, preset=None, alpha=False, optimize=True):
+    """Computes the cache key of an export.
+
+    @param Canvas image: The image. Any image providing ``row_pixels`` and ``bgcolor`` works, e.g. a CanvasView.
+    @param preset: The compression preset, see ``Canvas.to_png`` (optional).
+    @type preset: str or CompressionPreset or None
+    @param bool alpha: Whether the alpha channel is kept (optional).
+    @param bool optimize: Whether the color type is picked automatically (optional).
+    @return str: The key, as a hexadecimal string.
+    """
+    h = hashlib.sha256(settings_key(preset, alpha, optimize))
+    h.update(repr((image.width, image.height, tuple(image.bgcolor))).encode("ascii"))
+
+    # Hash the pixel buffer in one go if it holds exactly the image, and row by row otherwise.
+    pixels = getattr(image, "pixels", None)
+
+    if pixels is not None and len(pixels) == image.width * image.height * 4:
+        h.update(pixels)
+    else:
+        size = image.width * 4
+
+        for y in range(image.height):
+            row, s = image.row_pixels(y)
+            h.update(memoryview(row)[s:s + size])
+
+    return h.hexdigest()
+
+
+class PngCache(object):
+    """PngCache keeps encoded PNG images, keyed by the pixels and encoder settings they were made from.
+
+    Use it by passing it to ``Canvas.to_png`` or ``Canvas.write_png``. It can be shared between threads.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, directory=None):
+        """Creates a new PngCache object.
+
+        @param int max_bytes: The most PNG data to keep in memory. PNGs larger than this are only stored on
+                              disk (optional).
+        @param str directory: A directory to store PNGs in as well. It is created if it does not exist (optional).
+        """
+        if max_bytes < 0:
+            raise ValueError("max_bytes must not be negative.")
+
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """Returns the path a PNG is stored at on disk.
+
+        @param str key: The key of the PNG.
+        @return str: The path.
+        """
+        return os.path.join(self.directory, key + ".png")
+
+    def get(self, key):
+        """Looks a PNG up, in memory first and then on disk.
+
+        @param str key: The key of the PNG, see ``image_key``.
+        @return bytes: The PNG, or None if it is not cached.
+        """
+        with self.lock:
+            data = self.entries.get(key)
+
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self.count("png_cache_hits")
+                return data
+
+        if self.directory is not None:
+            try:
+                with open(self.path(key), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                with self.lock:
+                    self.disk_hits += 1
+                    self.count("png_cache_disk_hits")
+                    self.remember(key, data)
+                return data
+
+        with self.lock:
+            self.misses += 1
+            self.count("png_cache_misses")
+
+        return None
+
+    def put(self, key, data):
+        """Stores a PNG.
+
+        @param str key: The key of the PNG, see ``image_key``.
+        @param bytes data: The PNG.
+        """
+        with self.lock:
+            self.remember(key, data)
+
+        if self.directory is not None:
+            # Write to a temporary file first, so other processes never read a partial PNG.
+            fd, temp_path = tempfile.mkstemp(".tmp", dir=self.directory)
+
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temp_path, self.path(key))
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+    def remember(self, key, data):
+        """Adds a PNG to the in-memory entries, evicting the least recently used ones to stay within the budget. The
+        lock must be held.
+
+        @param str key: The key of the PNG.
+        @param bytes data: The PNG.
+        """
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key))
+
+        if len(data) > self.max_bytes:
+            return
+
+        self.entries[key] = data
+        self.size += len(data)
+
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def count(self, name):
+        """Counts a lookup while instrumentation is active.
+
+        @param str name: The name of the counter.
+        """
+        stats = instrumentation.active()
+        if stats is not None:
+            stats.count(name)
+
+    def write_png(self, image, stream, preset=None, alpha=False, optimize=True):
+        """Writes an image as a PNG to a stream, encoding it only if it is not cached yet. See ``Canvas.write_png``.
+
+        @param Canvas image: The image. Any image providing ``row_pixels``, ``bgcolor`` and ``write_png`` works.
+        @param BytesIO stream: The stream to write the PNG to.
+        @param preset: The compression preset (optional).
+        @type preset: str or CompressionPreset or None
+        @param bool alpha: Whether to keep the alpha channel (optional).
+        @param bool optimize: Whether to pick the cheapest color type (optional).
+        """
+        key = image_key(image, preset, alpha, optimize)
+        data = self.get(key)
+
+        if data is None:
+            buffer = BytesIO()
+            image.write_png(buffer, preset, alpha, optimize)
+            data = buffer.getvalue()
+            self.put(key, data)
+
+        stream.write(data)
+
+    def clear(self):
+        """Forgets all PNGs held in memory. Files on disk are kept."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """Exports the cache statistics.
+
+        @return dict: The number of memory hits, disk hits, misses and evictions, and the number and total size of
+                      the PNGs held in memory.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
@@ -0,0 +1,272 @@
+from struct import unpack
+from zlib import crc32, decompressobj, error as ZlibError
+
+from image_processing import filters
+from image_processing.canvas import Canvas, RgbaColor
+
+
+SIGNATURE = b"\x89PNG\x0D\x0A\x1A\x0A"
+
+# The number of samples per pixel for each color type.
+SAMPLES = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# The bit depths allowed for each color type.
+BIT_DEPTHS = {0: (1, 2, 4, 8, 16), 2: (8, 16), 3: (1, 2, 4, 8), 4: (8, 16), 6: (8, 16)}
+
+# The most decompressed data that's produced at once, so memory stays bounded regardless of the compression ratio.
+MAX_INFLATE = 64 * 1024
+
+
+def unpack_table(bit_depth):
+    """Builds a table that maps a byte to the samples it holds at the given bit depth below 8.
+
+    @param int bit_depth: 1, 2 or 4.
+    @return list: 256 bytes objects of ``8 // bit_depth`` samples each, most significant first.
+    """
+    mask = (1 << bit_depth) - 1
+    shifts = range(8 - bit_depth, -1, -bit_depth)
+    return [bytes((value >> shift) & mask for shift in shifts) for value in range(256)]
+
+
+class PngReader(object):
+    """PngReader is a class that allows you to decode PNG files, mirroring PngWriter.
+
+    The image data is inflated incrementally and unfiltered one scanline at a time, so only a few scanlines are held in
+    memory while reading. All color types and bit depths are supported, Adam7 interlacing is not. Pixels are delivered
+    as 8-bit samples; 16-bit samples are scaled down. For APNG files, the default image is read.
+    """
+
+    def __init__(self, stream):
+        """Creates a new PngReader object and reads the header chunks up to the image data.
+
+        @param BytesIO stream: The stream to read the PNG from.
+        """
+        self.stream = stream
+
+        if stream.read(8) != SIGNATURE:
+            raise ValueError("The stream does not contain a PNG image.")
+
+        type_, data = self.read_chunk()
+        if type_ != b"IHDR" or len(data) != 13:
+            raise ValueError("The PNG image does not start with an IHDR chunk.")
+
+        self.width, self.height, self.bit_depth, self.color_type, compression, filter_method, self.interlace = \
+            unpack("!2I5B", data)
+
+        if self.color_type not in BIT_DEPTHS or self.bit_depth not in BIT_DEPTHS[self.color_type]:
+            raise ValueError("Invalid color type %d or bit depth %d." % (self.color_type, self.bit_depth))
+        if compression != 0 or filter_method != 0:
+            raise ValueError("Unknown compression or filter method.")
+        if self.interlace:
+            raise ValueError("Interlaced PNG images are not supported.")
+
+        self.palette = None
+        self.transparency = None
+        self.pending = None
+
+        # Read ancillary chunks until the image data starts.
+        while True:
+            type_, data = self.read_chunk()
+
+            if type_ == b"PLTE":
+                self.palette = [data[i:i + 3] for i in range(0, len(data) - len(data) % 3, 3)]
+            elif type_ == b"tRNS":
+                self.transparency = data
+            elif type_ == b"IDAT":
+                self.pending = data
+                break
+            elif type_ == b"IEND":
+                raise ValueError("The PNG image does not contain image data.")
+
+        if self.color_type == 3 and not self.palette:
+            raise ValueError("The PNG image does not contain a palette.")
+        if self.transparency is not None and self.color_type in (0, 2) \
+                and len(self.transparency) < SAMPLES[self.color_type] * 2:
+            raise ValueError("The tRNS chunk is too short.")
+
+        # The number of 8-bit samples per pixel in the rows returned by ``rows``.
+        if self.color_type == 3:
+            self.channels = 4 if self.transparency else 3
+        elif self.color_type in (0, 2) and self.transparency:
+            self.channels = SAMPLES[self.color_type] + 1
+        else:
+            self.channels = SAMPLES[self.color_type]
+
+    def read_chunk(self):
+        """Reads a chunk from the stream and checks its CRC.
+
+        @return tuple: The chunk type and its data.
+        """
+        head = self.stream.read(8)
+        if len(head) != 8:
+            raise ValueError("Unexpected end of the PNG stream.")
+
+        length, type_ = unpack("!I4s", head)
+        data = self.stream.read(length)
+        tail = self.stream.read(4)
+
+        if len(data) != length or len(tail) != 4:
+            raise ValueError("Unexpected end of the PNG stream.")
+        if unpack("!I", tail)[0] != crc32(data, crc32(type_)):
+            raise ValueError("CRC mismatch in %s chunk." % type_.decode("latin-1"))
+
+        return type_, data
+
+    def compressed_data(self):
+        """Yields the contents of the consecutive IDAT chunks.
+
+        @return generator: The compressed image data, chunk by chunk.
+        """
+        data, self.pending = self.pending, None
+
+        while data is not None:
+            yield data
+
+            type_, data = self.read_chunk()
+            if type_ != b"IDAT":
+                data = None
+
+    def filtered_rows(self):
+        """Yields the filtered scanlines of the image, inflating just enough data for each one.
+
+        @return generator: The filtered scanlines, including their filter type byte.
+        """
+        stride = (self.width * SAMPLES[self.color_type] * self.bit_depth + 7) // 8 + 1
+        inflater = decompressobj()
+        compressed = self.compressed_data()
+        buffer = bytearray()
+
+        for _ in range(self.height):
+            while len(buffer) < stride:
+                if inflater.unconsumed_tail:
+                    buffer.extend(self.inflate(inflater, inflater.unconsumed_tail))
+                    continue
+
+                data = next(compressed, None)
+                if data is None or inflater.eof:
+                    raise ValueError("The PNG image data is truncated.")
+                buffer.extend(self.inflate(inflater, data))
+
+            yield bytes(buffer[:stride])
+            del buffer[:stride]
+
+    def inflate(self, inflater, data):
+        """Inflates the next piece of the image data, at most ``MAX_INFLATE`` bytes of it.
+
+        @param Decompress inflater: The decompressor.
+        @param bytes data: The compressed data.
+        @return bytes: The decompressed data.
+        """
+        try:
+            return inflater.decompress(data, MAX_INFLATE)
+        except ZlibError as e:
+            raise ValueError("The PNG image data is corrupt: %s." % e)
+
+    def raw_rows(self):
+        """Yields the unfiltered scanlines of the image in its own color type and bit depth.
+
+        @return generator: The scanlines.
+        """
+        bpp = max(1, SAMPLES[self.color_type] * self.bit_depth // 8)
+        previous = None
+
+        for line in self.filtered_rows():
+            previous = filters.unfilter_scanline(line[0], line[1:], previous, bpp)
+            yield previous
+
+    def rows(self):
+        """Yields the scanlines of the image as 8-bit samples, ``self.channels`` per pixel.
+
+        Grayscale images have one channel, grayscale images with alpha two, RGB three and RGBA four. Palette images
+        are expanded to RGB, or to RGBA if they have transparency. Transparency of grayscale and RGB images is turned
+        into an alpha channel.
+
+        @return generator: The scanlines, ``self.width * self.channels`` bytes each.
+        """
+        samples = SAMPLES[self.color_type]
+        count = self.width * samples
+        depth = self.bit_depth
+
+        if depth < 8:
+            unpack_samples = unpack_table(depth).__getitem__
+        if self.color_type == 0 and depth < 8:
+            # Scale the gray levels up to 8 bits.
+            scale = bytes(min(255, v * 255 // ((1 << depth) - 1)) for v in range(256))
+        if self.color_type == 3:
+            alphas = self.transparency or b""
+            entries = [rgb + (bytes((alphas[i],)) if i < len(alphas) else b"\xff") if self.channels == 4 else rgb
+                       for i, rgb in enumerate(self.palette)]
+            entries += [b"\x00" * self.channels] * (256 - len(entries))
+        if self.transparency and self.color_type in (0, 2):
+            key = unpack("!%dH" % samples, self.transparency[:samples * 2])
+
+        for raw in self.raw_rows():
+            if depth < 8:
+                line = b"".join(map(unpack_samples, raw))[:count]
+            else:
+                line = bytes(raw)
+
+            if self.color_type == 3:
+                yield b"".join(map(entries.__getitem__, line))
+                continue
+
+            if self.color_type == 0 and depth < 8:
+                line = line.translate(scale)
+            elif depth == 16:
+                # Round the 16-bit samples to the nearest 8-bit value.
+                line = bytes(((hi << 8 | lo) * 255 + 32767) // 65535 for hi, lo in zip(raw[0::2], raw[1::2]))
+
+            if self.transparency and self.color_type in (0, 2):
+                line = self.key_to_alpha(line, raw, key)
+
+            yield line
+
+    def key_to_alpha(self, line, raw, key):
+        """Adds an alpha channel to a grayscale or RGB scanline, making pixels that match the tRNS color transparent.
+
+        @param bytes line: The scanline as 8-bit samples.
+        @param bytes raw: The scanline in the image's own bit depth.
+        @param tuple key: The transparent color, one sample per channel.
+        @return bytes: The scanline with an alpha channel.
+        """
+        samples = SAMPLES[self.color_type]
+
+        if self.bit_depth == 16:
+            values = [hi * 256 + lo for hi, lo in zip(raw[0::2], raw[1::2])]
+        elif self.bit_depth < 8:
+            values = b"".join(map(unpack_table(self.bit_depth).__getitem__, raw))[:self.width]
+        else:
+            values = raw
+
+        out = bytearray(self.width * (samples + 1))
+        for c in range(samples):
+            out[c::samples + 1] = line[c::samples]
+
+        pixels = zip(*[values[c::samples] for c in range(samples)])
+        out[samples::samples + 1] = bytes(0 if pixel == key else 255 for pixel in pixels)
+        return bytes(out)
+
+    def read_into(self, canvas):
+        """Decodes the image into an existing canvas, row by row. The canvas must be as large as the image.
+
+        @param Canvas canvas: The canvas.
+        """
+        if canvas.width != self.width or canvas.height != self.height:
+            raise ValueError("The canvas must be %d x %d pixels." % (self.width, self.height))
+
+        for y, line in enumerate(self.rows()):
+            canvas.import_row(y, line, self.channels)
+
+    def to_canvas(self, bgcolor=None):
+        """Decodes the image into a new Canvas.
+
+        @param RgbaColor bgcolor: The background color of the canvas. Defaults to opaque black for images without
+                                  alpha and transparent black otherwise (optional).
+        @return Canvas: The canvas.
+        """
+        if bgcolor is None:
+            bgcolor = RgbaColor(0, 0, 0, 0 if self.channels in (2, 4) else 1)
+
+        canvas = Canvas(self.width, self.height, bgcolor)
+        self.read_into(canvas)
+        return canvas
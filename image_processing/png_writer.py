@@ -1,26 +1,452 @@
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from itertools import repeat
+from operator import add, mul
 from struct import pack
-from zlib import crc32, compress
-from math import floor
-from functools import reduce
-from ctypes import c_byte
+from time import perf_counter
+from zlib import adler32, crc32, compressobj, DEFLATED, MAX_WBITS, Z_DEFAULT_STRATEGY, Z_SYNC_FLUSH
+
+from image_processing import filters, instrumentation
+
+
+# Filter policies. FIXED applies the same filter to every scanline, HEURISTIC picks the filter with the minimum sum
+# of absolute differences per scanline and BRUTE_FORCE compresses every candidate and keeps the smallest. Picking the
+# best filter one scanline at a time can still lose to the heuristic overall, so BEST compresses the image with both
+# HEURISTIC and BRUTE_FORCE and keeps the smaller stream.
+FIXED, HEURISTIC, BRUTE_FORCE, BEST = "fixed", "heuristic", "brute-force", "best"
+
+# The policies that need trial compressions, so scanlines can't be filtered ahead of compression.
+TRIAL_POLICIES = (BRUTE_FORCE, BEST)
+
+
+# PNG color types.
+GRAYSCALE, RGB, PALETTE, GRAYSCALE_ALPHA, RGBA = 0, 2, 3, 4, 6
+
+# The number of samples per pixel of each color type.
+SAMPLES = {GRAYSCALE: 1, RGB: 3, PALETTE: 1, GRAYSCALE_ALPHA: 2, RGBA: 4}
+
+# The bit depths each color type supports. RGB, gray with alpha and RGBA images can only be written with 8 bits.
+BIT_DEPTHS = {GRAYSCALE: (1, 2, 4, 8), RGB: (8,), PALETTE: (1, 2, 4, 8), GRAYSCALE_ALPHA: (8,), RGBA: (8,)}
+
+
+# The amount of filtered data each strip should hold when compressing in parallel. Like pigz, we use 128 KiB.
+STRIP_SIZE = 128 * 1024
+
+# The size of deflate's sliding window, which is also the most a preset dictionary can hold.
+WINDOW_SIZE = 32 * 1024
+
+
+def zlib_header(level):
+    """Returns the two byte zlib stream header for the given compression level.
+
+    @param int level: The zlib compression level, from -1 to 9.
+    @return bytes: The header.
+    """
+    if level == -1:
+        level = 6
+
+    flevel = 0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3
+    cmf = (MAX_WBITS - 8) << 4 | DEFLATED
+    flg = flevel << 6
+    flg += 31 - (cmf << 8 | flg) % 31
+    return pack("!2B", cmf, flg)
+
+
+class CompressionPreset(object):
+    """CompressionPreset bundles the encoder settings that trade encoding time for file size."""
+
+    def __init__(self, level=9, strategy=Z_DEFAULT_STRATEGY, mem_level=8, filter_policy=HEURISTIC,
+                 filter_type=filters.PAETH):
+        """Creates a new CompressionPreset object.
+
+        @param int level: The zlib compression level, from 0 to 9.
+        @param int strategy: The zlib compression strategy, e.g. zlib.Z_FILTERED.
+        @param int mem_level: The zlib memory level, from 1 to 9.
+        @param str filter_policy: How scanline filters are chosen: FIXED, HEURISTIC, BRUTE_FORCE or BEST.
+        @param int filter_type: The filter used by the FIXED policy.
+        """
+        if filter_policy not in (FIXED, HEURISTIC, BRUTE_FORCE, BEST):
+            raise ValueError("Unknown filter policy %r." % filter_policy)
+
+        self.level = level
+        self.strategy = strategy
+        self.mem_level = mem_level
+        self.filter_policy = filter_policy
+        self.filter_type = filter_type
+
+    def compressobj(self, raw=False, zdict=None):
+        """Creates a compressor with this preset's settings.
+
+        @param bool raw: Whether to produce a raw deflate stream without zlib header and checksum.
+        @param bytes zdict: A preset dictionary (optional).
+        @return Compress: The compressor.
+        """
+        wbits = -MAX_WBITS if raw else MAX_WBITS
+
+        if zdict:
+            return compressobj(self.level, DEFLATED, wbits, self.mem_level, self.strategy, zdict)
+
+        return compressobj(self.level, DEFLATED, wbits, self.mem_level, self.strategy)
+
+
+# Named presets. See README.md for how they compare.
+PRESETS = {
+    "fastest": CompressionPreset(1, Z_DEFAULT_STRATEGY, 8, FIXED, filters.UP),
+    "balanced": CompressionPreset(6, Z_DEFAULT_STRATEGY, 8, FIXED, filters.PAETH),
+    "smallest": CompressionPreset(9, Z_DEFAULT_STRATEGY, 8, BEST),
+}
+
+
+def pixel_keys(line, channels):
+    """Maps every pixel of a scanline to an integer identifying its color, so colors can be counted and looked up
+    with C-level set and dict operations.
+
+    @param bytes line: The scanline, 24-bit RGB or 32-bit RGBA.
+    @param int channels: 3 or 4.
+    @return memoryview: One unsigned integer per pixel. RGB pixels get the key of the RGBA pixel with alpha 0.
+    """
+    if channels == 3:
+        padded = bytearray(len(line) // 3 * 4)
+        padded[0::4] = line[0::3]
+        padded[1::4] = line[1::3]
+        padded[2::4] = line[2::3]
+        line = padded
+
+    return memoryview(line).cast("I")
+
+
+def color_key(color):
+    """Returns the key ``pixel_keys`` gives pixels of the given color.
+
+    @param bytes color: The color, as 3 RGB or 4 RGBA bytes.
+    @return int: The key.
+    """
+    return int.from_bytes(color.ljust(4, b"\x00"), sys.byteorder)
+
+
+def count_colors(rows, channels, limit=256):
+    """Collects the distinct colors of an image, giving up as soon as there are more than ``limit``.
+
+    @param rows: The scanlines, 24-bit RGB or 32-bit RGBA.
+    @type rows: iterable of bytes
+    @param int channels: 3 or 4.
+    @param int limit: The most colors to collect (optional).
+    @return set: The colors as keys (see ``pixel_keys``), or None if there are more than ``limit``.
+    """
+    colors = set()
+
+    for line in rows:
+        colors.update(pixel_keys(line, channels))
+
+        if len(colors) > limit:
+            return None
+
+    return colors
+
+
+def analyze_row(line, channels):
+    """Collects what a scanline needs of a color type, for ``PngWriter.choose_color_type``.
+
+    @param bytes line: The scanline, 24-bit RGB or 32-bit RGBA.
+    @param int channels: 3 or 4.
+    @return tuple: ``(colors, levels, opaque)``: the scanline's colors as keys (see ``pixel_keys``), or None if it has
+                   more than 256; its gray levels, or None if it is not gray; and whether it is fully opaque.
+    """
+    colors = frozenset(pixel_keys(line, channels))
+    gray = line[0::channels] == line[1::channels] == line[2::channels]
+    opaque = channels == 3 or line[3::4] == b"\xff" * (len(line) // 4)
+    return colors if len(colors) <= 256 else None, frozenset(line[0::channels]) if gray else None, opaque
+
+
+def pack_samples(samples, bit_depth):
+    """Packs samples of less than 8 bits into bytes, leftmost sample in the most significant bits.
+
+    @param bytes samples: The samples, one per byte.
+    @param int bit_depth: 1, 2 or 4.
+    @return bytes: The packed samples. The last byte is padded with zero bits.
+    """
+    per_byte = 8 // bit_depth
+    samples = bytes(samples) + bytes(-len(samples) % per_byte)
+    packed = samples[0::per_byte]
+
+    for i in range(1, per_byte):
+        packed = map(add, map(mul, packed, repeat(1 << bit_depth)), samples[i::per_byte])
+
+    return bytes(packed)
+
+
+def depth_for(count):
+    """Returns the smallest bit depth that can distinguish ``count`` values.
+
+    @param int count: The number of values, at most 256.
+    @return int: 1, 2, 4 or 8.
+    """
+    return next(depth for depth in (1, 2, 4, 8) if count <= 1 << depth)
+
+
+def brute_force_filter(compressor, line, prev_line, bpp):
+    """Filters a scanline with every filter function and keeps the one that adds the least compressed data.
+
+    @param Compress compressor: The compressor the scanline will be fed to. It is copied for the trials, not changed.
+    @param bytes line: The scanline to process.
+    @param prev_line: The previous scanline, or None if ``line`` is the first scanline.
+    @type prev_line: bytes or None
+    @param int bpp: The number of bytes per complete pixel.
+    @return bytes: The filtered scanline.
+    """
+    best, best_size = None, None
+
+    for filter_type in range(5):
+        filtered = filters.filter_scanline(line, prev_line, bpp, filter_type)
+        trial = compressor.copy()
+        size = len(trial.compress(filtered)) + len(trial.flush(Z_SYNC_FLUSH))
+
+        if best is None or size < best_size:
+            best, best_size = filtered, size
+
+    return best
+
+
+def filter_strip(strip, prev_line, stride, bpp, preset):
+    """Filters a horizontal strip of an image. This is a module-level function so process pools can pickle it.
+
+    With the BRUTE_FORCE policy, the trial compressions run against a compressor private to the strip. The BEST
+    policy compresses the heuristically filtered strip with another one and keeps whichever filtering came out smaller.
+
+    @return bytes: The filtered scanlines of the strip.
+    """
+    if preset.filter_policy not in TRIAL_POLICIES:
+        filter_type = preset.filter_type if preset.filter_policy == FIXED else None
+        return filters.filter_image(strip, stride, bpp, filter_type, prev_line)
+
+    compressor = preset.compressobj(raw=True)
+    first_line = prev_line
+    filtered, size = [], 0
+
+    for i in range(0, len(strip), stride):
+        line = strip[i:i + stride]
+        filtered.append(brute_force_filter(compressor, line, prev_line, bpp))
+        size += len(compressor.compress(filtered[-1]))
+        prev_line = line
+
+    filtered = b"".join(filtered)
+
+    if preset.filter_policy == BEST:
+        heuristic = filters.filter_image(strip, stride, bpp, None, first_line)
+        other = preset.compressobj(raw=True)
+
+        if len(other.compress(heuristic) + other.flush()) < size + len(compressor.flush()):
+            return heuristic
+
+    return filtered
+
+
+def deflate_strip(data, preset, zdict):
+    """Compresses a strip of filtered data into raw deflate blocks, ending with a sync flush so that the output of
+    consecutive strips can be concatenated. This is a module-level function so process pools can pickle it.
+
+    @param bytes data: The filtered strip.
+    @param CompressionPreset preset: The compression settings.
+    @param bytes zdict: The filtered data preceding this strip (up to 32 KiB), or an empty bytes object.
+    @return bytes: The raw deflate data.
+    """
+    compressor = preset.compressobj(raw=True, zdict=zdict)
+    return compressor.compress(data) + compressor.flush(Z_SYNC_FLUSH)
 
 
 class PngWriter(object):
     """PngWriter is a class that allows you to encode PNG files."""
 
-    def __init__(self, stream, width, height, dynamic_filtering=True):
+    def __init__(self, stream, width, height, dynamic_filtering=True, chunk_size=65536, workers=1, executor=None,
+                 preset=None, channels=3, color_type=None, bit_depth=8, palette=None):
         """Creates a new PngWriter object.
 
+        Image data is always passed as 24-bit RGB, or 32-bit RGBA if ``channels`` is 4, and converted to the color type
+        of the PNG. By default, that's the same as the input. ``optimize`` picks the cheapest color type for an image.
+
         @param BytesIO stream: The stream to write the PNG to.
         @param int width: The width of the resulting image.
         @param int height: The height of the resulting image.
         @param bool dynamic_filtering: Whether dynamic filtering should be used (optional).
+        @param int chunk_size: The maximum size of the IDAT chunks emitted when streaming scanlines (optional).
+        @param int workers: The number of strips to filter and compress in parallel. 1 disables parallel
+                            compression (optional).
+        @param executor: A ``concurrent.futures`` executor to run the strips on, e.g. a ProcessPoolExecutor. If
+                         omitted, a thread pool with ``workers`` threads is created for each image (optional).
+        @type executor: concurrent.futures.Executor or None
+        @param preset: The compression settings: "fastest", "balanced", "smallest" or a CompressionPreset. If omitted,
+                       the maximum zlib level is used and ``dynamic_filtering`` decides between the heuristic
+                       filter choice and Paeth filtering throughout (optional).
+        @type preset: str or CompressionPreset or None
+        @param int channels: 3 if image data is passed as 24-bit RGB, 4 for 32-bit RGBA (optional).
+        @param int color_type: The color type of the PNG, see ``set_color_type``. Defaults to RGB for 3 channels and
+                               RGBA for 4 (optional).
+        @param int bit_depth: The bit depth of the PNG, see ``set_color_type`` (optional).
+        @param list palette: The palette for the PALETTE color type, see ``set_color_type`` (optional).
         """
+        if preset is None:
+            preset = CompressionPreset(filter_policy=HEURISTIC if dynamic_filtering else FIXED)
+        elif not isinstance(preset, CompressionPreset):
+            if preset not in PRESETS:
+                raise ValueError("Unknown preset %r." % preset)
+            preset = PRESETS[preset]
+
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be positive and non-zero.")
+        if workers < 1:
+            raise ValueError("workers must be positive and non-zero.")
+        if channels not in (3, 4):
+            raise ValueError("channels must be 3 or 4.")
+
         self.stream = stream
         self.width = width
         self.height = height
         self.dynamic_filtering = dynamic_filtering
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.executor = executor
+        self.preset = preset
+        self.channels = channels
+
+        if color_type is None:
+            color_type = RGB if channels == 3 else RGBA
+
+        self.set_color_type(color_type, bit_depth, palette)
+
+    def set_color_type(self, color_type, bit_depth=8, palette=None):
+        """Sets the color type the image data is converted to. This must happen before the IHDR chunk is written.
+
+        @param int color_type: GRAYSCALE, RGB, PALETTE, GRAYSCALE_ALPHA or RGBA. The types with alpha need 4 channels
+                               of input. Images are converted to gray by taking their red channel.
+        @param int bit_depth: 1, 2, 4 or 8 for GRAYSCALE and PALETTE, 8 otherwise (optional).
+        @param list palette: For PALETTE, the colors as bytes objects of ``channels`` bytes each, in index order. Every
+                             pixel of the image must have one of them (optional).
+        """
+        if color_type not in SAMPLES or bit_depth not in BIT_DEPTHS[color_type]:
+            raise ValueError("Unsupported color type %r with bit depth %r." % (color_type, bit_depth))
+        if color_type in (GRAYSCALE_ALPHA, RGBA) and self.channels != 4:
+            raise ValueError("Color types with alpha need RGBA image data.")
+        if color_type == PALETTE and (not palette or len(palette) > 1 << bit_depth):
+            raise ValueError("The palette must hold 1 to %d colors." % (1 << bit_depth))
+        if color_type == PALETTE and any(len(color) != self.channels for color in palette):
+            raise ValueError("Palette colors must have %d bytes." % self.channels)
+
+        self.color_type = color_type
+        self.bit_depth = bit_depth
+        self.palette = list(palette) if color_type == PALETTE else None
+        self.palette_index = {color_key(color): i for i, color in enumerate(self.palette or ())}
+
+        samples = SAMPLES[color_type]
+        self.stride = (self.width * samples * bit_depth + 7) // 8
+        self.bpp = max(1, samples * bit_depth // 8)
+
+        # Maps gray values to the samples of lower bit depths. Values in between levels are rounded down.
+        self.gray_scale = bytes(v // (255 // ((1 << bit_depth) - 1)) for v in range(256))
+
+    def optimize(self, rows):
+        """Scans an image and switches to the cheapest color type that represents it exactly:
+
+        - grayscale, at the lowest bit depth that holds all gray levels,
+        - indexed color, if there are 256 colors or less, at the lowest bit depth that can index them all,
+        - RGB for RGBA data without transparency,
+        - gray with alpha, for gray RGBA data with more than 256 colors.
+
+        Grayscale is preferred over indexed color if it does not need a higher bit depth. The scan stops once nothing
+        cheaper than the input's color type is possible.
+
+        @param rows: The scanlines of the image, as passed to ``write_image``.
+        @type rows: iterable of bytes
+        """
+        self.choose_color_type(analyze_row(line, self.channels) for line in rows)
+
+    def choose_color_type(self, analyses):
+        """Switches to the cheapest color type for an image whose scanlines have been analyzed, see ``optimize``. The
+        analyses can be kept and reused for scanlines that did not change.
+
+        @param analyses: The result of ``analyze_row`` for every scanline, in order. Iteration stops early once nothing
+                         cheaper than the input's color type is possible.
+        @type analyses: iterable of tuple
+        """
+        channels = self.channels
+        colors, levels = set(), set()
+        gray, opaque = True, True
+
+        for row_colors, row_levels, row_opaque in analyses:
+            if colors is not None:
+                if row_colors is not None:
+                    colors |= row_colors
+                if row_colors is None or len(colors) > 256:
+                    colors = None
+            if gray:
+                gray = row_levels is not None
+                if gray:
+                    levels.update(row_levels)
+            opaque = opaque and row_opaque
+
+            if colors is None and not gray and (channels == 3 or not opaque):
+                break
+
+        if colors is not None:
+            # Translucent colors come first, so the tRNS chunk only needs to cover those.
+            palette = sorted(color.to_bytes(4, sys.byteorder)[:channels] for color in colors)
+            palette.sort(key=lambda color: channels == 3 or color[3] == 255)
+
+        if gray and opaque:
+            gray_depth = next(depth for depth in (1, 2, 4, 8)
+                              if all(v % (255 // ((1 << depth) - 1)) == 0 for v in levels))
+
+            if gray_depth <= depth_for(len(colors)):
+                self.set_color_type(GRAYSCALE, gray_depth)
+            else:
+                self.set_color_type(PALETTE, depth_for(len(colors)), palette)
+        elif colors is not None:
+            self.set_color_type(PALETTE, depth_for(len(colors)), palette)
+        elif gray:
+            self.set_color_type(GRAYSCALE_ALPHA)
+        else:
+            self.set_color_type(RGB if opaque else RGBA)
+
+    @property
+    def converts(self):
+        """Whether image data needs to be converted to the color type of the PNG."""
+        return not (self.color_type == RGB and self.channels == 3 or self.color_type == RGBA)
+
+    def convert_row(self, line):
+        """Converts a scanline of image data to the color type of the PNG.
+
+        @param bytes line: The scanline, 24-bit RGB or 32-bit RGBA depending on ``channels``.
+        @return bytes: The scanline, ``self.stride`` bytes long.
+        """
+        channels = self.channels
+        color_type = self.color_type
+
+        if not self.converts:
+            return line
+
+        if color_type == RGB:
+            data = bytearray(self.width * 3)
+            data[0::3] = line[0::4]
+            data[1::3] = line[1::4]
+            data[2::3] = line[2::4]
+            return bytes(data)
+
+        if color_type == GRAYSCALE_ALPHA:
+            data = bytearray(self.width * 2)
+            data[0::2] = line[0::4]
+            data[1::2] = line[3::4]
+            return bytes(data)
+
+        if color_type == GRAYSCALE:
+            samples = line[0::channels]
+
+            if self.bit_depth < 8:
+                samples = samples.translate(self.gray_scale)
+        else:
+            samples = bytes(map(self.palette_index.__getitem__, pixel_keys(line, channels)))
+
+        return pack_samples(samples, self.bit_depth) if self.bit_depth < 8 else bytes(samples)
 
     def write_signature(self):
         """Writes the PNG signature to the stream."""
@@ -30,12 +456,26 @@ class PngWriter(object):
     def write_ihdr(self):
         """Writes the IHDR chunk to the stream.
 
-        This class only supports creating 8-bit RGB images without interlacing."""
+        This class only supports creating images without interlacing."""
 
-        # width, height, 8-bit bit depth, truecolor, compression method 0, filter method 0, no interlacing.
-        data = pack("!2I5b", self.width, self.height, 8, 2, 0, 0, 0)
+        # width, height, bit depth, color type, compression method 0, filter method 0, no interlacing.
+        data = pack("!2I5b", self.width, self.height, self.bit_depth, self.color_type, 0, 0, 0)
         self.write_chunk(b"IHDR", data)
 
+    def write_plte(self):
+        """Writes the PLTE chunk and, if the palette has translucent colors, the tRNS chunk to the stream. Nothing is
+        written unless the color type is PALETTE."""
+        if self.color_type != PALETTE:
+            return
+
+        self.write_chunk(b"PLTE", b"".join(color[:3] for color in self.palette))
+
+        if self.channels == 4:
+            alphas = bytes(color[3] for color in self.palette).rstrip(b"\xff")
+
+            if alphas:
+                self.write_chunk(b"tRNS", alphas)
+
     def write_actl(self, num_frames, num_plays):
         """Writes a fcTL chunk to the stream. This chunk is used in APNGs for defining how many frames the animation
         has and how many times it should loop.
@@ -46,17 +486,32 @@ class PngWriter(object):
         data = pack("!2I", num_frames, num_plays)
         self.write_chunk(b"acTL", data)
 
-    def write_fctl(self, seq, delay_num, delay_den):
+    def write_fctl(self, seq, delay_num, delay_den, width=None, height=None, x_offset=0, y_offset=0, dispose_op=0,
+                   blend_op=0):
         """Writes a fcTL chunk to the stream. This chunk is responsible for defining how frame ``seq`` should be
-        displayed in an APNG file. As this class does not support using smaller images as frames, frames are always
-        overlaid over the previous frame. The delay is specified as a fraction.
+        displayed in an APNG file. By default, frames cover the whole image and are overlaid over the previous frame.
+        The delay is specified as a fraction.
 
         @param int seq: The sequence number of the frame that this fcTL chunk describes.
         @param int delay_num: The numerator for the fraction representing the frame's delay.
         @param int delay_den: The denominator for the fraction representing the frame's delay.
+        @param int width: The width of the frame's region. Defaults to the image width (optional).
+        @param int height: The height of the frame's region. Defaults to the image height (optional).
+        @param int x_offset: The x coordinate of the frame's region (optional).
+        @param int y_offset: The y coordinate of the frame's region (optional).
+        @param int dispose_op: How the region is disposed of before the next frame: 0 leaves it as is, 1 clears it to
+                               transparent black, 2 restores the previous contents (optional).
+        @param int blend_op: 0 replaces the region with the frame, 1 alpha-blends the frame over it (optional).
         """
+        width = self.width if width is None else width
+        height = self.height if height is None else height
+
+        if width <= 0 or height <= 0 or x_offset < 0 or y_offset < 0 \
+                or x_offset + width > self.width or y_offset + height > self.height:
+            raise ValueError("The frame region does not fit into the image.")
+
         # See: https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
-        data = pack("!5I2H2B", seq, self.width, self.height, 0, 0, delay_num, delay_den, 0, 0)
+        data = pack("!5I2H2B", seq, width, height, x_offset, y_offset, delay_num, delay_den, dispose_op, blend_op)
         self.write_chunk(b"fcTL", data)
 
     def write_idat(self, image):
@@ -67,6 +522,45 @@ class PngWriter(object):
         """
         self.write_chunk(b"IDAT", self.process_image_data(image))
 
+    def write_idat_rows(self, rows):
+        """Writes IDAT chunks for an image that is passed as an iterable of scanlines.
+
+        Each scanline is filtered against the previous one and fed to the compressor as soon as it arrives. Compressed
+        data is written out in IDAT chunks of at most ``self.chunk_size`` bytes, so only a few scanlines and one chunk
+        are held in memory at any time.
+
+        @param rows: An iterable yielding self.height scanlines of self.width pixels. Pixels consist of three bytes
+                     specifying a 24-bit RGB color.
+        @type rows: iterable of bytes
+        """
+        self.write_idat_pieces(self.compress_rows(rows))
+
+    def write_idat_filtered(self, filtered_rows):
+        """Writes IDAT chunks for an image whose scanlines have already been filtered, e.g. by ``filter_scanline``.
+
+        @param filtered_rows: An iterable yielding self.height filtered scanlines, each including its filter type byte.
+        @type filtered_rows: iterable of bytes
+        """
+        self.write_idat_pieces(self.compress_filtered(filtered_rows))
+
+    def write_idat_pieces(self, pieces):
+        """Writes a zlib stream that is passed piece by piece as IDAT chunks of at most ``self.chunk_size`` bytes.
+
+        @param pieces: An iterable yielding consecutive pieces of the zlib stream.
+        @type pieces: iterable of bytes
+        """
+        pending = bytearray()
+
+        for piece in pieces:
+            pending.extend(piece)
+
+            while len(pending) >= self.chunk_size:
+                self.write_chunk(b"IDAT", bytes(pending[:self.chunk_size]))
+                del pending[:self.chunk_size]
+
+        for i in range(0, len(pending), self.chunk_size):
+            self.write_chunk(b"IDAT", bytes(pending[i:i + self.chunk_size]))
+
     def write_fdat(self, seq, image):
         """Writes a fdAT chunk to the stream. The passed data object is automatically filtered and compressed.
 
@@ -86,6 +580,10 @@ class PngWriter(object):
         @param bytes type: The chunk type identifier (e.g. b"IHDR").
         @param bytes data: The data to be stored in this chunk (optional).
         """
+        stats = instrumentation.active()
+        if stats is not None:
+            started = perf_counter()
+
         head = pack("!I4s", len(data), type)
         self.stream.write(head)
         self.stream.write(data)
@@ -94,15 +592,28 @@ class PngWriter(object):
         tail = pack("!I", crc32(data, crc32(type)))
         self.stream.write(tail)
 
+        if stats is not None:
+            stats.add_time("write", perf_counter() - started)
+            stats.count("chunks_written")
+            stats.count("bytes_written", len(data) + 12)
+
     def write_image(self, image):
         """Convenience method to quickly write a valid PNG image.
 
-        @param bytes image: A bytes object containing self.height * self.width pixels. Pixels consist of three bytes
-                            specifying a 24-bit RGB color.
+        @param image: A bytes object containing self.height * self.width pixels. Pixels consist of three bytes
+                      specifying a 24-bit RGB color. Alternatively, an iterable of scanlines can be passed, which
+                      is encoded as it is consumed (see ``write_idat_rows``).
+        @type image: bytes or iterable of bytes
         """
         self.write_signature()
         self.write_ihdr()
-        self.write_idat(image)
+        self.write_plte()
+
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            self.write_idat(image)
+        else:
+            self.write_idat_rows(image)
+
         self.write_iend()
 
     def process_image_data(self, image):
@@ -112,42 +623,330 @@ class PngWriter(object):
                             specifying a 24-bit RGB color.
         @return bytes: The filtered and compressed data.
         """
-        if len(image) != self.width * self.height * 3:
+        stride = self.width * self.channels
+
+        if len(image) != self.height * stride:
             raise ValueError("Passed data object does not contain %d x %d pixels." % (self.width, self.height))
 
-        # To encode a PNG image, the image first needs to be split up into scanlines for filtering purposes.
-        # A filtering mode must be specified for each scanline, so we extract the scanlines first.
-        scanlines = [image[i:i + self.width * 3] for i in range(0, self.width * self.height * 3, self.width * 3)]
-        processed = []
-
-        if self.dynamic_filtering:
-            # Apply dynamic filtering.
-            # We use the "minimum sum of absolute differences" heuristic for each scanline to determine the most
-            # the filter that allows best compression. See here: http://www.libpng.org/pub/png/book/chapter09.html
-            filters = [self.none_filter, self.sub_filter, self.up_filter, self.average_filter, self.paeth_filter]
-            min_sum_of_abs_diff = lambda line: reduce(lambda x, y: x + abs(c_byte(y).value), line[1:])
-
-            for i in range(self.height):
-                line = scanlines[i]
-                previous_line = None if i == 0 else scanlines[i - 1]
-
-                results = []
-                for filter_ in filters:
-                    processed_line = filter_(line, previous_line)
-                    score = min_sum_of_abs_diff(processed_line)
-                    results.append((processed_line, score))
-
-                # Sort results by the sum, asc. The filtered line with the lowest sum of absolute differences is picked.
-                ranking = sorted(results, key=lambda t: t[1])
-                processed.append(ranking[0][0])
-        else:
-            for i in range(self.height):
-                line = scanlines[i]
-                previous_line = None if i == 0 else scanlines[i - 1]
-                processed.append(self.paeth_filter(line, previous_line))
+        if self.parallel or self.preset.filter_policy in TRIAL_POLICIES:
+            return b"".join(self.compress_rows(image[i:i + stride] for i in range(0, len(image), stride)))
+
+        if self.converts:
+            image = b"".join(map(self.convert_row, (image[i:i + stride] for i in range(0, len(image), stride))))
+
+        # To encode a PNG image, every scanline gets filtered, each one with its own filter type byte. The filter
+        # engine processes the whole image in one go.
+        stats = instrumentation.active()
+        if stats is not None:
+            started = perf_counter()
+
+        filter_type = self.preset.filter_type if self.preset.filter_policy == FIXED else None
+        filtered = filters.filter_image(bytes(image), self.stride, self.bpp, filter_type)
+
+        if stats is not None:
+            stats.add_time("filter", perf_counter() - started)
+            stats.count("rows_filtered", self.height)
+            stats.record_filters(filtered[::self.stride + 1])
+            started = perf_counter()
+
+        # Compress the filtered scanlines.
+        compressor = self.preset.compressobj()
+        data = compressor.compress(filtered) + compressor.flush()
+
+        if stats is not None:
+            stats.add_time("compress", perf_counter() - started)
+            stats.count("filtered_bytes", len(filtered))
+            stats.count("compressed_bytes", len(data))
+
+        return data
+
+    @property
+    def parallel(self):
+        """Whether image data is filtered and compressed in parallel strips."""
+        return self.workers > 1 or self.executor is not None
+
+    def compress_rows(self, rows):
+        """Filters and compresses an iterable of scanlines, yielding the zlib stream piece by piece.
+
+        @param rows: An iterable yielding self.height scanlines of self.width pixels each.
+        @type rows: iterable of bytes
+        @return generator: The pieces of the zlib stream, in order.
+        """
+        if self.parallel:
+            yield from self.compress_rows_parallel(rows)
+            return
+
+        if self.preset.filter_policy == BEST:
+            yield self.compress_best(rows)
+            return
+
+        if self.preset.filter_policy != BRUTE_FORCE:
+            yield from self.compress_filtered(self.filter_rows(rows))
+            return
+
+        # Trial compressions need to see the real compressor state, so filtering is done right here.
+        compressor = self.preset.compressobj()
+        previous_line = None
+        stats = instrumentation.active()
+
+        for line in self.checked_rows(rows):
+            if stats is None:
+                yield compressor.compress(brute_force_filter(compressor, line, previous_line, self.bpp))
+            else:
+                started = perf_counter()
+                filtered = brute_force_filter(compressor, line, previous_line, self.bpp)
+                stats.add_time("filter", perf_counter() - started)
+                stats.count("rows_filtered")
+                stats.record_filters(filtered[:1])
+                yield self.compress_piece(compressor, filtered, stats)
+
+            previous_line = line
+
+        yield compressor.flush() if stats is None else self.compress_piece(compressor, None, stats)
+
+    def compress_best(self, rows):
+        """Compresses an iterable of scanlines with both the BRUTE_FORCE and the HEURISTIC policy at the same time and
+        returns the smaller zlib stream. Both streams are held in memory until the image is done.
+
+        @param rows: An iterable yielding self.height scanlines of self.width pixels each.
+        @type rows: iterable of bytes
+        @return bytes: The zlib stream.
+        """
+        trial, heuristic = self.preset.compressobj(), self.preset.compressobj()
+        trial_data, heuristic_data = [], []
+        trial_filters, heuristic_filters = bytearray(), bytearray()
+        filtered_bytes = 0
+        previous_line = None
+        stats = instrumentation.active()
+
+        if stats is not None:
+            started = perf_counter()
+
+        for line in self.checked_rows(rows):
+            filtered = brute_force_filter(trial, line, previous_line, self.bpp)
+            trial_data.append(trial.compress(filtered))
+            trial_filters.append(filtered[0])
+
+            filtered = filters.filter_scanline(line, previous_line, self.bpp)
+            heuristic_data.append(heuristic.compress(filtered))
+            heuristic_filters.append(filtered[0])
+
+            filtered_bytes += len(filtered)
+            previous_line = line
+
+        trial_data = b"".join(trial_data) + trial.flush()
+        heuristic_data = b"".join(heuristic_data) + heuristic.flush()
+        data, chosen = min((trial_data, trial_filters), (heuristic_data, heuristic_filters), key=lambda c: len(c[0]))
+
+        if stats is not None:
+            # Filtering and compressing are interleaved here, so they are timed together as filtering.
+            stats.add_time("filter", perf_counter() - started)
+            stats.count("rows_filtered", len(chosen))
+            stats.record_filters(bytes(chosen))
+            stats.count("filtered_bytes", filtered_bytes)
+            stats.count("compressed_bytes", len(data))
+
+        return data
+
+    def compress_filtered(self, filtered_rows):
+        """Compresses an iterable of filtered scanlines, yielding the zlib stream piece by piece.
+
+        @param filtered_rows: An iterable yielding filtered scanlines, each including its filter type byte.
+        @type filtered_rows: iterable of bytes
+        @return generator: The pieces of the zlib stream, in order.
+        """
+        compressor = self.preset.compressobj()
+        stats = instrumentation.active()
 
-        # Merge the filtered scanlines, then compress them.
-        return compress(b"".join(processed), 9)
+        if stats is None:
+            for filtered in filtered_rows:
+                yield compressor.compress(filtered)
+
+            yield compressor.flush()
+            return
+
+        for filtered in filtered_rows:
+            yield self.compress_piece(compressor, filtered, stats)
+
+        yield self.compress_piece(compressor, None, stats)
+
+    def compress_piece(self, compressor, filtered, stats):
+        """Feeds filtered data to a compressor while instrumentation is active, recording the time and sizes.
+
+        @param Compress compressor: The compressor.
+        @param filtered: The filtered data, or None to flush the compressor.
+        @type filtered: bytes or None
+        @param Stats stats: The Stats object to record the measurements in.
+        @return bytes: The compressed data.
+        """
+        started = perf_counter()
+        data = compressor.flush() if filtered is None else compressor.compress(filtered)
+        stats.add_time("compress", perf_counter() - started)
+        stats.count("filtered_bytes", 0 if filtered is None else len(filtered))
+        stats.count("compressed_bytes", len(data))
+        return data
+
+    def compress_rows_parallel(self, rows):
+        """Filters and compresses an iterable of scanlines in parallel, yielding the zlib stream piece by piece.
+
+        The image is cut into horizontal strips, which are filtered and deflated independently on the executor, in
+        the style of pigz. Each strip is compressed with the filtered data preceding it as preset dictionary and ends
+        with a sync flush, so the strips can be concatenated into a single deflate stream that compresses almost as
+        well as a serial one. The Adler-32 checksum of the whole stream is computed as the strips come in.
+
+        @param rows: An iterable yielding self.height scanlines of self.width pixels each.
+        @type rows: iterable of bytes
+        @return generator: The pieces of the zlib stream, in order.
+        """
+        preset = self.preset
+        stride, bpp = self.stride, self.bpp
+        strip_height = max(1, STRIP_SIZE // (stride + 1))
+
+        executor = self.executor or ThreadPoolExecutor(self.workers)
+        filtering, deflating = deque(), deque()
+        window = b""
+        checksum = adler32(b"")
+        stats = instrumentation.active()
+
+        def start_deflate():
+            # Strips are deflated in order, because each one needs the filtered data before it as dictionary.
+            nonlocal window, checksum
+            filtered = filtering.popleft().result()
+
+            if stats is not None:
+                stats.count("rows_filtered", len(filtered) // (stride + 1))
+                stats.count("filtered_bytes", len(filtered))
+                stats.record_filters(filtered[::stride + 1])
+
+            deflating.append(instrumentation.submit(executor, deflate_strip, filtered, preset, window))
+            window = (window + filtered)[-WINDOW_SIZE:]
+            checksum = adler32(filtered, checksum)
+
+        try:
+            yield zlib_header(preset.level)
+
+            strip, prev_line = [], None
+
+            for line in self.checked_rows(rows):
+                strip.append(line)
+
+                if len(strip) == strip_height:
+                    filtering.append(instrumentation.submit(executor, filter_strip, b"".join(strip), prev_line, stride,
+                                                            bpp, preset))
+                    strip, prev_line = [], line
+
+                # Keep a bounded number of strips in flight, so memory stays capped for long images.
+                while len(filtering) > self.workers:
+                    start_deflate()
+                while deflating and (deflating[0].done() or len(deflating) > self.workers):
+                    yield self.deflated(deflating.popleft(), stats)
+
+            if strip:
+                filtering.append(instrumentation.submit(executor, filter_strip, b"".join(strip), prev_line, stride, bpp,
+                                                        preset))
+
+            while filtering:
+                start_deflate()
+            while deflating:
+                yield self.deflated(deflating.popleft(), stats)
+
+            # Terminate the deflate stream with an empty final block, then append the checksum.
+            yield preset.compressobj(raw=True).flush()
+            yield pack("!I", checksum)
+        finally:
+            for future in list(filtering) + list(deflating):
+                future.cancel()
+            if self.executor is None:
+                executor.shutdown()
+
+    def deflated(self, future, stats):
+        """Returns the result of a strip's deflate future, counting its size while instrumentation is active.
+
+        @param Future future: The future.
+        @param Stats stats: The Stats object, or None.
+        @return bytes: The raw deflate data of the strip.
+        """
+        data = future.result()
+
+        if stats is not None:
+            stats.count("compressed_bytes", len(data))
+
+        return data
+
+    def filter_rows(self, rows):
+        """Filters an iterable of scanlines, yielding each filtered scanline as soon as it is available.
+
+        @param rows: An iterable yielding self.height scanlines of self.width pixels each.
+        @type rows: iterable of bytes
+        @return generator: The filtered scanlines, each prefixed with its filter type byte.
+        """
+        previous_line = None
+        stats = instrumentation.active()
+
+        for line in self.checked_rows(rows):
+            if stats is None:
+                yield self.filter_scanline(line, previous_line)
+            else:
+                started = perf_counter()
+                filtered = self.filter_scanline(line, previous_line)
+                stats.add_time("filter", perf_counter() - started)
+                stats.count("rows_filtered")
+                stats.record_filters(filtered[:1])
+                yield filtered
+
+            previous_line = line
+
+    def checked_rows(self, rows):
+        """Passes through an iterable of scanlines, making sure that it contains exactly self.height scanlines of
+        self.width pixels each, and converts them to the color type of the PNG.
+
+        @param rows: An iterable of scanlines.
+        @type rows: iterable of bytes
+        @return generator: The converted scanlines.
+        """
+        stride = self.width * self.channels
+        count = 0
+
+        for line in rows:
+            if len(line) != stride:
+                raise ValueError("Passed scanline does not contain %d pixels." % self.width)
+            if count == self.height:
+                raise ValueError("Passed image contains more than %d scanlines." % self.height)
+
+            yield self.convert_row(line)
+            count += 1
+
+        if count != self.height:
+            raise ValueError("Passed image contains %d instead of %d scanlines." % (count, self.height))
+
+    def filter_key(self):
+        """Returns a key that identifies how this writer filters scanlines, so filtered scanlines can be cached and
+        reused by other writers with the same key.
+
+        @return tuple: The key, or None if scanlines can't be filtered ahead of compression with this writer's
+                       settings.
+        """
+        if self.parallel or self.preset.filter_policy in TRIAL_POLICIES:
+            return None
+
+        palette = b"".join(self.palette) if self.palette else None
+        return (self.preset.filter_policy, self.preset.filter_type if self.preset.filter_policy == FIXED else None,
+                self.channels, self.color_type, self.bit_depth, palette)
+
+    def filter_scanline(self, line, previous_line=None):
+        """Filters a single scanline, picking the filter function according to the preset's filter policy. As trial
+        compression needs a compressor, the BRUTE_FORCE and BEST policies fall back to the heuristic here.
+
+        @param bytes line: The scanline to process, already converted by ``convert_row``.
+        @param previous_line: The previous scanline, or None if ``line`` is the first scanline.
+        @type previous_line: bytes or None
+        @return bytes: The filtered scanline, which will be one byte longer than ``line``.
+        """
+        # With a fixed filter policy, the same filter is used throughout. Otherwise, we use the "minimum sum of
+        # absolute differences" heuristic for each scanline to determine the filter that allows best compression.
+        # See here: http://www.libpng.org/pub/png/book/chapter09.html
+        filter_type = self.preset.filter_type if self.preset.filter_policy == FIXED else None
+        return filters.filter_scanline(line, previous_line, self.bpp, filter_type)
 
     def none_filter(self, scanline, prev_scanline=None):
         """Filters the given scanline using the None filter function. The filter type byte is automatically added.
@@ -157,12 +956,7 @@ class PngWriter(object):
         @type prev_scanline: bytes or None
         @return bytes: The new scanline, which will be one byte longer than ``scanline``.
         """
-
-        new_scanline = bytearray()
-        new_scanline.append(0)
-        new_scanline.extend(scanline)
-
-        return bytes(new_scanline)
+        return filters.none_filter(scanline, prev_scanline, self.bpp)
 
     def sub_filter(self, scanline, prev_scanline=None):
         """Filters the given scanline using the Sub filter function. The filter type byte is automatically added.
@@ -172,15 +966,7 @@ class PngWriter(object):
         @type prev_scanline: bytes or None
         @return bytes: The new scanline, which will be one byte longer than ``scanline``.
         """
-
-        new_scanline = bytearray(1 + len(scanline))
-        new_scanline[0] = 1
-
-        for i, x in enumerate(scanline):
-            a = 0 if i < 3 else scanline[i - 3]
-            new_scanline[i + 1] = (x - a) % 256
-
-        return bytes(new_scanline)
+        return filters.sub_filter(scanline, prev_scanline, self.bpp)
 
     def up_filter(self, scanline, prev_scanline=None):
         """Filters the given scanline using the Up filter function. The filter type byte is automatically added.
@@ -190,15 +976,7 @@ class PngWriter(object):
         @type prev_scanline: bytes or None
         @return bytes: The new scanline, which will be one byte longer than ``scanline``.
         """
-
-        new_scanline = bytearray(1 + len(scanline))
-        new_scanline[0] = 2
-
-        for i, x in enumerate(scanline):
-            b = prev_scanline[i] if prev_scanline else 0
-            new_scanline[i + 1] = (x - b) % 256
-
-        return bytes(new_scanline)
+        return filters.up_filter(scanline, prev_scanline, self.bpp)
 
     def average_filter(self, scanline, prev_scanline=None):
         """Filters the given scanline using the Average filter function. The filter type byte is automatically added.
@@ -208,17 +986,7 @@ class PngWriter(object):
         @type prev_scanline: bytes or None
         @return bytes: The new scanline, which will be one byte longer than ``scanline``.
         """
-
-        new_scanline = bytearray(1 + len(scanline))
-        new_scanline[0] = 3
-
-        for i, x in enumerate(scanline):
-            a = 0 if i < 3 else scanline[i - 3]
-            b = prev_scanline[i] if prev_scanline else 0
-            avg = floor((a + b) / 2)
-            new_scanline[i + 1] = (x - avg) % 256
-
-        return bytes(new_scanline)
+        return filters.average_filter(scanline, prev_scanline, self.bpp)
 
     def paeth_filter(self, scanline, prev_scanline):
         """Filters the given scanline using the Paeth filter function. The filter type byte is automatically added.
@@ -228,39 +996,4 @@ class PngWriter(object):
         @type prev_scanline: bytes or None
         @return bytes: The new scanline, which will be one byte longer than ``scanline``.
         """
-
-        new_scanline = bytearray(1 + len(scanline))
-        new_scanline[0] = 4
-
-        for i, x in enumerate(scanline):
-            # Determine the values of corresponding bytes surrounding our byte x.
-            # The corresponding byte is always offset by the count of bytes per pixel because we only want to look at
-            # at bytes for the same color.
-            # So if we are dealing with a red pixel, a, b, c are arranged around x as follows:  c.. b..
-            #                                                                                   a.. x..
-
-            a = 0 if i < 3 else scanline[i - 3]
-
-            if prev_scanline:
-                b = prev_scanline[i]
-                c = 0 if i < 3 else prev_scanline[i - 3]
-            else:
-                b, c = 0, 0
-
-            # Do Paeth filtering for x, saving the predictor in pr.
-            p = a + b - c
-            pa = abs(p - a)
-            pb = abs(p - b)
-            pc = abs(p - c)
-
-            if pa <= pb and pa <= pc:
-                pr = a
-            elif pb <= pc:
-                pr = b
-            else:
-                pr = c
-
-            # We want to insert the new x after the filter type byte, hence offset 1.
-            new_scanline[i + 1] = (x - pr) % 256
-
-        return bytes(new_scanline)
+        return filters.paeth_filter(scanline, prev_scanline, self.bpp)
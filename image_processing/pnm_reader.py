@@ -0,0 +1,158 @@
+from image_processing.canvas import Canvas, RgbaColor
+
+
+# The number of channels for each PAM tuple type.
+TUPLE_TYPES = {b"GRAYSCALE": 1, b"GRAYSCALE_ALPHA": 2, b"RGB": 3, b"RGB_ALPHA": 4}
+
+
+class PnmReader(object):
+    """PnmReader is a class that allows you to decode binary PGM (P5), PPM (P6) and PAM (P7) files.
+
+    The pixel data is read one row at a time, so only a single row is held in memory while reading. Samples with a
+    maxval other than 255, including 16-bit samples, are scaled to 8 bits.
+    """
+
+    def __init__(self, stream):
+        """Creates a new PnmReader object and reads the header.
+
+        @param BytesIO stream: The stream to read the image from.
+        """
+        self.stream = stream
+
+        magic = stream.read(2)
+
+        if magic in (b"P5", b"P6"):
+            self.width, self.height, self.maxval = self.read_numbers(3)
+            self.channels = 1 if magic == b"P5" else 3
+        elif magic == b"P7":
+            self.read_pam_header()
+        else:
+            raise ValueError("The stream does not contain a binary PGM, PPM or PAM image.")
+
+        if self.width <= 0 or self.height <= 0:
+            raise ValueError("Width and height must be positive and non-zero.")
+        if not 0 < self.maxval < 65536:
+            raise ValueError("maxval must be within the range 1 to 65535 inclusive.")
+
+        self.sample_size = 1 if self.maxval < 256 else 2
+
+    def read_token(self):
+        """Reads the next whitespace-separated header token, skipping comments. The single whitespace character that
+        ends the token is consumed too.
+
+        @return bytes: The token.
+        """
+        token = b""
+
+        while True:
+            c = self.stream.read(1)
+
+            if not c:
+                if token:
+                    return token
+                raise ValueError("Unexpected end of the PNM header.")
+            if c == b"#" and not token:
+                self.stream.readline()
+            elif c.isspace():
+                if token:
+                    return token
+            else:
+                token += c
+
+    def read_numbers(self, count):
+        """Reads the given number of integers from the header.
+
+        @param int count: The number of integers.
+        @return list: The integers.
+        """
+        tokens = [self.read_token() for _ in range(count)]
+
+        if not all(token.isdigit() for token in tokens):
+            raise ValueError("Invalid PNM header.")
+
+        return [int(token) for token in tokens]
+
+    def read_pam_header(self):
+        """Reads the header lines of a PAM image, up to and including ENDHDR."""
+        fields = {}
+
+        while True:
+            line = self.stream.readline()
+
+            if not line:
+                raise ValueError("Unexpected end of the PAM header.")
+
+            words = line.split(b"#", 1)[0].split()
+
+            if not words:
+                continue
+            if words[0] == b"ENDHDR":
+                break
+            if words[0] == b"TUPLTYPE":
+                fields[b"TUPLTYPE"] = b" ".join(words[1:])
+            elif len(words) == 2 and words[1].isdigit():
+                fields[words[0]] = int(words[1])
+            else:
+                raise ValueError("Invalid PAM header line %r." % line)
+
+        for name in (b"WIDTH", b"HEIGHT", b"DEPTH", b"MAXVAL"):
+            if name not in fields:
+                raise ValueError("The PAM header does not contain %s." % name.decode("ascii"))
+
+        self.width, self.height, self.maxval = fields[b"WIDTH"], fields[b"HEIGHT"], fields[b"MAXVAL"]
+        self.channels = fields[b"DEPTH"]
+
+        if self.channels not in (1, 2, 3, 4):
+            raise ValueError("Only PAM images with a depth of 1 to 4 are supported.")
+        if b"TUPLTYPE" in fields and TUPLE_TYPES.get(fields[b"TUPLTYPE"], self.channels) != self.channels:
+            raise ValueError("The PAM tuple type does not match its depth.")
+
+    def rows(self):
+        """Yields the rows of the image as 8-bit samples, ``self.channels`` per pixel.
+
+        @return generator: The rows, ``self.width * self.channels`` bytes each.
+        """
+        size = self.width * self.channels * self.sample_size
+        maxval = self.maxval
+
+        if self.sample_size == 1 and maxval != 255:
+            scale = bytes(min(255, (v * 255 + maxval // 2) // maxval) for v in range(256))
+
+        for _ in range(self.height):
+            data = self.stream.read(size)
+
+            if len(data) != size:
+                raise ValueError("The PNM image data is truncated.")
+
+            if self.sample_size == 2:
+                data = bytes(min(255, ((hi << 8 | lo) * 255 + maxval // 2) // maxval)
+                             for hi, lo in zip(data[0::2], data[1::2]))
+            elif maxval != 255:
+                data = data.translate(scale)
+
+            yield data
+
+    def read_into(self, canvas):
+        """Decodes the image into an existing canvas, row by row. The canvas must be as large as the image.
+
+        @param Canvas canvas: The canvas.
+        """
+        if canvas.width != self.width or canvas.height != self.height:
+            raise ValueError("The canvas must be %d x %d pixels." % (self.width, self.height))
+
+        for y, line in enumerate(self.rows()):
+            canvas.import_row(y, line, self.channels)
+
+    def to_canvas(self, bgcolor=None):
+        """Decodes the image into a new Canvas.
+
+        @param RgbaColor bgcolor: The background color of the canvas. Defaults to opaque black for images without
+                                  alpha and transparent black otherwise (optional).
+        @return Canvas: The canvas.
+        """
+        if bgcolor is None:
+            bgcolor = RgbaColor(0, 0, 0, 0 if self.channels in (2, 4) else 1)
+
+        canvas = Canvas(self.width, self.height, bgcolor)
+        self.read_into(canvas)
+        return canvas
@@ -0,0 +1,344 @@
+"""Separable resampling of images in the layout of ``Canvas.pixels``.
+
+Images are resized with a horizontal and a vertical pass. Each pass works on whole rows with C-level ``map`` calls:
+the vertical pass adds up weighted source rows, the horizontal pass gathers the source samples of each tap through a
+precomputed index table. Resampled rows are held as lists of floats, which ``map`` iterates about twice as fast as
+arrays. Weight tables depend only on the source size, the target size and the filter, so they are
+computed once and reused by later resizes of the same size.
+
+When downscaling, the filters are stretched by the scale factor, so every source pixel contributes to the result.
+Translucent images are resampled with premultiplied alpha, so transparent pixels don't darken their neighbors.
+"""
+from array import array
+from functools import lru_cache
+from itertools import repeat
+from math import pi, sin
+from operator import add, mul, truediv
+
+
+# Resampling filters.
+NEAREST, BOX, BILINEAR, LANCZOS = "nearest", "box", "bilinear", "lanczos"
+
+# The number of weight tables kept per pass.
+WEIGHT_CACHE_SIZE = 32
+
+
+def box_kernel(x):
+    """The box filter: every sample within half a pixel counts the same."""
+    return 1. if -0.5 <= x < 0.5 else 0.
+
+
+def bilinear_kernel(x):
+    """The triangle filter behind bilinear interpolation."""
+    x = abs(x)
+    return 1. - x if x < 1. else 0.
+
+
+def lanczos_kernel(x):
+    """The Lanczos filter with three lobes, a windowed sinc function."""
+    if x == 0.:
+        return 1.
+    if -3. < x < 3.:
+        return 3. * sin(pi * x) * sin(pi * x / 3.) / (pi * pi * x * x)
+    return 0.
+
+
+# Maps filters to their kernel function and support, i.e. the radius outside of which the kernel is zero.
+KERNELS = {BOX: (box_kernel, 0.5), BILINEAR: (bilinear_kernel, 1.), LANCZOS: (lanczos_kernel, 3.)}
+
+
+@lru_cache(maxsize=WEIGHT_CACHE_SIZE)
+def weights(src_size, dst_size, filter):
+    """Computes the weights of the source samples for every target sample along one axis.
+
+    @param int src_size: The number of source samples.
+    @param int dst_size: The number of target samples.
+    @param str filter: The filter: NEAREST, BOX, BILINEAR or LANCZOS.
+    @return tuple: A ``(start, weights)`` tuple for every target sample, where ``weights`` is a tuple of the weights
+                   of the source samples from ``start`` on. The weights add up to 1.
+    """
+    scale = src_size / dst_size
+
+    if filter == NEAREST:
+        return tuple((min(int((i + 0.5) * scale), src_size - 1), (1.,)) for i in range(dst_size))
+
+    kernel, support = KERNELS[filter]
+    filter_scale = max(scale, 1.)
+    support *= filter_scale
+    table = []
+
+    for i in range(dst_size):
+        center = (i + 0.5) * scale
+        # Take every sample whose center lies within the support, including those right on its edges: the box
+        # filter counts the sample on its left edge.
+        start = max(int(center - support - 0.5), 0)
+        end = min(int(center + support + 0.5) + 1, src_size)
+        ws = [kernel((j + 0.5 - center) / filter_scale) for j in range(start, end)]
+
+        # Drop the zero weights at both ends, which the kernels produce at the edges of their support.
+        while len(ws) > 1 and ws[-1] == 0.:
+            ws.pop()
+        while len(ws) > 1 and ws[0] == 0.:
+            ws.pop(0)
+            start += 1
+
+        total = sum(ws)
+        table.append((start, tuple(w / total for w in ws) if total else (1.,)))
+
+    return tuple(table)
+
+
+@lru_cache(maxsize=WEIGHT_CACHE_SIZE)
+def gather_table(src_width, dst_width, filter):
+    """Turns the weights of a horizontal pass into one gather step per tap, working on all four channels of a row.
+
+    @param int src_width: The width of the source rows.
+    @param int dst_width: The width of the target rows.
+    @param str filter: The filter.
+    @return list: An ``(indices, weights)`` tuple for every tap. ``indices`` holds, for every float of a target row,
+                  the index of the source float it takes from the tap and ``weights`` its weight. Target pixels with
+                  fewer taps get a weight of 0 for the remaining ones.
+    """
+    table = weights(src_width, dst_width, filter)
+    taps = max(len(ws) for _, ws in table)
+    steps = []
+
+    for k in range(taps):
+        indices, tap_weights = [], []
+
+        for start, ws in table:
+            pixel = (start + min(k, len(ws) - 1)) * 4
+            indices += (pixel, pixel + 1, pixel + 2, pixel + 3)
+            tap_weights += repeat(ws[k] if k < len(ws) else 0., 4)
+
+        steps.append((indices, tap_weights))
+
+    return steps
+
+
+def resample_horizontally(rows, src_width, dst_width, filter):
+    """Resamples every row to a new width.
+
+    @param list rows: The rows, as lists of floats or ``array("d")`` objects in the layout of ``Canvas.pixels``.
+    @param int src_width: The width of the rows.
+    @param int dst_width: The new width.
+    @param str filter: The filter.
+    @return list: The resampled rows.
+    """
+    steps = gather_table(src_width, dst_width, filter)
+    resampled = []
+
+    for row in rows:
+        get = row.__getitem__
+
+        if filter == NEAREST:
+            resampled.append(list(map(get, steps[0][0])))
+            continue
+
+        total = None
+        for indices, tap_weights in steps:
+            terms = map(mul, map(get, indices), tap_weights)
+            total = terms if total is None else map(add, total, terms)
+
+        resampled.append(list(total))
+
+    return resampled
+
+
+def resample_vertically(rows, dst_height, filter):
+    """Resamples a list of rows to a new number of rows.
+
+    @param list rows: The rows, as lists of floats or ``array("d")`` objects in the layout of ``Canvas.pixels``.
+    @param int dst_height: The new number of rows.
+    @param str filter: The filter.
+    @return list: The resampled rows.
+    """
+    resampled = []
+
+    for start, ws in weights(len(rows), dst_height, filter):
+        if filter == NEAREST:
+            resampled.append(rows[start])
+            continue
+
+        total = None
+        for row, w in zip(rows[start:start + len(ws)], ws):
+            terms = map(mul, row, repeat(w))
+            total = terms if total is None else map(add, total, terms)
+
+        resampled.append(list(total))
+
+    return resampled
+
+
+def box_reduce(rows, factor_x, factor_y):
+    """Shrinks rows by integer factors, averaging each block of ``factor_x`` x ``factor_y`` pixels. This gives the
+    same result as the box filter, but needs neither weight tables nor index lookups.
+
+    @param list rows: The rows, as lists of floats or ``array("d")`` objects in the layout of ``Canvas.pixels``.
+    @param int factor_x: The horizontal factor. It must divide the width of the rows.
+    @param int factor_y: The vertical factor. It must divide the number of rows.
+    @return list: The reduced rows.
+    """
+    scale = repeat(1. / (factor_x * factor_y))
+    reduced = []
+
+    for y in range(0, len(rows), factor_y):
+        total = rows[y]
+        for row in rows[y + 1:y + factor_y]:
+            total = map(add, total, row)
+
+        total = list(total)
+        row = [0.] * (len(total) // factor_x)
+
+        for c in range(4):
+            samples = None
+            for j in range(factor_x):
+                part = total[j * 4 + c::factor_x * 4]
+                samples = part if samples is None else map(add, samples, part)
+
+            row[c::4] = list(map(mul, samples, scale))
+
+        reduced.append(row)
+
+    return reduced
+
+
+def premultiplied(row):
+    """Multiplies the colors of a row by their alpha values.
+
+    @param array row: The row, as an ``array("d")``.
+    @return list: The premultiplied row, as a list of floats.
+    """
+    row = row.tolist()
+    alphas = row[3::4]
+
+    for c in range(3):
+        row[c::4] = list(map(mul, row[c::4], alphas))
+
+    return row
+
+
+def unpremultiply(row):
+    """Divides the colors of a row by their alpha values, in place. Pixels with an alpha value of 0 become transparent
+    black.
+
+    @param list row: The row, as a list of floats.
+    """
+    alphas = row[3::4]
+    transparent = min(alphas) <= 0.
+
+    for c in range(3):
+        if transparent:
+            row[c::4] = [v / a if a > 0. else 0. for v, a in zip(row[c::4], alphas)]
+        else:
+            row[c::4] = list(map(truediv, row[c::4], alphas))
+
+
+def clamp(row):
+    """Clamps every value of a row to the range 0 to 1, in place.
+
+    @param list row: The row, as a list of floats.
+    """
+    if min(row) < 0. or max(row) > 1.:
+        row[:] = list(map(min, repeat(1.), map(max, repeat(0.), row)))
+
+
+def reduction_factor(src_size, dst_size, reducing_gap):
+    """Picks the factor to shrink an axis by with ``box_reduce`` before resampling it.
+
+    @param int src_size: The number of source samples.
+    @param int dst_size: The number of target samples.
+    @param float reducing_gap: How many times larger than the target the reduced axis must stay.
+    @return int: The largest divisor of ``src_size`` that keeps the axis at least that large, or 1.
+    """
+    limit = int(src_size / (dst_size * reducing_gap))
+    return next((d for d in range(limit, 1, -1) if src_size % d == 0), 1)
+
+
+def resize(image, width, height, filter=BILINEAR, reducing_gap=None):
+    """Resizes an image.
+
+    @param Canvas image: The image. Any image providing ``row_pixels`` works.
+    @param int width: The new width.
+    @param int height: The new height.
+    @param str filter: The filter: NEAREST, BOX, BILINEAR or LANCZOS (optional).
+    @param float reducing_gap: Speeds up large reductions by first shrinking the image by an integer factor with
+                               ``box_reduce``, as long as it stays at least ``reducing_gap`` times larger than the
+                               target. A gap of 2 or more gives results very close to resampling in one step. If
+                               omitted, the filter is applied to the full image (optional).
+    @return array: The pixels of the resized image, in the layout of ``Canvas.pixels``.
+    """
+    if filter != NEAREST and filter not in KERNELS:
+        raise ValueError("Unknown filter %r." % filter)
+    if width <= 0 or height <= 0:
+        raise ValueError("Width and height must be positive and non-zero.")
+    if reducing_gap is not None and reducing_gap < 1.:
+        raise ValueError("reducing_gap must be at least 1.")
+
+    src_width, src_height = image.width, image.height
+    size = src_width * 4
+    rows = []
+
+    for y in range(src_height):
+        pixels, s = image.row_pixels(y)
+        rows.append(pixels[s:s + size])
+
+    resized = array("d")
+
+    if width == src_width and height == src_height:
+        for row in rows:
+            resized.extend(row)
+        return resized
+
+    opaque = all(min(row[3::4]) >= 1. for row in rows)
+
+    fast_box = filter == BOX and src_width % width == 0 and src_height % height == 0
+    factor_x = factor_y = 1
+
+    if reducing_gap is not None and filter != NEAREST and not fast_box:
+        factor_x = reduction_factor(src_width, width, reducing_gap)
+        factor_y = reduction_factor(src_height, height, reducing_gap)
+
+    if filter != NEAREST and not opaque:
+        rows = [premultiplied(row) for row in rows]
+
+    if fast_box:
+        rows = box_reduce(rows, src_width // width, src_height // height)
+    else:
+        if factor_x > 1 or factor_y > 1:
+            rows = box_reduce(rows, factor_x, factor_y)
+            src_width, src_height = src_width // factor_x, src_height // factor_y
+        elif filter != NEAREST and opaque:
+            # The filters read every source sample several times, which is faster from lists.
+            rows = [row.tolist() for row in rows]
+
+        # Run the cheaper order of passes. A horizontal tap costs a lookup, a multiplication and an addition per
+        # target sample, a vertical one only the latter two.
+        taps_x = max(len(ws) for _, ws in weights(src_width, width, filter))
+        taps_y = max(len(ws) for _, ws in weights(src_height, height, filter))
+        horizontal_first = 3 * src_height * width * taps_x + 2 * height * width * taps_y \
+            <= 2 * height * src_width * taps_y + 3 * height * width * taps_x
+
+        if horizontal_first and width != src_width:
+            rows = resample_horizontally(rows, src_width, width, filter)
+        if height != src_height:
+            rows = resample_vertically(rows, height, filter)
+        if not horizontal_first and width != src_width:
+            rows = resample_horizontally(rows, src_width, width, filter)
+
+    for row in rows:
+        # Nearest neighbor rows may still be source rows, but only hold copied source values anyway.
+        if filter != NEAREST:
+            # Lanczos overshoots near edges, so the values need clamping, also after dividing by alpha.
+            if filter == LANCZOS:
+                clamp(row)
+            if opaque:
+                row[3::4] = [1.] * width
+            else:
+                unpremultiply(row)
+                if filter == LANCZOS:
+                    clamp(row)
+
+        resized.extend(row)
+
+    return resized
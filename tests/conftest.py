@@ -0,0 +1,71 @@
+import pytest
+
+from image_processing.canvas import Canvas, RgbaColor
+from image_processing.font import Font
+
+
+def canvas_factory(width=12, height=8):
+    """Builds an opaque canvas with a translucent rectangle in it, so both opaque and blended pixels are covered."""
+    canvas = Canvas(width, height, RgbaColor(0.1, 0.2, 0.3, 1))
+    canvas.fill_rect(width // 6, height // 8, width // 2, height * 5 // 8, RgbaColor(0.9, 0.5, 0.1, 0.5))
+    return canvas
+
+
+def pattern_factory(width, height, opaque=False):
+    """Builds a canvas whose every pixel differs from its neighbours, with transparent, translucent and opaque
+    pixels unless ``opaque`` is set."""
+    canvas = Canvas(width, height, RgbaColor(0, 0, 0, 0))
+
+    for y in range(height):
+        for x in range(width):
+            a = 1. if opaque or (x + y) % 5 == 0 else ((x * 7 + y * 3) % 5) / 4
+            canvas.set(x, y, RgbaColor((x * 37 % 11) / 10, (y * 13 % 7) / 6, ((x + y) % 4) / 3, a))
+
+    return canvas
+
+
+def font_factory(**kwargs):
+    """Builds a font of two 4 x 5 glyphs, "a" and "b", with opaque and translucent pixels."""
+    font = Font(**kwargs)
+    glyphs = {}
+
+    for i, c in enumerate("ab"):
+        glyph = Canvas(4, 5, RgbaColor(0, 0, 0, 0))
+        glyph.fill_rect(i, 1, 2, 3, RgbaColor(1, 1, 1, 1))
+        glyph.set(3, 4, RgbaColor(0, 0, 1, 0.25))
+        glyphs[c] = glyph
+
+    font.load_glyphs(glyphs, 4, 5)
+    return font
+
+
+def frames_factory(count, width=24, height=12):
+    """Builds animation frames with an orange square moving right by two pixels per frame."""
+    frames = []
+
+    for i in range(count):
+        frame = Canvas(width, height, RgbaColor(0, 0, 0, 1))
+        frame.fill_rect(i * 2, 3, 5, 4, RgbaColor(1, 0.5, 0, 1))
+        frames.append(frame)
+
+    return frames
+
+
+@pytest.fixture
+def make_canvas():
+    return canvas_factory
+
+
+@pytest.fixture
+def make_pattern():
+    return pattern_factory
+
+
+@pytest.fixture
+def make_font():
+    return font_factory
+
+
+@pytest.fixture
+def make_frames():
+    return frames_factory
@@ -0,0 +1,198 @@
+import random
+import zlib
+from io import BytesIO
+from struct import unpack
+
+import pytest
+
+from image_processing import apng_writer, filters
+from image_processing.apng_writer import ApngWriter
+
+
+def reference(frames):
+    stream = BytesIO()
+    ApngWriter(stream, 24, 12, len(frames)).write_animation(frames)
+    return stream.getvalue()
+
+
+@pytest.mark.parametrize("kwargs", [{"workers": 3}, {"workers": 2, "queue_size": 1}])
+def test_parallel_matches_serial(make_frames, kwargs):
+    frames = make_frames(7)
+    stream = BytesIO()
+    writer = ApngWriter(stream, 24, 12, len(frames), **kwargs)
+    writer.write_frames(iter(frames))
+    writer.close()
+
+    assert stream.getvalue() == reference(frames)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_failing_generator_can_be_resumed(make_frames, workers):
+    frames = make_frames(8)
+
+    def produce():
+        yield from frames[:5]
+        raise RuntimeError("render failed")
+
+    stream = BytesIO()
+    writer = ApngWriter(stream, 24, 12, len(frames), workers=workers, queue_size=4)
+
+    with pytest.raises(RuntimeError):
+        writer.write_frames(produce())
+
+    assert writer.frames_read == writer.frames_written
+    writer.write_frames(frames[writer.frames_written:])
+    writer.close()
+
+    assert stream.getvalue() == reference(frames)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_failing_encoder_can_be_resumed(monkeypatch, make_frames, workers):
+    frames = make_frames(6)
+    encode_frame = apng_writer.encode_frame
+    calls = []
+
+    def fail_once(*args):
+        calls.append(args)
+        if len(calls) == 3:
+            raise MemoryError()
+        return encode_frame(*args)
+
+    monkeypatch.setattr(apng_writer, "encode_frame", fail_once)
+    stream = BytesIO()
+    writer = ApngWriter(stream, 24, 12, len(frames), workers=workers)
+
+    with pytest.raises(MemoryError):
+        writer.write_frames(frames)
+
+    assert writer.frames_written == writer.frames_read == 2
+    writer.write_frames(frames[2:])
+
+    assert stream.getvalue() == reference(frames)
+
+
+def test_close_rejects_incomplete_animations(make_frames):
+    frames = make_frames(3)
+    writer = ApngWriter(BytesIO(), 24, 12, len(frames))
+    writer.write_frames(frames[:2])
+
+    with pytest.raises(ValueError, match="2 of 3"):
+        writer.close()
+
+    writer.write_frame(frames[2])
+    writer.close()
+
+
+def read_chunks(data):
+    """Splits a PNG into its chunks, as (type, data) tuples."""
+    chunks, i = [], 8
+
+    while i < len(data):
+        length, type_ = unpack("!I4s", data[i:i + 8])
+        chunks.append((type_, data[i + 8:i + 8 + length]))
+        i += 12 + length
+
+    return chunks
+
+
+def decode_frames(data, width, height):
+    """Decodes every frame of an APNG written by ApngWriter, applying its fcTL regions in order.
+
+    @return list: ``(fctl, image)`` tuples, where ``fctl`` holds the unpacked fcTL fields and ``image`` is the
+                  composited frame as 24-bit RGB.
+    """
+    canvas = bytearray(width * height * 3)
+    frames, fctl, seqs = [], None, []
+
+    for type_, chunk in read_chunks(data):
+        if type_ == b"fcTL":
+            fctl = unpack("!5I2H2B", chunk)
+            seqs.append(fctl[0])
+            continue
+        if type_ not in (b"IDAT", b"fdAT"):
+            continue
+        if type_ == b"fdAT":
+            seqs.append(unpack("!I", chunk[:4])[0])
+            chunk = chunk[4:]
+
+        _, frame_width, frame_height, x, y = fctl[:5]
+        raw = zlib.decompress(chunk)
+        stride = frame_width * 3
+        previous = None
+
+        for row in range(frame_height):
+            line = raw[row * (stride + 1):(row + 1) * (stride + 1)]
+            previous = bytes(filters.unfilter_scanline(line[0], line[1:], previous, 3))
+            start = ((y + row) * width + x) * 3
+            canvas[start:start + stride] = previous
+
+        frames.append((fctl, bytes(canvas)))
+
+    assert seqs == list(range(len(seqs)))
+    return frames
+
+
+def test_frames_decode_to_their_canvases(make_frames):
+    frames = make_frames(5)
+    frames.insert(3, frames[2].copy())
+    stream = BytesIO()
+    ApngWriter(stream, 24, 12, len(frames)).write_animation(frames, 1, 20)
+
+    decoded = decode_frames(stream.getvalue(), 24, 12)
+    assert [image for _, image in decoded] == [frame.bytes() for frame in frames]
+
+    regions = [fctl[1:5] for fctl, _ in decoded]
+    # The square moves two pixels per frame, so each frame covers where it was and where it is now. The repeated
+    # frame changes nothing and is stored as a single pixel.
+    assert regions == [(24, 12, 0, 0), (7, 4, 0, 3), (7, 4, 2, 3), (1, 1, 0, 0), (7, 4, 4, 3), (7, 4, 6, 3)]
+    assert all(fctl[5:] == (1, 20, apng_writer.DISPOSE_NONE, apng_writer.BLEND_SOURCE) for fctl, _ in decoded)
+
+    chunks = [type_ for type_, _ in read_chunks(stream.getvalue())]
+    assert chunks[:4] == [b"IHDR", b"acTL", b"fcTL", b"IDAT"] and chunks[-1] == b"IEND"
+    assert chunks.count(b"fdAT") == len(frames) - 1
+
+
+def test_dirty_rect_of_identical_frames_is_one_pixel(make_frames):
+    frame = make_frames(1)[0]
+    writer = ApngWriter(BytesIO(), 24, 12, 2)
+    rows = list(frame.rows())
+
+    assert writer.dirty_rect(rows, list(rows)) == (0, 0, 1, 1)
+
+
+def naive_changed_span(a, b, bpp):
+    changed = [i for i in range(len(a) // bpp) if a[i * bpp:(i + 1) * bpp] != b[i * bpp:(i + 1) * bpp]]
+    return (changed[0], changed[-1] + 1) if changed else None
+
+
+@pytest.mark.parametrize("bpp", [1, 3, 4])
+def test_changed_span_matches_naive_scan(bpp):
+    rng = random.Random(bpp)
+    pixels = 17
+
+    for _ in range(200):
+        a = bytes(rng.randrange(4) for _ in range(pixels * bpp))
+        b = bytearray(a)
+
+        for _ in range(rng.randrange(4)):
+            b[rng.randrange(len(b))] = rng.randrange(4)
+
+        assert apng_writer.changed_span(a, bytes(b), bpp) == naive_changed_span(a, b, bpp)
+
+
+@pytest.mark.parametrize("bpp", [1, 3])
+def test_changed_span_at_the_edges(bpp):
+    a = bytes(range(10 * bpp))
+
+    def change(*indices):
+        b = bytearray(a)
+        for i in indices:
+            b[i] ^= 1
+        return bytes(b)
+
+    assert apng_writer.changed_span(a, a, bpp) is None
+    assert apng_writer.changed_span(a, change(0), bpp) == (0, 1)
+    assert apng_writer.changed_span(a, change(len(a) - 1), bpp) == (9, 10)
+    assert apng_writer.changed_span(a, change(0, len(a) - 1), bpp) == (0, 10)
+    assert apng_writer.changed_span(a, change(bpp * 4 + bpp - 1), bpp) == (4, 5)
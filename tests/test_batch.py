@@ -0,0 +1,151 @@
+from io import BytesIO
+
+import pytest
+
+from image_processing import batch
+from image_processing.batch import BatchRenderer, RenderJob, SharedImage
+from image_processing.canvas import Canvas, RgbaColor
+from image_processing.instrumentation import instrument
+
+
+@pytest.fixture
+def assets(make_canvas, make_font):
+    background = make_canvas(24, 16)
+
+    overlay = Canvas(8, 6, RgbaColor(0, 0, 0, 0))
+    overlay.fill_rect(1, 1, 4, 3, RgbaColor(0.1, 0.9, 0.2, 1))
+    overlay.fill_rect(3, 2, 4, 3, RgbaColor(1, 1, 1, 0.5))
+
+    return background, overlay, make_font()
+
+
+def make_jobs():
+    return [
+        RenderJob("background"),
+        RenderJob("background").blend("overlay", 2, 3).text("font", 1, 1, "ab\nba"),
+        RenderJob("background").blend("overlay", -3, 12, ignore_src_alpha=True).copy_rect(0, 0, 8, 8, 18, 10),
+        RenderJob("overlay").text("font", 0, 0, "a b"),
+    ]
+
+
+def render_serially(job, images, font, preset):
+    canvas = images[job.base].copy()
+
+    for operation in job.operations:
+        if operation[0] == "blend":
+            _, image, x, y, ignore_src_alpha = operation
+            canvas.blend(images[image], x, y, ignore_src_alpha)
+        elif operation[0] == "text":
+            _, _, x, y, text = operation
+            font.write(canvas, x, y, text)
+        else:
+            _, x, y, width, height, dest_x, dest_y = operation
+            canvas.blend(canvas.rect(x, y, width, height), dest_x, dest_y)
+
+    stream = BytesIO()
+    canvas.write_png(stream, preset)
+    return stream.getvalue()
+
+
+@pytest.mark.parametrize("preset", [None, "fastest"])
+def test_render_matches_serial_rendering(assets, preset):
+    background, overlay, font = assets
+    images = {"background": background, "overlay": overlay}
+
+    with BatchRenderer(workers=2, preset=preset) as renderer:
+        renderer.add_image("background", background)
+        renderer.add_image("overlay", overlay)
+        renderer.add_font("font", font)
+        results = renderer.render(make_jobs() * 2)
+
+    assert results == [render_serially(job, images, font, preset) for job in make_jobs() * 2]
+
+
+def test_render_writes_outputs(assets, tmp_path):
+    background, _, font = assets
+    path = str(tmp_path / "out.png")
+
+    with BatchRenderer(workers=1) as renderer:
+        renderer.add_image("background", background)
+        renderer.add_font("font", font)
+        assert renderer.render([RenderJob("background", path).text("font", 2, 2, "ab")]) == [path]
+
+    with open(path, "rb") as f:
+        assert f.read() == render_serially(RenderJob("background").text("font", 2, 2, "ab"),
+                                           {"background": background}, font, None)
+
+
+def test_unknown_assets_are_rejected(assets):
+    background, _, _ = assets
+
+    with BatchRenderer(workers=1) as renderer:
+        renderer.add_image("background", background)
+
+        with pytest.raises(ValueError):
+            renderer.render([RenderJob("missing")])
+        with pytest.raises(ValueError):
+            renderer.render([RenderJob("background").blend("missing")])
+        with pytest.raises(ValueError):
+            renderer.render([RenderJob("background").text("missing", 0, 0, "a")])
+
+
+def test_workers_read_assets_from_shared_memory(assets, monkeypatch):
+    background, _, font = assets
+    monkeypatch.setattr(batch, "worker_assets", {})
+
+    with BatchRenderer(workers=1) as renderer:
+        renderer.add_image("background", background)
+        renderer.add_font("font", font)
+        batch.attach_assets(renderer.images, renderer.fonts, None)
+
+        # Glyphs are bands of the shared block, not private copies.
+        glyph = batch.worker_assets["fonts"]["font"].charmap["b"]
+        assert isinstance(glyph, SharedImage)
+        assert glyph.memory is batch.worker_assets["fonts"]["font"].charmap["a"].memory
+        assert glyph.spans(2) == font.charmap["b"].spans(2)
+
+        # The template reads the shared block; a job's copy only copies the pixels on its first write.
+        template = batch.base_canvas("background")
+        assert isinstance(template.pixels, memoryview)
+        with pytest.raises(TypeError):
+            template.set(0, 0, RgbaColor(0, 0, 0, 1))
+
+        copy = template.copy()
+        assert copy.pixels is template.pixels
+        copy.set(0, 0, RgbaColor(0, 0, 0, 1))
+        assert copy.at(0, 0) == (0, 0, 0, 1)
+        assert template.at(0, 0) == background.at(0, 0)
+        assert copy.bytes()[3:] == background.bytes()[3:]
+
+        for glyph in batch.worker_assets["fonts"]["font"].charmap.values():
+            glyph.close()
+        glyph.owner.close()
+        batch.worker_assets["images"]["background"].close()
+
+
+@pytest.mark.parametrize("preset", [None, "fastest"])
+def test_jobs_only_export_the_rows_they_change(monkeypatch, preset):
+    # Black and white, so jobs that add white pixels keep exporting it as 1-bit grayscale.
+    gray = Canvas(16, 32, RgbaColor(0, 0, 0, 1))
+    gray.fill_rect(0, 8, 16, 8, RgbaColor(1, 1, 1, 1))
+    patch = Canvas(4, 3, RgbaColor(1, 1, 1, 1))
+    monkeypatch.setattr(batch, "worker_assets", {})
+
+    with BatchRenderer(workers=1, preset=preset) as renderer:
+        renderer.add_image("gray", gray)
+        renderer.add_image("patch", patch)
+        batch.attach_assets(renderer.images, {}, preset)
+        batch.base_canvas("gray")
+
+        with instrument() as stats:
+            for y in (4, 20):
+                png = batch.render_job(RenderJob("gray").blend("patch", 2, y))
+
+        # Each job changes 3 rows; the row below them is filtered again too, as it depends on the row above.
+        assert stats.counters["rows_analyzed"] == 6
+        assert stats.counters["rows_filtered"] == 8
+        assert png == render_serially(RenderJob("gray").blend("patch", 2, 20), {"gray": gray, "patch": patch}, None,
+                                      preset)
+
+        for image in batch.worker_assets["images"].values():
+            image.close()
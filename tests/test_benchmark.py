@@ -0,0 +1,63 @@
+import json
+
+from image_processing import benchmark
+
+
+def test_compare_flags_increases_beyond_the_threshold():
+    results = {"results": {"copy@64": {"seconds": 1.1, "peak_bytes": 10000},
+                           "rect@64": {"seconds": 1.5, "peak_bytes": 0},
+                           "new@64": {"seconds": 9.0, "peak_bytes": 900}}}
+    baseline = {"results": {"copy@64": {"seconds": 1.0, "peak_bytes": 0},
+                            "rect@64": {"seconds": 1.0, "peak_bytes": 0}}}
+
+    assert benchmark.compare(results, baseline, 0.2) == [
+        ("copy@64", "peak_bytes", 0, 10000),
+        ("rect@64", "seconds", 1.0, 1.5),
+    ]
+
+
+def test_compare_ignores_small_absolute_increases():
+    results = {"results": {"fill@64": {"seconds": 0.0015, "peak_bytes": 1000},
+                           "blit@64": {"seconds": 0.0045, "peak_bytes": 9000}}}
+    baseline = {"results": {"fill@64": {"seconds": 0.0005, "peak_bytes": 0},
+                            "blit@64": {"seconds": 0.002, "peak_bytes": 4000}}}
+
+    # fill@64 tripled, but by less than the minimum deltas.
+    assert benchmark.compare(results, baseline, 0.2) == [("blit@64", "seconds", 0.002, 0.0045),
+                                                         ("blit@64", "peak_bytes", 4000, 9000)]
+    assert benchmark.compare(results, baseline, 0.2, {}) == [
+        ("blit@64", "seconds", 0.002, 0.0045), ("blit@64", "peak_bytes", 4000, 9000),
+        ("fill@64", "seconds", 0.0005, 0.0015), ("fill@64", "peak_bytes", 0, 1000),
+    ]
+
+
+def test_copy_benchmark_includes_the_first_write(tmp_path):
+    bench = benchmark.Benchmark(64, str(tmp_path))
+    metrics = bench.run("copy", 1)
+
+    # The first write copies all 64 x 64 pixels.
+    assert metrics["peak_bytes"] >= 64 * 64 * 4 * 8
+    assert bench.canvas.at(0, 0) != (1, 1, 1, 1)
+
+
+def run_main(tmp_path, baseline_metrics):
+    baseline = tmp_path / "baseline.json"
+    baseline.write_text(json.dumps({"results": {"copy@64": baseline_metrics}}))
+    output = tmp_path / "results.json"
+
+    status = benchmark.main(["--sizes", "64", "--ops", "copy", "--repeat", "1", "--output", str(output),
+                             "--baseline", str(baseline)])
+    assert set(json.loads(output.read_text())["results"]) == {"copy@64"}
+    return status
+
+
+def test_main_reports_regressions(tmp_path, capsys):
+    assert run_main(tmp_path, {"seconds": 0.0, "peak_bytes": 0}) == 1
+
+    lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith("REGRESSION")]
+    assert lines and all(line.endswith("(n/a)") for line in lines)
+
+
+def test_main_passes_without_regressions(tmp_path, capsys):
+    assert run_main(tmp_path, {"seconds": 1e9, "peak_bytes": 1e12}) == 0
+    assert "No regressions" in capsys.readouterr().out
@@ -0,0 +1,390 @@
+import random
+import warnings
+from array import array
+from io import BytesIO
+from math import floor
+from struct import pack
+
+import pytest
+
+from image_processing.canvas import Canvas, Pixel, RgbaColor, decode_pixels as decode
+from image_processing.instrumentation import instrument
+
+
+def sample_canvas():
+    canvas = Canvas(4, 3, RgbaColor(0, 0, 0, 1))
+    canvas.set(1, 2, RgbaColor(1, 0.5, 0.25, 1))
+    return canvas
+
+
+def test_at_returns_an_immutable_snapshot():
+    canvas = sample_canvas()
+    color = canvas.at(1, 2)
+
+    assert color == Pixel(1, 0.5, 0.25, 1)
+    assert (color.r, color.g, color.b, color.a) == (1, 0.5, 0.25, 1)
+    with pytest.raises(AttributeError):
+        color.r = 0.
+
+
+def test_set_changes_one_pixel():
+    canvas = sample_canvas()
+    canvas.set(0, 0, canvas.at(1, 2))
+
+    assert canvas.at(0, 0) == canvas.at(1, 2)
+    assert canvas.at(1, 0) == Pixel(0, 0, 0, 1)
+    with pytest.raises(ValueError):
+        canvas.set(4, 0, RgbaColor(0, 0, 0, 1))
+
+
+def test_canvas_attribute_is_a_deprecated_snapshot():
+    canvas = sample_canvas()
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        colors = canvas.canvas
+
+    assert caught and issubclass(caught[0].category, DeprecationWarning)
+    assert len(colors) == 12
+    assert colors[2 * 4 + 1] == Pixel(1, 0.5, 0.25, 1)
+    with pytest.raises(AttributeError):
+        canvas.canvas = []
+
+
+def test_rect_copies_pixels_and_background():
+    canvas = sample_canvas()
+    rect = canvas.rect(1, 1, 2, 2)
+
+    assert (rect.width, rect.height) == (2, 2)
+    assert rect.at(0, 1) == Pixel(1, 0.5, 0.25, 1)
+    assert len(rect.pixels) == 16
+    assert rect.bgcolor is not canvas.bgcolor
+    assert tuple(rect.bgcolor) == tuple(canvas.bgcolor)
+
+    # The rectangle is independent of the canvas.
+    rect.set(0, 1, RgbaColor(0, 0, 0, 1))
+    assert canvas.at(1, 2) == Pixel(1, 0.5, 0.25, 1)
+
+
+def test_pixels_must_fit():
+    with pytest.raises(ValueError):
+        Canvas(2, 2, RgbaColor(0, 0, 0, 1), pixels=[0.] * 4)
+
+
+def export(canvas, **kwargs):
+    stream = BytesIO()
+    canvas.write_png(stream, **kwargs)
+    return stream.getvalue()
+
+
+def fresh(canvas):
+    return Canvas(canvas.width, canvas.height, RgbaColor(*canvas.bgcolor), array("d", canvas.pixels))
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"alpha": True}, {"alpha": True, "optimize": False}, {"preset": "fastest"}])
+def test_incremental_export_matches_a_fresh_export(kwargs):
+    canvas = Canvas(40, 30, RgbaColor(0.2, 0.4, 0.6, 1))
+    canvas.fill_rect(5, 5, 20, 10, RgbaColor(1, 0, 0, 0.5))
+    export(canvas, **kwargs)
+
+    # Edits that change the color type the image is optimized to: more colors, then transparency.
+    for i in range(3):
+        canvas.fill_rect(i * 7, 20 + i, 6, 3, RgbaColor(i / 3, 1 - i / 3, 0.5, 1))
+        assert export(canvas, **kwargs) == export(fresh(canvas), **kwargs)
+
+    copy = canvas.copy()
+    copy.fill_rect(0, 0, 3, 3, RgbaColor(0, 0, 0, 0))
+    assert export(copy, **kwargs) == export(fresh(copy), **kwargs)
+    assert export(canvas, **kwargs) == export(fresh(canvas), **kwargs)
+
+
+def test_incremental_export_only_analyzes_changed_rows():
+    canvas = Canvas(16, 12, RgbaColor(0, 0, 0, 1))
+    export(canvas, alpha=True)
+    canvas.fill_rect(0, 4, 16, 2, RgbaColor(1, 1, 1, 1))
+
+    with instrument() as stats:
+        export(canvas, alpha=True)
+
+    assert stats.counters["rows_analyzed"] == 2
+    assert stats.counters["rows_analysis_cached"] == 10
+
+
+# Offsets that place a 5 x 4 rectangle inside, across every edge of and entirely outside a 12 x 8 canvas.
+OFFSETS = [(2, 3), (0, 0), (-2, -1), (9, 6), (-3, 5), (10, -2), (-5, 0), (12, 3), (4, -4), (4, 8)]
+
+
+@pytest.mark.parametrize("x, y", OFFSETS)
+def test_opaque_fill_rect_matches_setting_pixels(make_pattern, x, y):
+    canvas = make_pattern(12, 8)
+    expected = canvas.copy()
+    color = RgbaColor(0.3, 0.6, 0.9, 1)
+
+    for py in range(max(0, y), min(8, y + 4)):
+        for px in range(max(0, x), min(12, x + 5)):
+            expected.set(px, py, color)
+
+    canvas.fill_rect(x, y, 5, 4, color)
+    assert canvas.pixels == expected.pixels
+
+
+@pytest.mark.parametrize("x, y", OFFSETS)
+@pytest.mark.parametrize("alpha", [0.5, 0.999, 0.])
+def test_translucent_fill_rect_matches_blending_a_solid_canvas(make_pattern, x, y, alpha):
+    canvas = make_pattern(12, 8)
+    expected = canvas.copy()
+    color = RgbaColor(0.3, 0.6, 0.9, alpha)
+
+    expected.blend(Canvas(5, 4, color), x, y)
+    canvas.fill_rect(x, y, 5, 4, color)
+    assert canvas.pixels == expected.pixels
+
+
+@pytest.mark.parametrize("x, y", OFFSETS)
+def test_blit_matches_blending_without_alpha(make_pattern, x, y):
+    canvas = make_pattern(12, 8)
+    src = make_pattern(5, 4)
+    expected = canvas.copy()
+
+    expected.blend(src, x, y, ignore_src_alpha=True)
+    canvas.blit(src, x, y)
+    assert canvas.pixels == expected.pixels
+
+    # The covered pixels are replaced, alpha included; the others are left alone.
+    original = make_pattern(12, 8)
+    for py in range(8):
+        for px in range(12):
+            inside = 0 <= px - x < 5 and 0 <= py - y < 4
+            assert canvas.at(px, py) == (src.at(px - x, py - y) if inside else original.at(px, py))
+
+
+def test_fill_rect_rejects_negative_sizes():
+    with pytest.raises(ValueError):
+        sample_canvas().fill_rect(0, 0, -1, 2, RgbaColor(0, 0, 0, 1))
+
+
+@pytest.mark.parametrize("x, y", OFFSETS)
+def test_blending_a_view_matches_blending_its_copy(make_pattern, x, y):
+    view = make_pattern(9, 7).rect(2, 1, 5, 4, view=True)
+    canvas, expected = make_pattern(12, 8, opaque=True), make_pattern(12, 8, opaque=True)
+
+    canvas.blend(view, x, y)
+    expected.blend(view.copy(), x, y)
+    assert canvas.pixels == expected.pixels
+
+
+@pytest.mark.parametrize("x, y", [(4, 2), (3, 1), (0, 0), (1, 3), (7, 4)])
+def test_blending_a_view_into_its_own_canvas(make_pattern, x, y):
+    canvas = make_pattern(12, 8)
+    expected = canvas.copy()
+    view = canvas.rect(2, 1, 5, 4, view=True)
+
+    expected.blend(view.copy(), x, y)
+    canvas.blend(view, x, y)
+    assert canvas.pixels == expected.pixels
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"alpha": True}, {"alpha": True, "optimize": False}, {"preset": "fastest"}])
+def test_view_exports_match_its_copy(make_pattern, tmp_path, kwargs):
+    view = make_pattern(9, 7).rect(2, 1, 5, 4, view=True)
+    copy = view.copy()
+
+    assert view.bytes() == copy.bytes()
+    assert list(view.rgba_rows()) == list(copy.rgba_rows())
+    assert export(view, **kwargs) == export(copy, **kwargs)
+
+    view.to_png(str(tmp_path / "view.png"), **kwargs)
+    copy.to_png(str(tmp_path / "copy.png"), **kwargs)
+    assert (tmp_path / "view.png").read_bytes() == (tmp_path / "copy.png").read_bytes()
+
+
+def test_views_see_later_changes():
+    canvas = sample_canvas()
+    view = canvas.rect(1, 1, 3, 2, view=True)
+    canvas.set(2, 1, RgbaColor(0, 1, 0, 1))
+
+    assert view.at(1, 0) == Pixel(0, 1, 0, 1)
+    assert view.bytes() == canvas.rect(1, 1, 3, 2).bytes()
+
+
+def test_copies_share_pixels_until_written():
+    canvas = sample_canvas()
+    copy = canvas.copy()
+    assert copy.pixels is canvas.pixels
+
+    # Writing to the copy leaves the original alone ...
+    copy.set(0, 0, RgbaColor(1, 1, 1, 1))
+    assert copy.pixels is not canvas.pixels
+    assert canvas.at(0, 0) == Pixel(0, 0, 0, 1)
+
+    # ... and the other way around.
+    copy = canvas.copy()
+    canvas.fill_rect(0, 0, 4, 3, RgbaColor(0, 0, 1, 1))
+    assert copy.at(0, 0) == Pixel(0, 0, 0, 1) and copy.at(1, 2) == Pixel(1, 0.5, 0.25, 1)
+    assert canvas.at(1, 2) == Pixel(0, 0, 1, 1)
+
+
+def test_copies_stay_isolated_after_detach():
+    canvas = sample_canvas()
+    first, second = canvas.copy(), canvas.copy()
+
+    # Detaching the original copies its pixels, as two copies still share them.
+    canvas.detach()
+    assert canvas.pixels is not first.pixels and first.pixels is second.pixels
+
+    canvas.set(0, 0, RgbaColor(1, 0, 0, 1))
+    first.set(1, 0, RgbaColor(0, 1, 0, 1))
+
+    # The last owner keeps the pixels without copying them.
+    shared = second.pixels
+    second.detach()
+    assert second.pixels is shared
+    second.set(2, 0, RgbaColor(0, 0, 1, 1))
+
+    black = Pixel(0, 0, 0, 1)
+    assert [canvas.at(x, 0) for x in range(3)] == [Pixel(1, 0, 0, 1), black, black]
+    assert [first.at(x, 0) for x in range(3)] == [black, Pixel(0, 1, 0, 1), black]
+    assert [second.at(x, 0) for x in range(3)] == [black, black, Pixel(0, 0, 1, 1)]
+
+
+def reference_row_bytes(canvas, y):
+    """Converts a scanline pixel by pixel, like Canvas.row_bytes did before the bulk conversion."""
+    data = bytearray(canvas.width * 3)
+    bg_r, bg_g, bg_b, _ = canvas.bgcolor
+
+    for i in range(canvas.width):
+        p = (y * canvas.width + i) * 4
+        r, g, b, a = canvas.pixels[p:p + 4]
+
+        if a >= 0.999:
+            data[i*3:i*3 + 3] = pack("!3B", floor(r * 255), floor(g * 255), floor(b * 255))
+        else:
+            r = floor((r * a + bg_r * (1 - a)) * 255)
+            g = floor((g * a + bg_g * (1 - a)) * 255)
+            b = floor((b * a + bg_b * (1 - a)) * 255)
+            data[i*3:i*3 + 3] = pack("!3B", r, g, b)
+
+    return bytes(data)
+
+
+# Alphas around the 0.999 threshold and at the ends, and colors that are exactly 0 or 1 or slightly outside the range
+# from rounding errors, e.g. after blending.
+EDGE_ALPHAS = [0., 1., 0.999, 0.9989999, 0.9995, 1 - 1e-12, 1e-12, 0.5, -0., 1 + 1e-12]
+EDGE_COLORS = [0., 1., 0.5, 1 / 255, 254.5 / 255, 1 - 1e-12, 1 + 1e-12, -0., 1e-12]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_bytes_match_per_pixel_conversion(seed):
+    rng = random.Random(seed)
+    width, height = 13, 9
+    pixels = array("d")
+
+    for y in range(height):
+        # Every third row is opaque, so the fast path is covered as well.
+        alphas = [1., 0.999, 1 - 1e-12, 1 + 1e-12] if y % 3 == 0 else EDGE_ALPHAS + [rng.random()]
+        for _ in range(width):
+            pixels.extend(rng.choice(EDGE_COLORS + [rng.random()]) for _ in range(3))
+            pixels.append(rng.choice(alphas))
+
+    canvas = Canvas(width, height, RgbaColor(rng.random(), 1, 0, 1), pixels)
+    expected = [reference_row_bytes(canvas, y) for y in range(height)]
+
+    assert list(canvas.rows()) == expected
+    assert canvas.bytes() == b"".join(expected)
+    assert canvas.rect(2, 1, 9, 7, view=True).bytes() == canvas.rect(2, 1, 9, 7).bytes()
+
+
+def test_imports_match_per_byte_conversion():
+    data = bytes(range(256)) * 3
+    canvas = Canvas(64, 12, RgbaColor(0, 0, 0, 1))
+
+    canvas.import_rgba_data(data)
+    assert list(canvas.pixels[:len(data)]) == [v / 255 for v in data]
+
+    canvas.import_rgb_data(data)
+    assert list(canvas.pixels[:len(data) // 3 * 4]) == [v for i in range(0, 768, 3) for v in (data[i] / 255, data[i + 1] / 255,
+                                                                                   data[i + 2] / 255, 1.0)]
+
+    for channels in (1, 2, 3, 4):
+        row = data[:64 * channels]
+        canvas.import_row(5, row, channels)
+        pixels = list(canvas.pixels[5 * 64 * 4:6 * 64 * 4])
+
+        for i in range(64):
+            values = [v / 255 for v in row[i * channels:(i + 1) * channels]]
+            if channels <= 2:
+                values[:1] = values[:1] * 3
+            if channels in (1, 3):
+                values.append(1.0)
+            assert pixels[i * 4:i * 4 + 4] == values
+
+    # Converting back gives the same bytes.
+    assert Canvas(64, 4, RgbaColor(0, 0, 0, 1), decode(bytes(range(256)) * 3, 3)).bytes() == bytes(range(256)) * 3
+
+
+def reference_blend(dst, src, offset_x, offset_y):
+    """Blends pixel by pixel, like Canvas.blend did before it worked on spans. Fully transparent source pixels leave
+    the target alone, as they do in a span blend."""
+    for src_y in range(src.height):
+        for src_x in range(src.width):
+            x, y = offset_x + src_x, offset_y + src_y
+            if not (0 <= x < dst.width and 0 <= y < dst.height):
+                continue
+
+            s, d = (src_y * src.width + src_x) * 4, (y * dst.width + x) * 4
+            src_r, src_g, src_b, src_a = src.pixels[s:s + 4]
+            dst_r, dst_g, dst_b, dst_a = dst.pixels[d:d + 4]
+
+            if src_a <= 0.:
+                continue
+            if src_a >= 0.999999:
+                dst.pixels[d:d + 4] = src.pixels[s:s + 4]
+                continue
+
+            new_alpha = src_a + dst_a * (1 - src_a)
+            if new_alpha < 0.000001:
+                dst.pixels[d:d + 4] = array("d", (0, 0, 0, 0))
+            else:
+                dst.pixels[d:d + 4] = array("d", ((src_r * src_a + dst_r * dst_a * (1 - src_a)) / new_alpha,
+                                                  (src_g * src_a + dst_g * dst_a * (1 - src_a)) / new_alpha,
+                                                  (src_b * src_a + dst_b * dst_a * (1 - src_a)) / new_alpha,
+                                                  new_alpha))
+
+
+def random_runs(rng, width, height):
+    """Builds a canvas whose rows consist of random runs of transparent, translucent and opaque pixels."""
+    canvas = Canvas(width, height, RgbaColor(0, 0, 0, 0))
+    alphas = [0., 1., 0.999999, 0.9999989, 1e-7, None]
+
+    for y in range(height):
+        x = 0
+        while x < width:
+            alpha, end = rng.choice(alphas), min(width, x + rng.randrange(1, 6))
+            for x in range(x, end):
+                canvas.set(x, y, RgbaColor(rng.random(), rng.random(), rng.random(),
+                                           rng.random() if alpha is None else alpha))
+            x = end
+
+    return canvas
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("x, y", [(0, 0), (3, 2), (-4, -3), (8, 5), (-2, 6), (9, -1), (-11, 0), (0, 9)])
+def test_span_blend_matches_per_pixel_blend(make_pattern, seed, x, y):
+    rng = random.Random(seed)
+    src = random_runs(rng, 11, 8)
+    canvas = make_pattern(14, 9)
+    canvas.set(0, 0, RgbaColor(0.5, 0.5, 0.5, 1e-7))
+    expected = canvas.copy()
+    expected.detach()
+
+    reference_blend(expected, src, x, y)
+    canvas.blend(src, x, y)
+    assert canvas.pixels == expected.pixels
+
+    # Uniform rows take the fast paths.
+    for alpha in (0., 1.):
+        src = Canvas(11, 8, RgbaColor(0.2, 0.4, 0.6, alpha))
+        reference_blend(expected, src, x, y)
+        canvas.blend(src, x, y)
+        assert canvas.pixels == expected.pixels
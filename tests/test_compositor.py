@@ -0,0 +1,107 @@
+import pytest
+
+from image_processing.canvas import Canvas, RgbaColor
+from image_processing.compositor import Compositor, add_intervals, subtract_intervals
+
+
+def make_layer(width, height, color, translucent=None, hole=False):
+    layer = Canvas(width, height, color)
+    if translucent is not None:
+        layer.fill_rect(1, 1, width - 2, height - 2, translucent)
+    if hole:
+        layer.set(0, 0, RgbaColor(0, 0, 0, 0))
+    return layer
+
+
+OPAQUE = make_layer(8, 6, RgbaColor(1, 0, 0, 1), RgbaColor(0, 1, 0, 0.25))
+FULL = make_layer(20, 3, RgbaColor(0, 0, 1, 1))
+TRANSLUCENT = make_layer(7, 9, RgbaColor(0.5, 0.5, 0.5, 0.5), RgbaColor(1, 1, 0, 0.75), hole=True)
+TRANSPARENT = make_layer(5, 5, RgbaColor(0, 0, 0, 0), RgbaColor(1, 0, 1, 1))
+
+STACKS = {
+    "opaque": [(OPAQUE, 2, 1, False), (OPAQUE, 5, 3, False), (OPAQUE, 0, 0, False)],
+    "translucent": [(TRANSLUCENT, 1, 2, False), (TRANSLUCENT, 4, 0, False), (TRANSPARENT, 3, 4, False)],
+    "mixed": [(TRANSLUCENT, 0, 0, False), (FULL, 0, 2, False), (OPAQUE, 6, 1, False), (TRANSLUCENT, 10, 3, False),
+              (TRANSPARENT, 12, 5, False)],
+    "off canvas": [(OPAQUE, -4, -2, False), (TRANSLUCENT, 16, 8, False), (FULL, -3, 10, False),
+                   (OPAQUE, 30, 0, False), (TRANSLUCENT, 0, -20, False)],
+    "ignore src alpha": [(TRANSLUCENT, 2, 2, True), (TRANSPARENT, 6, 1, True), (TRANSLUCENT, 5, 4, False),
+                         (OPAQUE, -2, 8, True)],
+}
+
+
+@pytest.fixture
+def base(make_canvas):
+    return make_canvas(20, 12)
+
+
+def blend_directly(base, layers):
+    canvas = base.copy()
+    for src, x, y, ignore_src_alpha in layers:
+        canvas.blend(src, x, y, ignore_src_alpha)
+    return canvas
+
+
+def record(base, layers):
+    compositor = Compositor(base.copy())
+    for src, x, y, ignore_src_alpha in layers:
+        compositor.blend(src, x, y, ignore_src_alpha)
+    return compositor
+
+
+@pytest.mark.parametrize("name", sorted(STACKS))
+def test_flatten_matches_direct_blending(base, name):
+    expected = blend_directly(base, STACKS[name])
+    canvas = record(base, STACKS[name]).flatten()
+
+    assert canvas.pixels == expected.pixels
+    assert canvas.bytes() == expected.bytes()
+
+
+@pytest.mark.parametrize("name", sorted(STACKS))
+def test_rect_matches_direct_blending(base, name):
+    expected = blend_directly(base, STACKS[name])
+    compositor = record(base, STACKS[name])
+    layers = list(compositor.layers)
+
+    for x, y, width, height in ((0, 0, 20, 12), (3, 2, 9, 7), (19, 11, 1, 1), (0, 5, 20, 0)):
+        assert compositor.rect(x, y, width, height).pixels == expected.rect(x, y, width, height).pixels
+
+    # The layers are kept and the canvas is left as it was.
+    assert compositor.layers == layers
+    assert compositor.canvas.pixels == base.pixels
+
+
+def test_write_matches_direct_text(base, make_font):
+    font = make_font()
+    expected = blend_directly(base, STACKS["mixed"])
+    font.write(expected, 3, 4, "ab\nba")
+
+    compositor = record(base, STACKS["mixed"])
+    compositor.write(font, 3, 4, "ab\nba")
+    assert compositor.flatten().pixels == expected.pixels
+
+
+def test_flatten_forgets_layers_and_marks_rows_dirty(base):
+    compositor = record(base, [(OPAQUE, 2, 3, False)])
+    canvas = compositor.canvas
+    versions = list(canvas.row_versions)
+
+    assert compositor.flatten() is canvas
+    assert compositor.layers == []
+    assert [y for y in range(canvas.height) if canvas.row_versions[y] != versions[y]] == list(range(3, 9))
+
+
+def test_subtract_intervals():
+    assert subtract_intervals(0, 10, []) == [(0, 10)]
+    assert subtract_intervals(0, 10, [(2, 4), (6, 8)]) == [(0, 2), (4, 6), (8, 10)]
+    assert subtract_intervals(3, 7, [(0, 4), (5, 6), (6, 9)]) == [(4, 5)]
+    assert subtract_intervals(3, 7, [(0, 3), (7, 9)]) == [(3, 7)]
+    assert subtract_intervals(3, 7, [(0, 10)]) == []
+
+
+def test_add_intervals():
+    assert add_intervals([], [(5, 7), (1, 3)]) == [(1, 3), (5, 7)]
+    assert add_intervals([(1, 3), (5, 7)], [(3, 5)]) == [(1, 7)]
+    assert add_intervals([(1, 3), (8, 9)], [(2, 6), (4, 5)]) == [(1, 6), (8, 9)]
+    assert add_intervals([(0, 10)], [(2, 4)]) == [(0, 10)]
@@ -0,0 +1,129 @@
+import random
+
+import pytest
+
+from image_processing import filters
+
+
+def reference_filter(line, prev_line, bpp, filter_type):
+    """Filters a scanline byte by byte, like PngWriter did before the filter engine, for any bpp."""
+    filtered = bytearray([filter_type])
+
+    for i, x in enumerate(line):
+        a = line[i - bpp] if i >= bpp else 0
+        b = prev_line[i] if prev_line else 0
+        c = prev_line[i - bpp] if prev_line and i >= bpp else 0
+
+        if filter_type == filters.NONE:
+            predictor = 0
+        elif filter_type == filters.SUB:
+            predictor = a
+        elif filter_type == filters.UP:
+            predictor = b
+        elif filter_type == filters.AVERAGE:
+            predictor = (a + b) // 2
+        else:
+            p = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            predictor = a if pa <= pb and pa <= pc else b if pb <= pc else c
+
+        filtered.append((x - predictor) % 256)
+
+    return bytes(filtered)
+
+
+def reference_heuristic(line, prev_line, bpp):
+    """Picks the filter with the lowest sum of absolute differences, counting the first byte unsigned, lowest type
+    first on ties."""
+    def score(filtered):
+        return filtered[1] + sum(abs(v - 256 if v > 127 else v) for v in filtered[2:])
+
+    return min((reference_filter(line, prev_line, bpp, t) for t in range(5)), key=score)
+
+
+def random_rows(rng, count, stride):
+    """Random rows, some of them smooth or flat, so every filter wins sometimes."""
+    rows = []
+
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            rows.append(bytes(rng.randrange(256) for _ in range(stride)))
+        elif kind == 1:
+            start = rng.randrange(256)
+            rows.append(bytes((start + j * rng.randrange(3)) & 255 for j in range(stride)))
+        else:
+            rows.append(bytes([rng.randrange(256)]) * stride)
+
+    return rows
+
+
+@pytest.fixture(params=["python", "numpy"])
+def backend(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+
+    monkeypatch.setattr(filters, "backend", filters.backend)
+    filters.set_backend(request.param)
+    return request.param
+
+
+@pytest.mark.parametrize("bpp", [1, 3, 4])
+@pytest.mark.parametrize("filter_type", [None, filters.NONE, filters.SUB, filters.UP, filters.AVERAGE, filters.PAETH])
+def test_filter_scanline_matches_reference(backend, bpp, filter_type):
+    rng = random.Random(bpp * 10 + (filter_type or 0))
+    rows = random_rows(rng, 12, bpp * 7)
+
+    for prev_line, line in zip([None] + rows, rows):
+        if filter_type is None:
+            expected = reference_heuristic(line, prev_line, bpp)
+        else:
+            expected = reference_filter(line, prev_line, bpp, filter_type)
+
+        assert filters.filter_scanline(line, prev_line, bpp, filter_type) == expected
+
+
+@pytest.mark.parametrize("bpp", [1, 3, 4])
+@pytest.mark.parametrize("filter_type", [None, filters.SUB, filters.PAETH])
+def test_filter_image_matches_reference(backend, bpp, filter_type):
+    rng = random.Random(bpp)
+    stride = bpp * 9
+    rows = random_rows(rng, 10, stride)
+
+    def expected(rows, prev_line):
+        filtered = []
+        for line in rows:
+            if filter_type is None:
+                filtered.append(reference_heuristic(line, prev_line, bpp))
+            else:
+                filtered.append(reference_filter(line, prev_line, bpp, filter_type))
+            prev_line = line
+        return b"".join(filtered)
+
+    assert filters.filter_image(b"".join(rows), stride, bpp, filter_type) == expected(rows, None)
+
+    # A strip is filtered against the scanline above it.
+    assert filters.filter_image(b"".join(rows[4:]), stride, bpp, filter_type, rows[3]) == expected(rows[4:], rows[3])
+
+
+def test_heuristic_ties_go_to_the_lowest_type(backend):
+    # Every filter scores 0 on a black first scanline. On a flat one, Sub and Paeth both predict from the left.
+    assert filters.filter_scanline(bytes(6), None, 3)[0] == filters.NONE
+    assert filters.filter_scanline(bytes([5]) * 6, None, 3)[0] == filters.SUB
+
+
+def test_unfilter_reverses_filter(backend):
+    rng = random.Random(7)
+
+    for bpp in (1, 3, 4):
+        rows = random_rows(rng, 6, bpp * 5)
+
+        for filter_type in range(5):
+            for prev_line, line in zip([None] + rows, rows):
+                filtered = filters.filter_scanline(line, prev_line, bpp, filter_type)
+                assert filters.unfilter_scanline(filter_type, filtered[1:], prev_line, bpp) == line
+
+
+def test_unknown_backends_are_rejected():
+    with pytest.raises(ValueError):
+        filters.set_backend("cuda")
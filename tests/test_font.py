@@ -0,0 +1,68 @@
+from image_processing.canvas import Canvas, RgbaColor
+from image_processing.font import Font, run_size
+
+
+def test_layout_is_cached(make_font):
+    font = make_font()
+    assert font.layout("ab") is font.layout("ab")
+    assert font.runs_size == run_size(font.layout("ab")) == 8 * 5 * 4 * 8
+
+
+def test_cache_is_bounded_by_count(make_font):
+    font = make_font(cache_size=2)
+
+    for text in ("a", "b", "ab", "ba"):
+        font.layout(text)
+
+    assert list(font.runs) == ["ab", "ba"]
+    assert font.runs_size == 2 * run_size(font.layout("ab"))
+
+
+def test_cache_is_bounded_by_bytes(make_font):
+    one = 4 * 5 * 4 * 8
+    font = make_font(cache_bytes=3 * one)
+
+    font.layout("a")
+    font.layout("b")
+    font.layout("a")
+    font.layout("ab")
+
+    # "ab" takes two glyphs' worth, so the least recently used "b" goes.
+    assert list(font.runs) == ["a", "ab"]
+    assert font.runs_size == 3 * one
+
+    # Runs larger than the whole budget are built, but not cached.
+    run = font.layout("abab")
+    assert run is not None and "abab" not in font.runs
+    assert font.runs_size <= font.cache_bytes
+
+
+def test_write_matches_uncached_layout(make_font):
+    cached, uncached = make_font(), make_font(cache_size=0)
+    a = Canvas(20, 10, RgbaColor(0, 0, 0, 1))
+    b = Canvas(20, 10, RgbaColor(0, 0, 0, 1))
+
+    for _ in range(2):
+        cached.write(a, 1, 2, "ab a")
+        uncached.write(b, 1, 2, "ab a")
+
+    assert not uncached.runs
+    assert a.bytes() == b.bytes()
+
+
+def test_glyphs_are_canvases(tmp_path):
+    image = Canvas(8, 5, RgbaColor(0, 0, 0, 0))
+    image.fill_rect(1, 1, 2, 3, RgbaColor(1, 1, 1, 1))
+    path = tmp_path / "font.raw"
+    path.write_bytes(b"".join(image.rgba_rows()))
+
+    font = Font()
+    font.load(str(path), "ab", 4, 5)
+    other = Font()
+    other.load_glyphs({"a": image.rect(0, 0, 4, 5, view=True)}, 4, 5)
+    image.fill_rect(0, 0, 8, 5, RgbaColor(1, 0, 0, 1))
+
+    for glyph in (font.charmap["a"], other.charmap["a"]):
+        assert type(glyph) is Canvas
+        assert glyph.at(1, 1) == (1, 1, 1, 1)
+        assert glyph.at(0, 0) == (0, 0, 0, 0)
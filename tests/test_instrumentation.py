@@ -0,0 +1,62 @@
+from io import BytesIO
+from threading import Barrier, Thread
+
+from image_processing import instrumentation
+from image_processing.apng_writer import ApngWriter
+from image_processing.instrumentation import instrument
+from image_processing.png_writer import PngWriter
+
+
+def test_disabled_outside_of_blocks():
+    assert instrumentation.active() is None
+
+    with instrument() as outer:
+        with instrument() as inner:
+            assert instrumentation.active() is inner
+        assert instrumentation.active() is outer
+
+    assert instrumentation.active() is None
+
+
+def test_concurrent_blocks_are_independent():
+    barrier = Barrier(2)
+    results = {}
+
+    def render(name, rows):
+        with instrument() as stats:
+            # Both blocks are open while the other thread encodes.
+            barrier.wait()
+            PngWriter(BytesIO(), 8, rows).write_image(bytes(8 * 3 * rows))
+            barrier.wait()
+        results[name] = stats
+
+    threads = [Thread(target=render, args=("a", 3)), Thread(target=render, args=("b", 5))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results["a"].counters["rows_filtered"] == 3
+    assert results["b"].counters["rows_filtered"] == 5
+    assert instrumentation.active() is None
+
+
+def test_worker_threads_record_in_the_callers_stats(make_frames):
+    # Fresh frames for each run, as exporting caches their rows.
+    with instrument() as serial:
+        ApngWriter(BytesIO(), 24, 12, 6).write_animation(make_frames(6))
+    with instrument() as parallel:
+        ApngWriter(BytesIO(), 24, 12, 6, workers=3).write_animation(make_frames(6))
+
+    assert parallel.counters == serial.counters
+    assert sorted(parallel.timers) == sorted(serial.timers)
+
+
+def test_parallel_strips_are_counted():
+    rows = [bytes(range(i, i + 48)) for i in range(40)]
+
+    with instrument() as stats:
+        PngWriter(BytesIO(), 16, 40, workers=2).write_image(iter(rows))
+
+    assert stats.counters["rows_filtered"] == 40
+    assert len(stats.filter_choices) == 40
@@ -0,0 +1,90 @@
+import pytest
+
+from image_processing.canvas import Canvas, RgbaColor
+from image_processing.mapped_image import MappedImage
+
+WIDTH, HEIGHT = 9, 6
+
+
+def make_data(channels):
+    data = bytearray()
+
+    for y in range(HEIGHT):
+        for x in range(WIDTH):
+            data += bytes(((x * 29 + y) & 255, (y * 41) & 255, (x * y * 7) & 255))
+            if channels == 4:
+                data.append((0, 255, 128, 255, 7)[(x + y) % 5])
+
+    return bytes(data)
+
+
+def import_data(data, channels):
+    canvas = Canvas(WIDTH, HEIGHT, RgbaColor(0, 0, 0, 0))
+    if channels == 3:
+        canvas.import_rgb_data(data)
+    else:
+        canvas.import_rgba_data(data)
+    return canvas
+
+
+@pytest.fixture(params=[3, 4])
+def image(request, tmp_path):
+    data = make_data(request.param)
+    path = tmp_path / "image.data"
+    path.write_bytes(data)
+
+    with MappedImage(str(path), WIDTH, HEIGHT, request.param) as image:
+        yield image, import_data(data, request.param)
+
+
+def test_to_canvas_matches_import(image):
+    image, expected = image
+    canvas = image.to_canvas()
+
+    assert canvas.pixels == expected.pixels
+    assert tuple(canvas.bgcolor) == (0, 0, 0, 1 if image.channels == 3 else 0)
+
+
+def test_rect_matches_import(image):
+    image, expected = image
+
+    for x, y, width, height in ((0, 0, WIDTH, HEIGHT), (2, 1, 5, 4), (8, 5, 1, 1), (3, 2, 0, 3)):
+        assert image.rect(x, y, width, height).pixels == expected.rect(x, y, width, height).pixels
+
+    with pytest.raises(ValueError):
+        image.rect(WIDTH, 0, 1, 1)
+    with pytest.raises(ValueError):
+        image.rect(4, 2, 6, 1)
+    with pytest.raises(ValueError):
+        image.rect(0, 0, -1, 1)
+
+
+def test_spans_match_canvas(image):
+    image, expected = image
+
+    for y in range(HEIGHT):
+        assert image.spans(y) == expected.spans(y)
+        assert image.spans(y, 2, 7) == expected.spans(y, 2, 7)
+
+
+@pytest.mark.parametrize("offset", [(-3, -2), (5, 3), (-4, 4), (0, 0)])
+def test_blend_matches_canvas(image, offset):
+    image, expected = image
+    target = Canvas(10, 8, RgbaColor(0.2, 0.4, 0.6, 1))
+    reference = target.copy()
+
+    target.blend(image, *offset)
+    reference.blend(expected, *offset)
+    assert target.pixels == reference.pixels
+
+
+def test_invalid_files_are_rejected(tmp_path):
+    path = tmp_path / "image.data"
+    path.write_bytes(make_data(3))
+
+    with pytest.raises(ValueError):
+        MappedImage(str(path), WIDTH, HEIGHT + 1)
+    with pytest.raises(ValueError):
+        MappedImage(str(path), WIDTH, HEIGHT, channels=2)
+    with pytest.raises(ValueError):
+        MappedImage(str(path), 0, HEIGHT)
@@ -0,0 +1,124 @@
+import os
+from io import BytesIO
+from zlib import Z_DEFAULT_STRATEGY, Z_FILTERED
+
+import pytest
+
+from image_processing import filters
+from image_processing.canvas import RgbaColor
+from image_processing.png_cache import PngCache, image_key
+from image_processing.png_writer import BEST, FIXED, HEURISTIC, CompressionPreset
+
+
+def test_memory_is_bounded_by_bytes_in_lru_order():
+    cache = PngCache(max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbb")
+    cache.put("c", b"cc")
+    assert cache.get("a") == b"aaaa"
+
+    # "b" is the least recently used entry now.
+    cache.put("d", b"ddd")
+    assert list(cache.entries) == ["c", "a", "d"]
+    assert cache.get("b") is None
+
+    # Replacing an entry does not count it twice; PNGs beyond the budget are not kept in memory.
+    cache.put("a", b"a")
+    cache.put("e", b"e" * 11)
+    assert list(cache.entries) == ["c", "d", "a"]
+    assert cache.stats() == {"hits": 1, "disk_hits": 0, "misses": 1, "evictions": 1, "entries": 3, "bytes": 6}
+
+
+def test_clear_keeps_statistics():
+    cache = PngCache(max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.clear()
+
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == cache.stats()["bytes"] == 0
+    assert cache.stats()["misses"] == 1
+
+
+def test_disk_tier_serves_a_fresh_cache(tmp_path):
+    directory = str(tmp_path / "png")
+    cache = PngCache(max_bytes=4, directory=directory)
+    cache.put("small", b"abc")
+    cache.put("large", b"too large")
+
+    assert sorted(os.listdir(directory)) == ["large.png", "small.png"]
+    assert "large" not in cache.entries
+
+    fresh = PngCache(max_bytes=4, directory=directory)
+    assert fresh.get("small") == b"abc"
+    assert fresh.get("small") == b"abc"
+    assert fresh.get("large") == b"too large"
+    assert fresh.get("missing") is None
+    assert fresh.stats() == {"hits": 1, "disk_hits": 2, "misses": 1, "evictions": 0, "entries": 1, "bytes": 3}
+
+
+def test_failed_writes_leave_no_files(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    cache = PngCache(directory=directory)
+
+    def fail(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+
+    with pytest.raises(OSError):
+        cache.put("key", b"data")
+
+    assert os.listdir(directory) == []
+
+
+def test_equivalent_presets_share_keys(make_canvas):
+    canvas = make_canvas()
+    key = image_key(canvas)
+
+    assert key == image_key(canvas, CompressionPreset()) == image_key(canvas, CompressionPreset(9, Z_DEFAULT_STRATEGY,
+                                                                                                8, HEURISTIC))
+    assert image_key(canvas, "balanced") == image_key(canvas, CompressionPreset(6, Z_DEFAULT_STRATEGY, 8, FIXED,
+                                                                                 filters.PAETH))
+    # The filter type only matters to the fixed policy.
+    assert image_key(canvas, "smallest") == image_key(canvas, CompressionPreset(9, filter_policy=BEST,
+                                                                                 filter_type=filters.UP))
+    assert image_key(canvas, "fastest") != image_key(canvas, CompressionPreset(1, filter_policy=FIXED,
+                                                                                filter_type=filters.SUB))
+
+    assert len({key, image_key(canvas, "fastest"), image_key(canvas, CompressionPreset(strategy=Z_FILTERED)),
+                image_key(canvas, alpha=True), image_key(canvas, optimize=False)}) == 5
+
+    with pytest.raises(ValueError):
+        image_key(canvas, "tiny")
+
+
+def test_keys_depend_on_the_image(make_canvas):
+    canvas = make_canvas()
+    key = image_key(canvas)
+
+    assert image_key(canvas.copy()) == key
+    assert image_key(canvas.rect(3, 2, 5, 4, view=True)) == image_key(canvas.rect(3, 2, 5, 4))
+
+    other = canvas.copy()
+    other.bgcolor = RgbaColor(0, 0, 0, 1)
+    assert image_key(other) != key
+
+    other = canvas.copy()
+    other.set(11, 7, RgbaColor(1, 1, 1, 1))
+    assert image_key(other) != key
+
+
+def test_write_png_encodes_once(make_canvas, tmp_path):
+    canvas = make_canvas()
+    expected = BytesIO()
+    canvas.write_png(expected, "fastest")
+
+    cache = PngCache(directory=str(tmp_path))
+    for _ in range(2):
+        stream = BytesIO()
+        canvas.write_png(stream, "fastest", cache=cache)
+        assert stream.getvalue() == expected.getvalue()
+
+    assert cache.stats()["misses"] == 1 and cache.stats()["hits"] == 1
+    with open(cache.path(image_key(canvas, "fastest")), "rb") as f:
+        assert f.read() == expected.getvalue()
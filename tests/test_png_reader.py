@@ -0,0 +1,175 @@
+import zlib
+from io import BytesIO
+from struct import pack
+
+import pytest
+
+from image_processing.canvas import Canvas, RgbaColor
+from image_processing.png_reader import PngReader
+from image_processing.png_writer import GRAYSCALE, GRAYSCALE_ALPHA, PALETTE, RGB, RGBA, PngWriter
+
+WIDTH, HEIGHT = 13, 7
+
+
+def chunk(type_, data=b""):
+    return pack("!I4s", len(data), type_) + data + pack("!I", zlib.crc32(data, zlib.crc32(type_)))
+
+
+def make_png(width, height, bit_depth, color_type, scanlines, interlace=0, extra=b""):
+    """Builds a PNG by hand from unfiltered scanlines in the image's own format."""
+    ihdr = pack("!2I5B", width, height, bit_depth, color_type, 0, 0, interlace)
+    data = zlib.compress(b"".join(b"\x00" + line for line in scanlines))
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + extra + chunk(b"IDAT", data) + chunk(b"IEND")
+
+
+def rgba_rows(color_type, bit_depth):
+    """Builds RGBA rows that the given color type and bit depth represent exactly."""
+    levels = [v * 255 // ((1 << bit_depth) - 1) for v in range(1 << bit_depth)]
+    rows = []
+
+    for y in range(HEIGHT):
+        row = bytearray()
+
+        for x in range(WIDTH):
+            v = levels[(x + y * 3) % len(levels)]
+
+            if color_type == GRAYSCALE:
+                row += bytes((v, v, v, 255))
+            elif color_type == PALETTE:
+                row += bytes((v, 255 - v, v // 2, 255 if v % 2 else 128))
+            elif color_type == GRAYSCALE_ALPHA:
+                row += bytes((v, v, v, (x * 20) % 256))
+            elif color_type == RGB:
+                row += bytes((x * 19 % 256, y * 31 % 256, (x ^ y) * 7 % 256, 255))
+            else:
+                row += bytes((x * 19 % 256, y * 31 % 256, (x ^ y) * 7 % 256, (x + y) * 17 % 256))
+
+        rows.append(bytes(row))
+
+    return rows
+
+
+WRITTEN = [(GRAYSCALE, 1), (GRAYSCALE, 2), (GRAYSCALE, 4), (GRAYSCALE, 8), (PALETTE, 1), (PALETTE, 2), (PALETTE, 4),
+           (PALETTE, 8), (RGB, 8), (GRAYSCALE_ALPHA, 8), (RGBA, 8)]
+
+
+@pytest.mark.parametrize("color_type, bit_depth", WRITTEN)
+def test_round_trip(color_type, bit_depth):
+    rows = rgba_rows(color_type, bit_depth)
+    palette = sorted({row[i:i + 4] for row in rows for i in range(0, len(row), 4)}) if color_type == PALETTE else None
+
+    stream = BytesIO()
+    PngWriter(stream, WIDTH, HEIGHT, channels=4, color_type=color_type, bit_depth=bit_depth,
+              palette=palette).write_image(iter(rows))
+    stream.seek(0)
+    reader = PngReader(stream)
+
+    assert (reader.color_type, reader.bit_depth) == (color_type, bit_depth)
+    assert list(reader.to_canvas().rgba_rows()) == rows
+
+
+@pytest.mark.parametrize("alpha", [False, True])
+def test_round_trip_of_optimized_canvas(alpha):
+    canvas = Canvas(WIDTH, HEIGHT, RgbaColor(0, 0, 0, 1))
+    canvas.fill_rect(2, 1, 5, 4, RgbaColor(1, 0.5, 0, 0.5 if alpha else 1))
+    stream = BytesIO()
+    canvas.write_png(stream, alpha=alpha)
+    stream.seek(0)
+
+    assert list(PngReader(stream).to_canvas().rgba_rows()) == list(canvas.rgba_rows())
+
+
+def test_sixteen_bit():
+    samples = [0, 1, 0x7fff, 0x8080, 0xffff]
+    png = make_png(5, 1, 16, GRAYSCALE, [b"".join(pack("!H", v) for v in samples)])
+    reader = PngReader(BytesIO(png))
+
+    assert list(reader.rows()) == [bytes((0, 0, 127, 128, 255))]
+
+
+def test_transparent_color_key():
+    png = make_png(3, 1, 8, RGB, [bytes((1, 2, 3, 4, 5, 6, 1, 2, 3))], extra=chunk(b"tRNS", pack("!3H", 1, 2, 3)))
+    reader = PngReader(BytesIO(png))
+
+    assert reader.channels == 4
+    assert list(reader.rows()) == [bytes((1, 2, 3, 0, 4, 5, 6, 255, 1, 2, 3, 0))]
+
+
+def test_interlaced_images_are_rejected():
+    png = make_png(4, 4, 8, GRAYSCALE, [bytes(4)] * 4, interlace=1)
+
+    with pytest.raises(ValueError, match="Interlaced"):
+        PngReader(BytesIO(png))
+
+
+def valid_png():
+    stream = BytesIO()
+    PngWriter(stream, WIDTH, HEIGHT, preset="fastest").write_image(bytes(range(WIDTH * 3)) * HEIGHT)
+    return stream.getvalue()
+
+
+def decode(png):
+    return list(PngReader(BytesIO(png)).rows())
+
+
+@pytest.mark.parametrize("offset", [12, 16, 29, 33 + 8, -20, -14])
+def test_corrupted_byte(offset):
+    # Flipping any byte of a chunk that is read breaks its CRC: IHDR's type, data and CRC, IDAT's data and CRC.
+    png = bytearray(valid_png())
+    png[offset] ^= 0x55
+
+    with pytest.raises(ValueError, match="CRC mismatch"):
+        decode(bytes(png))
+
+
+@pytest.mark.parametrize("length", [0, 7, 8, 20, 40, 50])
+def test_truncated_stream(length):
+    png = valid_png()
+
+    with pytest.raises(ValueError):
+        decode(png[:length])
+
+
+def test_truncated_idat():
+    data = zlib.compress(b"\x00" + bytes(range(WIDTH)) * 1)
+    ihdr = pack("!2I5B", WIDTH, 4, 8, GRAYSCALE, 0, 0, 0)
+    png = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", data[:len(data) // 2]) + chunk(b"IEND")
+
+    with pytest.raises(ValueError, match="truncated"):
+        decode(png)
+
+
+def test_image_data_ends_early():
+    # A complete zlib stream that holds fewer scanlines than the header promises.
+    png = make_png(WIDTH, 4, 8, GRAYSCALE, [bytes(WIDTH)] * 2)
+    png = png.replace(pack("!2I", WIDTH, 2), pack("!2I", WIDTH, 4), 1)
+
+    with pytest.raises(ValueError):
+        decode(png)
+
+
+def test_corrupt_deflate_data():
+    ihdr = pack("!2I5B", WIDTH, 2, 8, GRAYSCALE, 0, 0, 0)
+    png = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", b"\x78\x9c" + bytes(range(40))) + chunk(b"IEND")
+
+    with pytest.raises(ValueError, match="corrupt"):
+        decode(png)
+
+
+@pytest.mark.parametrize("png", [
+    b"GIF89a" + bytes(20),
+    make_png(2, 2, 3, RGB, [bytes(6)] * 2),
+    make_png(2, 1, 8, PALETTE, [bytes(2)]),
+    make_png(2, 1, 8, RGB, [bytes(6)], extra=chunk(b"tRNS", b"\x00")),
+])
+def test_invalid_images(png):
+    with pytest.raises(ValueError):
+        decode(png)
+
+
+def test_unknown_filter_type():
+    ihdr = pack("!2I5B", 2, 1, 8, GRAYSCALE, 0, 0, 0)
+    png = b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(b"\x07\x00\x09")) + chunk(b"IEND")
+
+    with pytest.raises(ValueError):
+        decode(png)
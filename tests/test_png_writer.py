@@ -0,0 +1,194 @@
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from struct import unpack_from
+
+import pytest
+
+from image_processing import png_writer
+from image_processing.png_reader import PngReader
+from image_processing.png_writer import PngWriter
+
+
+def make_rows(width, height, channels=3):
+    """Builds an image that repeats itself across rows, so deflate refers back across strip boundaries."""
+    return [bytes((x * 7 + (y % 4) * 13 + (x * y) % 5) % 256 for x in range(width * channels)) for y in range(height)]
+
+
+def chunks(png):
+    """Splits a PNG into its (type, data) chunks."""
+    chunks, i = [], 8
+
+    while i < len(png):
+        length, type_ = unpack_from("!I4s", png, i)
+        chunks.append((type_, png[i + 8:i + 8 + length]))
+        i += length + 12
+
+    return chunks
+
+
+def idat(png):
+    """Returns the zlib stream of a PNG."""
+    return b"".join(data for type_, data in chunks(png) if type_ == b"IDAT")
+
+
+def encode(rows, width, **kwargs):
+    stream = BytesIO()
+    PngWriter(stream, width, len(rows), **kwargs).write_image(iter(rows))
+    return stream.getvalue()
+
+
+def decode(png):
+    return list(PngReader(BytesIO(png)).rows())
+
+
+@pytest.mark.parametrize("preset", [None, "fastest", "balanced"])
+@pytest.mark.parametrize("strip_size", [1, 100, 1000, png_writer.STRIP_SIZE])
+@pytest.mark.parametrize("workers", [2, 3, 16])
+def test_parallel_stream_matches_serial(monkeypatch, preset, strip_size, workers):
+    # With a strip size of 1, every row is a strip of its own, and 16 workers are more than there are rows.
+    monkeypatch.setattr(png_writer, "STRIP_SIZE", strip_size)
+    rows = make_rows(30, 12)
+
+    serial = encode(rows, 30, preset=preset)
+    parallel = encode(rows, 30, preset=preset, workers=workers)
+
+    # zlib.decompress checks the stitched Adler-32 as well.
+    assert zlib.decompress(idat(parallel)) == zlib.decompress(idat(serial))
+    assert decode(parallel) == rows
+
+
+def test_parallel_strips_are_primed_with_the_previous_data(monkeypatch):
+    # Four strips of ten rows. Without the preceding data as dictionary, every strip starts from scratch and the
+    # stream more than doubles in size.
+    monkeypatch.setattr(png_writer, "STRIP_SIZE", 1000)
+    rows = make_rows(30, 40)
+
+    serial = idat(encode(rows, 30))
+    parallel = idat(encode(rows, 30, workers=2))
+
+    assert zlib.decompress(parallel) == zlib.decompress(serial)
+    assert len(parallel) < 1.5 * len(serial)
+
+
+@pytest.mark.parametrize("strip_size", [1, 100])
+def test_parallel_brute_force(monkeypatch, strip_size):
+    # Trial compression runs against a compressor per strip, so the chosen filters may differ from the serial path.
+    monkeypatch.setattr(png_writer, "STRIP_SIZE", strip_size)
+    rows = make_rows(20, 9)
+    parallel = encode(rows, 20, preset="smallest", workers=4)
+
+    assert len(zlib.decompress(idat(parallel))) == 9 * (20 * 3 + 1)
+    assert decode(parallel) == rows
+
+
+def test_parallel_single_row():
+    rows = make_rows(50, 1)
+    parallel = encode(rows, 50, workers=4)
+
+    assert zlib.decompress(idat(parallel)) == zlib.decompress(idat(encode(rows, 50)))
+
+
+def test_parallel_rgba(monkeypatch):
+    monkeypatch.setattr(png_writer, "STRIP_SIZE", 64)
+    rows = make_rows(16, 10, channels=4)
+    parallel = encode(rows, 16, channels=4, workers=3)
+
+    assert zlib.decompress(idat(parallel)) == zlib.decompress(idat(encode(rows, 16, channels=4)))
+    assert decode(parallel) == rows
+
+
+def test_parallel_process_pool(monkeypatch):
+    monkeypatch.setattr(png_writer, "STRIP_SIZE", 200)
+    rows = make_rows(40, 20)
+
+    with ProcessPoolExecutor(2) as executor:
+        parallel = encode(rows, 40, executor=executor)
+
+    assert zlib.decompress(idat(parallel)) == zlib.decompress(idat(encode(rows, 40)))
+
+
+def test_parallel_rejects_wrong_row_count():
+    with pytest.raises(ValueError):
+        PngWriter(BytesIO(), 10, 4, workers=2).write_image(iter(make_rows(10, 3)))
+
+
+@pytest.mark.parametrize("rows", [make_rows(40, 30), [bytes(range(120))] * 30])
+def test_smallest_is_never_larger_than_the_default(rows):
+    smallest = encode(rows, 40, preset="smallest")
+
+    assert len(smallest) <= len(encode(rows, 40))
+    assert len(smallest) <= len(encode(rows, 40, preset=png_writer.CompressionPreset(
+        filter_policy=png_writer.BRUTE_FORCE)))
+    assert decode(smallest) == rows
+
+
+def test_best_policy_in_parallel(monkeypatch):
+    monkeypatch.setattr(png_writer, "STRIP_SIZE", 300)
+    rows = make_rows(40, 30)
+
+    assert decode(encode(rows, 40, preset="smallest", workers=3)) == rows
+
+
+def leveled_rows(width, height, bit_depth):
+    """Builds a gray RGB image that uses every level of the given bit depth."""
+    levels = [v * 255 // ((1 << bit_depth) - 1) for v in range(1 << bit_depth)]
+    return [bytes(levels[(x + y) % len(levels)] for x in range(width) for _ in range(3)) for y in range(height)]
+
+
+@pytest.mark.parametrize("bit_depth", [1, 2, 4, 8])
+def test_rgb_input_as_grayscale(bit_depth):
+    rows = leveled_rows(11, 5, bit_depth)
+    png = encode(rows, 11, color_type=png_writer.GRAYSCALE, bit_depth=bit_depth)
+
+    assert PngReader(BytesIO(png)).bit_depth == bit_depth
+    assert decode(png) == [row[::3] for row in rows]
+
+
+@pytest.mark.parametrize("bit_depth", [1, 2, 4, 8])
+@pytest.mark.parametrize("workers", [1, 2])
+def test_rgb_input_as_palette(monkeypatch, bit_depth, workers):
+    monkeypatch.setattr(png_writer, "STRIP_SIZE", 16)
+    palette = [bytes((i * 40 % 256, 255 - i, 9)) for i in range(1 << bit_depth)]
+    rows = [b"".join(palette[(x * 3 + y) % len(palette)] for x in range(11)) for y in range(5)]
+    png = encode(rows, 11, color_type=png_writer.PALETTE, bit_depth=bit_depth, palette=palette, workers=workers)
+    reader = PngReader(BytesIO(png))
+
+    assert (reader.color_type, reader.bit_depth) == (png_writer.PALETTE, bit_depth)
+    assert decode(png) == rows
+
+
+def test_rgb_input_rejects_alpha_color_types():
+    with pytest.raises(ValueError):
+        PngWriter(BytesIO(), 4, 4, color_type=png_writer.RGBA)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 65536])
+def test_streamed_idat_chunks_stay_within_chunk_size(chunk_size):
+    rows = make_rows(40, 30)
+    png = encode(rows, 40, chunk_size=chunk_size)
+    sizes = [len(data) for type_, data in chunks(png) if type_ == b"IDAT"]
+
+    assert max(sizes) <= chunk_size
+    # Only the last chunk may be short.
+    assert all(size == chunk_size for size in sizes[:-1])
+    assert decode(png) == rows
+
+
+def test_chunk_size_must_be_positive():
+    with pytest.raises(ValueError):
+        PngWriter(BytesIO(), 4, 4, chunk_size=0)
+
+
+@pytest.mark.parametrize("preset", [None, "fastest", "balanced", "smallest"])
+@pytest.mark.parametrize("channels", [3, 4])
+def test_streaming_rows_matches_writing_the_buffer(preset, channels):
+    rows = make_rows(25, 18, channels)
+
+    buffered, streamed = BytesIO(), BytesIO()
+    PngWriter(buffered, 25, 18, preset=preset, channels=channels).write_image(b"".join(rows))
+    PngWriter(streamed, 25, 18, preset=preset, channels=channels, chunk_size=64).write_image(row for row in rows)
+    streamed = streamed.getvalue()
+
+    assert idat(streamed) == idat(buffered.getvalue())
+    assert decode(streamed) == rows
@@ -0,0 +1,114 @@
+from io import BytesIO
+
+import pytest
+
+from image_processing.canvas import Canvas, RgbaColor
+from image_processing.pnm_reader import PnmReader
+
+WIDTH, HEIGHT = 5, 3
+
+
+def samples(channels):
+    """Builds the 8-bit samples of a test image, one bytes object per row."""
+    return [bytes((x * 50 + y * 20 + c * 70) % 256 for x in range(WIDTH) for c in range(channels))
+            for y in range(HEIGHT)]
+
+
+def widen(rows):
+    """Turns 8-bit samples into 16-bit samples with a maxval of 65535."""
+    return [b"".join(bytes((v, v)) for v in row) for row in rows]
+
+
+def expected_canvas(rows, channels):
+    canvas = Canvas(WIDTH, HEIGHT, RgbaColor(0, 0, 0, 0))
+    for y, row in enumerate(rows):
+        canvas.import_row(y, row, channels)
+    return canvas
+
+
+def read(data):
+    return PnmReader(BytesIO(data)).to_canvas()
+
+
+@pytest.mark.parametrize("magic, channels", [(b"P5", 1), (b"P6", 3)])
+def test_pgm_and_ppm(magic, channels):
+    rows = samples(channels)
+    canvas = read(magic + b"\n%d %d\n255\n" % (WIDTH, HEIGHT) + b"".join(rows))
+
+    assert canvas.pixels == expected_canvas(rows, channels).pixels
+    assert tuple(canvas.bgcolor) == (0, 0, 0, 1)
+
+
+@pytest.mark.parametrize("tupltype, channels", [(b"GRAYSCALE", 1), (b"GRAYSCALE_ALPHA", 2), (b"RGB", 3),
+                                                (b"RGB_ALPHA", 4), (None, 4)])
+def test_pam(tupltype, channels):
+    rows = samples(channels)
+    header = b"P7\nWIDTH %d\nHEIGHT %d\nDEPTH %d\nMAXVAL 255\n" % (WIDTH, HEIGHT, channels)
+    if tupltype is not None:
+        header += b"TUPLTYPE " + tupltype + b"\n"
+    canvas = read(header + b"ENDHDR\n" + b"".join(rows))
+
+    assert canvas.pixels == expected_canvas(rows, channels).pixels
+    assert tuple(canvas.bgcolor) == (0, 0, 0, 0 if channels in (2, 4) else 1)
+
+
+def test_comments_in_the_header():
+    rows = samples(3)
+    ppm = b"P6 # a comment\n# another one\n%d\t%d # size\n#\n255\n" % (WIDTH, HEIGHT) + b"".join(rows)
+    pam = b"P7\n# a comment\nWIDTH %d # width\nHEIGHT %d\n\nDEPTH 3\nMAXVAL 255\nENDHDR\n" % (WIDTH, HEIGHT)
+
+    assert read(ppm).pixels == expected_canvas(rows, 3).pixels
+    assert read(pam + b"".join(rows)).pixels == expected_canvas(rows, 3).pixels
+
+
+def test_maxval_65535():
+    rows = samples(3)
+    canvas = read(b"P6\n%d %d\n65535\n" % (WIDTH, HEIGHT) + b"".join(widen(rows)))
+
+    assert canvas.pixels == expected_canvas(rows, 3).pixels
+
+    pam = b"P7\nWIDTH %d\nHEIGHT %d\nDEPTH 4\nMAXVAL 65535\nENDHDR\n" % (WIDTH, HEIGHT)
+    rows = samples(4)
+    assert read(pam + b"".join(widen(rows))).pixels == expected_canvas(rows, 4).pixels
+
+
+def test_other_maxvals_are_scaled():
+    canvas = read(b"P5 3 1 15\n" + bytes((0, 8, 15)))
+    assert [canvas.at(x, 0).r for x in range(3)] == [0., 136 / 255, 1.]
+
+
+def test_read_into_checks_the_size():
+    reader = PnmReader(BytesIO(b"P5 2 2 255\n" + bytes(4)))
+
+    with pytest.raises(ValueError):
+        reader.read_into(Canvas(3, 2, RgbaColor(0, 0, 0, 1)))
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"P3\n2 2\n255\n",
+    b"P6\n2",
+    b"P6\n2 2",
+    b"P6\n2 x 255\n",
+    b"P6\n0 2 255\n",
+    b"P6\n2 2 0\n",
+    b"P6\n2 2 65536\n",
+    b"P7\nWIDTH 2\nHEIGHT 2\nDEPTH 3\nMAXVAL 255\n",
+    b"P7\nWIDTH 2\nHEIGHT 2\nMAXVAL 255\nENDHDR\n",
+    b"P7\nWIDTH 2\nHEIGHT 2\nDEPTH 5\nMAXVAL 255\nENDHDR\n",
+    b"P7\nWIDTH 2\nHEIGHT 2\nDEPTH 3\nMAXVAL 255\nTUPLTYPE RGB_ALPHA\nENDHDR\n",
+    b"P7\nWIDTH two\nHEIGHT 2\nDEPTH 3\nMAXVAL 255\nENDHDR\n",
+])
+def test_invalid_headers_raise_value_error(data):
+    with pytest.raises(ValueError):
+        read(data)
+
+
+@pytest.mark.parametrize("data", [
+    b"P6\n2 2\n255\n" + bytes(11),
+    b"P5\n2 2\n65535\n" + bytes(7),
+    b"P7\nWIDTH 2\nHEIGHT 2\nDEPTH 4\nMAXVAL 255\nENDHDR\n" + bytes(8),
+])
+def test_truncated_data_raises_value_error(data):
+    with pytest.raises(ValueError):
+        read(data)
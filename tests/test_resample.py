@@ -0,0 +1,130 @@
+import pytest
+
+from image_processing import resample
+
+
+def axis_weights(src_size, dst_size, filter):
+    """Computes the weights of every source sample for every target sample straight from the kernel."""
+    scale = src_size / dst_size
+    table = []
+
+    for i in range(dst_size):
+        center = (i + 0.5) * scale
+
+        if filter == resample.NEAREST:
+            ws = [0.] * src_size
+            ws[min(int(center), src_size - 1)] = 1.
+        else:
+            kernel, _ = resample.KERNELS[filter]
+            filter_scale = max(scale, 1.)
+            ws = [kernel((j + 0.5 - center) / filter_scale) for j in range(src_size)]
+            total = sum(ws)
+            ws = [w / total for w in ws]
+
+        table.append(ws)
+
+    return table
+
+
+def reference(canvas, width, height, filter):
+    """Resizes a canvas the slow way: every target pixel is the weighted sum of all source pixels, premultiplied."""
+    wx = axis_weights(canvas.width, width, filter)
+    wy = axis_weights(canvas.height, height, filter)
+    pixels = []
+
+    for j in range(height):
+        for i in range(width):
+            if filter == resample.NEAREST:
+                pixels.append(canvas.at(wx[i].index(1.), wy[j].index(1.)))
+                continue
+
+            sums = [0.] * 4
+
+            for y in range(canvas.height):
+                for x in range(canvas.width):
+                    w = wx[i][x] * wy[j][y]
+
+                    if w:
+                        r, g, b, a = canvas.at(x, y)
+                        sums = [s + v * w for s, v in zip(sums, (r * a, g * a, b * a, a))]
+
+            # Lanczos overshoots, so the premultiplied values are clamped before dividing by alpha and after.
+            r, g, b, a = [min(max(s, 0.), 1.) for s in sums]
+            pixels.append(tuple(min(max(c / a, 0.), 1.) if a > 0. else 0. for c in (r, g, b)) + (a,))
+
+    return pixels
+
+
+def assert_close(canvas, expected, tolerance=1e-9):
+    actual = [canvas.at(x, y) for y in range(canvas.height) for x in range(canvas.width)]
+    assert len(actual) == len(expected)
+
+    for a, e in zip(actual, expected):
+        assert all(abs(u - v) <= tolerance for u, v in zip(a, e)), (a, e)
+
+
+@pytest.mark.parametrize("filter", [resample.NEAREST, resample.BOX, resample.BILINEAR, resample.LANCZOS])
+@pytest.mark.parametrize("size", [(4, 3), (3, 4), (1, 1), (1, 7), (9, 5), (16, 2), (20, 13), (24, 14)])
+def test_resize_matches_reference(make_pattern, filter, size):
+    canvas = make_pattern(12, 7)
+    assert_close(canvas.resize(*size, filter=filter), reference(canvas, *size, filter))
+
+
+@pytest.mark.parametrize("filter", [resample.BOX, resample.BILINEAR, resample.LANCZOS])
+def test_opaque_resize_matches_reference(make_pattern, filter):
+    canvas = make_pattern(10, 8, opaque=True)
+
+    for size in ((5, 4), (7, 3), (15, 11)):
+        resized = canvas.resize(*size, filter=filter)
+        assert_close(resized, reference(canvas, *size, filter))
+        assert all(a == 1. for a in resized.pixels[3::4])
+
+
+def test_box_reduction_by_integer_factors_averages_blocks(make_pattern):
+    canvas = make_pattern(8, 6, opaque=True)
+    resized = canvas.resize(4, 2, filter=resample.BOX)
+
+    for x, y in ((0, 0), (3, 1)):
+        block = [canvas.at(x * 2 + i, y * 3 + j) for i in range(2) for j in range(3)]
+        assert resized.at(x, y)[:3] == pytest.approx([sum(c[k] for c in block) / 6 for k in range(3)], abs=1e-12)
+
+
+def test_both_pass_orders_match_reference(make_pattern):
+    # A wide target runs the vertical pass first, a tall one the horizontal pass.
+    for width, height in ((30, 2), (2, 30)):
+        canvas = make_pattern(6, 6)
+        assert_close(canvas.resize(width, height, filter=resample.BILINEAR),
+                     reference(canvas, width, height, resample.BILINEAR))
+
+
+def test_same_size_returns_a_copy(make_pattern):
+    canvas = make_pattern(5, 4)
+    resized = canvas.resize(5, 4, filter=resample.LANCZOS)
+
+    assert resized.pixels == canvas.pixels and resized.pixels is not canvas.pixels
+
+
+def test_reducing_gap_box_reduces_first(make_pattern):
+    canvas = make_pattern(24, 18)
+    resized = canvas.resize(5, 3, filter=resample.LANCZOS, reducing_gap=2.)
+
+    # 24 / (5 * 2) allows a factor of 2 horizontally, 18 / (3 * 2) one of 3 vertically.
+    reduced = canvas.resize(12, 6, filter=resample.BOX)
+    assert_close(resized, [reduced.resize(5, 3, filter=resample.LANCZOS).at(x, y)
+                           for y in range(3) for x in range(5)])
+
+    # The result stays close to resampling in one step.
+    assert_close(resized, [canvas.resize(5, 3, filter=resample.LANCZOS).at(x, y) for y in range(3) for x in range(5)],
+                 tolerance=0.25)
+
+
+def test_invalid_arguments_are_rejected(make_pattern):
+    canvas = make_pattern(4, 4)
+
+    for width, height in ((0, 2), (2, 0), (-1, 2)):
+        with pytest.raises(ValueError):
+            canvas.resize(width, height)
+    with pytest.raises(ValueError):
+        canvas.resize(2, 2, filter="cubic")
+    with pytest.raises(ValueError):
+        canvas.resize(2, 2, reducing_gap=0.5)